@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Keeps track of which clips have already been archived, so that archiveloop
+doesn't archive them again from older snapshots.
+
+The list lives in an SQLite database in /mutable, indexed by path, so that
+comparing it to the current snapshot listing doesn't require sorting either
+of them. A damaged database is moved aside and rebuilt from what can still
+be read from it, and the commands exit with 1 if the ledger can't be used,
+e.g. because another process keeps it locked.
+
+Usage:
+  archive_ledger.py candidates <listing> <output>
+      Forget archived files that are no longer in any snapshot (i.e. aren't
+      in <listing>), and write the files from <listing> that haven't been
+      archived yet to <output>.
+  archive_ledger.py list
+      Print all archived files.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+from teslausb_common import read_lines, write_atomically
+
+LEDGER_FILE = '/mutable/archive_ledger.db'
+# The plain text list that was used before, which is imported (and then
+# removed) the first time it's found.
+LEGACY_LIST_FILE = '/mutable/sentry_files_archived'
+
+# Rows are inserted in batches of this many.
+BATCH_SIZE = 10000
+
+
+def _batches(iterable):
+    batch = []
+    for item in iterable:
+        batch.append((item,))
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _is_locked(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def _is_corrupt(error, path):
+    """
+    Checking the whole database takes a while on an SD card, so it's only
+    done once using it failed.
+    :return: whether the error means the database file is damaged, rather
+             than e.g. locked by another process
+    """
+    if not isinstance(error, sqlite3.DatabaseError) or _is_locked(error):
+        return False
+    try:
+        db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, timeout=60)
+        try:
+            return db.execute('PRAGMA quick_check').fetchone()[0] != 'ok'
+        finally:
+            db.close()
+    except sqlite3.DatabaseError as e:
+        return not _is_locked(e)
+
+
+def _rebuild(path):
+    """
+    Move a damaged ledger aside to <path>.corrupt, and start a new one with
+    whatever could still be read from it.
+    """
+    salvaged = []
+    try:
+        old = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        try:
+            for (clip,) in old.execute('SELECT path FROM archived'):
+                salvaged.append(clip)
+        finally:
+            old.close()
+    except sqlite3.Error:
+        pass
+    for suffix in ('', '-journal'):
+        if os.path.exists(path + suffix):
+            os.replace(path + suffix, path + '.corrupt' + suffix)
+    print('archive ledger {} was damaged, moved it to {}.corrupt and kept {} file(s) from it'.format(
+        path, path, len(salvaged)), file=sys.stderr)
+    db = _connect(path)
+    add(db, salvaged)
+    return db
+
+
+def _connect(path):
+    # Wait a while for other processes using the ledger, rather than failing
+    # right away.
+    db = sqlite3.connect(path, timeout=60)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS archived (path TEXT PRIMARY KEY) WITHOUT ROWID')
+    except sqlite3.Error:
+        db.close()
+        raise
+    return db
+
+
+def open_ledger(path=LEDGER_FILE, legacy_path=LEGACY_LIST_FILE):
+    """
+    Open the ledger, creating it if needed, or rebuilding it if it's
+    damaged. The default synchronous mode is kept, since power is often cut
+    without warning and anything less can leave the database corrupt.
+    :param path: the database file
+    :param legacy_path: text list of archived files to import, if it exists
+    :return: an sqlite3 connection
+    :raises sqlite3.Error: if the ledger is locked by another process
+    """
+    try:
+        db = _connect(path)
+    except sqlite3.DatabaseError as e:
+        if not _is_corrupt(e, path):
+            raise
+        db = _rebuild(path)
+    if legacy_path and os.path.exists(legacy_path):
+        with db:
+            for batch in _batches(read_lines(legacy_path)):
+                db.executemany('INSERT OR IGNORE INTO archived VALUES (?)', batch)
+        os.remove(legacy_path)
+    return db
+
+
+def candidates(db, listing, output):
+    """
+    Compare the ledger to the current snapshot listing, in a single pass.
+    :param db: the ledger
+    :param listing: file with the clips currently in the snapshots
+    :param output: file to write the clips that still need archiving to
+    :return: (number of clips to archive, number of clips forgotten)
+    """
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS listing (path TEXT PRIMARY KEY) WITHOUT ROWID')
+    db.execute('DELETE FROM listing')
+    for batch in _batches(read_lines(listing)):
+        db.executemany('INSERT OR IGNORE INTO listing VALUES (?)', batch)
+
+    with db:
+        forgotten = db.execute('DELETE FROM archived WHERE path NOT IN (SELECT path FROM listing)').rowcount
+
+    query = 'SELECT path FROM listing WHERE path NOT IN (SELECT path FROM archived) ORDER BY path'
+    paths = [path for (path,) in db.execute(query)]
+    write_atomically(output, ''.join(path + '\n' for path in paths))
+    db.execute('DELETE FROM listing')
+    return len(paths), forgotten
+
+
+def add(db, paths):
+    """
+    Record the given clips as archived, in a single transaction.
+    """
+    with db:
+        for batch in _batches(paths):
+            db.executemany('INSERT OR IGNORE INTO archived VALUES (?)', batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ledger', default=LEDGER_FILE, help='The ledger database.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    candidates_parser = subparsers.add_parser('candidates')
+    candidates_parser.add_argument('listing')
+    candidates_parser.add_argument('output')
+    subparsers.add_parser('list')
+    args = parser.parse_args()
+
+    def run(db):
+        if args.command == 'candidates':
+            count, forgotten = candidates(db, args.listing, args.output)
+            print('{} file(s) to archive, forgot {} file(s) no longer in any snapshot'.format(count, forgotten),
+                  file=sys.stderr)
+        else:
+            for (path,) in db.execute('SELECT path FROM archived ORDER BY path'):
+                print(path)
+
+    try:
+        db = open_ledger(args.ledger)
+        try:
+            run(db)
+        except sqlite3.DatabaseError as e:
+            # Damage that didn't show when opening it.
+            if not _is_corrupt(e, args.ledger):
+                raise
+            db.close()
+            db = _rebuild(args.ledger)
+            run(db)
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        print("couldn't use archive ledger {}: {}".format(args.ledger, e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Archives clips through the configured archive-clips.sh, most important ones
+first, with several transfers running at once.
+
+Usage: archive_scheduler.py <dir> <list> [<dir> <list>]...
+
+The first list is split into batches: SavedClips first, then SentryClips,
+track mode clips and RecentClips, newest event first within each. The
+batches are handed to archive-clips.sh by ARCHIVE_WORKERS workers (default
+2), which share ARCHIVE_BANDWIDTH_LIMIT KiB/s (default unlimited). Any
+further lists, i.e. the trigger files, are archived once all clips are.
+
+Every batch's archived clips are added to the archive ledger as soon as the
+batch is done, so if archiving is interrupted, the next run picks up where
+this one left off. The outcome for each clip is written to
+/tmp/archive_results, and the number of track mode clips and other clips
+archived is printed.
+
+The start and end of the run, and the size of each clip and how long it
+took to archive, are recorded with telemetry.py. archive-clips.sh moves a
+clip off the drive once it's archived, so how long each took is seen by
+checking for that every FILE_POLL_INTERVAL seconds.
+
+Once archive-clips.sh fails, no new batches are started, since that
+generally means the archive server became unreachable, and the exit code
+is 1.
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import archive_ledger
+import telemetry
+import teslausb_metrics
+from teslausb_common import log
+
+ARCHIVE_CLIPS = '/root/bin/archive-clips.sh'
+RESULTS_FILE = '/tmp/archive_results'
+BATCH_DIR = '/tmp/archive_batches'
+
+# Lower is more important.
+PRIORITIES = (
+    ('SavedClips/', 0),
+    ('SentryClips/', 1),
+    ('TeslaTrackMode/', 2),
+    ('RecentClips/', 3),
+)
+BATCH_SIZE = 50
+FILE_POLL_INTERVAL = 1
+
+
+def _env_int(name, default):
+    value = os.environ.get(name, '')
+    return int(value) if value.strip() else default
+
+
+def _priority(path):
+    for prefix, priority in PRIORITIES:
+        if path.startswith(prefix):
+            return priority
+    return len(PRIORITIES)
+
+
+def prioritize(paths):
+    """
+    Sort clips in the order they should be archived: by category, then
+    newest event (or, for clips that aren't in an event folder, newest clip)
+    first. Clip names and event folder names start with their timestamp, so
+    sorting by name sorts by time.
+    """
+    def event(path):
+        if path.startswith(('SavedClips/', 'SentryClips/')):
+            return os.path.dirname(path)
+        return path
+
+    # Each sort keeps the order of the previous one for equal keys, so the
+    # files of an event stay together, in their usual order.
+    paths = sorted(paths)
+    paths.sort(key=event, reverse=True)
+    paths.sort(key=_priority)
+    return paths
+
+
+def make_batches(paths, size=BATCH_SIZE):
+    return [paths[i:i + size] for i in range(0, len(paths), size)]
+
+
+class Scheduler:
+    def __init__(self, directory, workers, bandwidth_limit):
+        self.directory = directory
+        self.workers = workers
+        self.env = dict(os.environ)
+        if bandwidth_limit:
+            # Each archive-clips.sh gets an equal share, since the backends
+            # can only limit their own transfers.
+            self.env['ARCHIVE_BWLIMIT'] = str(max(1, bandwidth_limit // workers))
+        self.failed = threading.Event()
+        self.lock = threading.Lock()
+        self.batch_number = 0
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        # path to outcome, of the clips whose batches are done
+        self.results = {}
+
+    def _batch_file(self, paths):
+        with self.lock:
+            self.batch_number += 1
+            path = os.path.join(BATCH_DIR, str(self.batch_number))
+        with open(path, 'w', errors='surrogateescape') as f:
+            for line in paths:
+                f.write(line + '\n')
+        return path
+
+    def run_batch(self, directory, paths):
+        """
+        Archive one batch, unless an earlier batch failed.
+        :return: (dict of path to 'archived', 'failed' or 'skipped',
+                  number of bytes archived)
+        """
+        if self.failed.is_set():
+            return dict((path, 'skipped') for path in paths), 0
+        sizes = {}
+        for path in paths:
+            try:
+                sizes[path] = os.stat(os.path.join(directory, path)).st_size
+            except OSError:
+                sizes[path] = 0
+        batch_file = self._batch_file(paths)
+        start = time.monotonic()
+        process = subprocess.Popen([ARCHIVE_CLIPS, directory, batch_file], env=self.env,
+                                   stdin=subprocess.DEVNULL, stdout=sys.stderr)
+        pending = list(paths)
+        last_done = start
+        while pending:
+            try:
+                process.wait(FILE_POLL_INTERVAL)
+                finished = True
+            except subprocess.TimeoutExpired:
+                finished = False
+            last_done = self._record_archived(directory, pending, sizes, last_done)
+            if finished:
+                break
+        returncode = process.wait()
+        os.remove(batch_file)
+        # Archiving a clip moves it off the drive, so whatever is left failed.
+        results = dict((path, 'failed' if os.path.lexists(os.path.join(directory, path)) else 'archived')
+                       for path in paths)
+        archived = sum(1 for status in results.values() if status == 'archived')
+        log('archived {} of {} file(s) in {:.0f}s'.format(archived, len(paths), time.monotonic() - start))
+        if returncode != 0:
+            if not self.failed.is_set():
+                log('archive-clips.sh exited with code {}, not starting any more batches'.format(returncode))
+            self.failed.set()
+        return results, sum(sizes[path] for path, status in results.items() if status == 'archived')
+
+    def _record_archived(self, directory, pending, sizes, last_done):
+        """
+        Record the clips in pending that have been moved off the drive since
+        the last check, and take them out of pending. The time since the
+        last clip was archived is shared out among them by size.
+        :return: when the last clip was archived
+        """
+        done = [path for path in pending if not os.path.lexists(os.path.join(directory, path))]
+        if not done:
+            return last_done
+        now = time.monotonic()
+        total = sum(sizes[path] for path in done)
+        for path in done:
+            pending.remove(path)
+            share = sizes[path] / total if total else 1 / len(done)
+            telemetry.emit('archive_file', run=self.run_id, path=path, bytes=sizes[path],
+                           seconds=round((now - last_done) * share, 3))
+        return now
+
+    def run(self, paths, ledger):
+        """
+        Archive the clips, recording each batch's archived clips in the
+        ledger as it completes.
+        The outcome for each clip is kept in self.results, also when this
+        raises.
+        """
+        batches = make_batches(prioritize(paths))
+        log('archiving {} file(s) in {} batch(es) with {} worker(s)'.format(len(paths), len(batches), self.workers))
+        start = time.time()
+        files_done = 0
+        bytes_done = 0
+        teslausb_metrics.set_archive_progress(in_progress=True, started_at=start, files_total=len(paths),
+                                              files_done=0, bytes_done=0)
+        telemetry.emit('archive_start', run=self.run_id, files=len(paths), batches=len(batches),
+                       workers=self.workers)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # The executor starts batches in the order they're submitted.
+                futures = [executor.submit(self.run_batch, self.directory, batch) for batch in batches]
+                for batch, future in zip(batches, futures):
+                    try:
+                        batch_results, batch_bytes = future.result()
+                    except Exception as e:
+                        if not self.failed.is_set():
+                            log("couldn't archive batch: {}, not starting any more batches".format(e))
+                        self.failed.set()
+                        batch_results, batch_bytes = dict((path, 'failed') for path in batch), 0
+                    self.results.update(batch_results)
+                    archived = [path for path, status in batch_results.items() if status == 'archived']
+                    files_done += len(archived)
+                    bytes_done += batch_bytes
+                    archive_ledger.add(ledger, archived)
+                    teslausb_metrics.set_archive_progress(in_progress=True, started_at=start,
+                                                          files_total=len(paths), files_done=files_done,
+                                                          bytes_done=bytes_done)
+        finally:
+            duration = round(time.time() - start, 1)
+            teslausb_metrics.set_archive_progress(in_progress=False, started_at=start, files_total=len(paths),
+                                                  files_done=files_done, bytes_done=bytes_done)
+            teslausb_metrics.update_counters(
+                add={'archived_bytes': bytes_done, 'archived_files': files_done, 'archive_runs': 1,
+                     'archive_seconds': duration},
+                values={'last_archive_seconds': duration})
+            telemetry.emit('archive_end', run=self.run_id, files=files_done, bytes=bytes_done, seconds=duration,
+                           failed=self.failed.is_set())
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) < 2 or len(args) % 2:
+        print(__doc__, file=sys.stderr)
+        return 2
+
+    directory, list_file = args[0], args[1]
+    with open(list_file, 'r', errors='surrogateescape') as f:
+        paths = [line.rstrip('\n') for line in f if line.strip()]
+
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    scheduler = Scheduler(directory,
+                          max(1, _env_int('ARCHIVE_WORKERS', 2)),
+                          _env_int('ARCHIVE_BANDWIDTH_LIMIT', 0))
+    try:
+        ledger = archive_ledger.open_ledger()
+        try:
+            scheduler.run(paths, ledger)
+        finally:
+            ledger.close()
+
+        # The trigger files go last, so they show up once everything else is
+        # there.
+        exit_code = 1 if scheduler.failed.is_set() else 0
+        if exit_code == 0:
+            for extra_dir, extra_list in zip(args[2::2], args[3::2]):
+                if subprocess.run([ARCHIVE_CLIPS, extra_dir, extra_list], stdin=subprocess.DEVNULL,
+                                  stdout=sys.stderr, check=False).returncode != 0:
+                    exit_code = 1
+    finally:
+        # Clips that weren't gotten to are reported as skipped.
+        results = scheduler.results
+        with open(RESULTS_FILE, 'w', errors='surrogateescape') as f:
+            for path in paths:
+                f.write('{}\t{}\n'.format(results.get(path, 'skipped'), path))
+
+    trackmode = sum(1 for path, status in results.items()
+                    if status == 'archived' and path.startswith('TeslaTrackMode'))
+    other = sum(1 for status in results.values() if status == 'archived') - trackmode
+    print('{} {}'.format(trackmode, other))
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -26,22 +26,39 @@ function connectionmonitor {
 
 connectionmonitor $$ &
 
+flags=()
+# set by archive_scheduler.py, in KiB/s
+if [ -n "${ARCHIVE_BWLIMIT:-}" ]
+then
+  flags+=("--bwlimit=$ARCHIVE_BWLIMIT")
+fi
+
 # rsync's temp files may be left behind if the connection is lost,
 # but rsync doesn't clean these up on subsequent runs. Putting
 # them in a temp dir allows them to be easily cleaned up.
-rsynctmp=".teslausbtmp"
+# archive_scheduler.py runs several of these at once, so each gets its
+# own, and those of earlier runs that are no longer running are removed.
+for dir in "$ARCHIVE_MOUNT/.teslausbtmp/"*
+do
+  if ! kill -0 "${dir##*/}" 2> /dev/null
+  then
+    rm -rf "$dir" || true
+  fi
+done
+rsynctmp=".teslausbtmp/$$"
 rm -rf "$ARCHIVE_MOUNT/${rsynctmp:?}" || true
 mkdir -p "$ARCHIVE_MOUNT/$rsynctmp"
 
-rm -f /tmp/archive-rsync-cmd.log /tmp/archive-error.log
+rm -f /tmp/archive-rsync-cmd.$$.log
 
 while [ -n "${1+x}" ]
 do
   if ! (rsync -avhRL --remove-source-files --temp-dir="$rsynctmp" --no-perms --omit-dir-times --stats \
-        --log-file=/tmp/archive-rsync-cmd.log --ignore-missing-args \
-        --files-from="$2" "$1/" "$ARCHIVE_MOUNT" &> /tmp/rsynclog || [[ "$?" = "24" ]] )
+        --log-file=/tmp/archive-rsync-cmd.$$.log --ignore-missing-args "${flags[@]}" \
+        --files-from="$2" "$1/" "$ARCHIVE_MOUNT" &> /tmp/rsynclog.$$ || [[ "$?" = "24" ]] )
   then
-    cat /tmp/archive-rsync-cmd.log /tmp/rsynclog > /tmp/archive-error.log
+    cat /tmp/archive-rsync-cmd.$$.log /tmp/rsynclog.$$ >> /tmp/archive-error.log
+    rm -f /tmp/archive-rsync-cmd.$$.log /tmp/rsynclog.$$
     exit 1
   fi
 
@@ -49,5 +66,6 @@ do
 done
 
 rm -rf "$ARCHIVE_MOUNT/${rsynctmp:?}" || true
+rm -f /tmp/archive-rsync-cmd.$$.log /tmp/rsynclog.$$
 
 kill %1 || true
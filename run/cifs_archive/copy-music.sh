@@ -2,7 +2,6 @@
 
 SRC="/mnt/musicarchive"
 DST="/mnt/music"
-LOG="/tmp/rsyncmusiclog.txt"
 
 # check that DST is the mounted disk image, not the mountpoint directory
 if ! findmnt --mountpoint $DST > /dev/null
@@ -24,10 +23,11 @@ function connectionmonitor {
       fi
     done
     log "connection dead, killing copy-music"
-    # Give rsync a chance to clean up before killing it hard.
-    killall rsync || true
+    # Give music_sync.py a chance to save its manifest before killing it
+    # hard.
+    pkill -f /root/bin/music_sync.py || true
     sleep 2
-    killall -9 rsync || true
+    pkill -9 -f /root/bin/music_sync.py || true
     kill -9 "$1" || true
     return
   done
@@ -53,11 +53,15 @@ function do_music_sync {
 
   connectionmonitor $$ &
 
-  if ! rsync -rum --no-human-readable --exclude=.fseventsd/*** --exclude=*.DS_Store --exclude=.metadata_never_index \
-                --exclude="System Volume Information/***" \
-                --delete --modify-window=2 --info=stats2 "$SRC/" "$DST" &> "$LOG"
+  # music_sync.py only lists the folders on the share that changed since the
+  # last sync, and prints the number of files copied, deleted, skipped and
+  # failed.
+  local counts=""
+  local result=0
+  counts=$(/root/bin/music_sync.py sync "$SRC" "$DST" 2>> "$LOG_FILE") || result=$?
+  if [ "$result" != 0 ]
   then
-    log "rsync failed with error $?"
+    log "music sync failed with error $result"
   fi
 
   # Stop the connection monitor.
@@ -66,18 +70,11 @@ function do_music_sync {
   # remove empty directories
   find $DST -depth -type d -empty -delete || true
 
-  # parse log for relevant info
-  declare -i NUM_FILES_COPIED
-  NUM_FILES_COPIED=$(($(sed -n -e 's/\(^Number of regular files transferred: \)\([[:digit:]]\+\).*/\2/p' "$LOG")))
-  declare -i NUM_FILES_DELETED
-  NUM_FILES_DELETED=$(($(sed -n -e 's/\(^Number of deleted files: [[:digit:]]\+ (reg: \)\([[:digit:]]\+\)*.*/\2/p' "$LOG")))
-  declare -i TOTAL_FILES
-  TOTAL_FILES=$(sed -n -e 's/\(^Number of files: [[:digit:]]\+ (reg: \)\([[:digit:]]\+\)*.*/\2/p' "$LOG")
-  declare -i NUM_FILES_ERROR
-  NUM_FILES_ERROR=$(($(grep -c "failed to open" $LOG || true)))
-
-  declare -i NUM_FILES_SKIPPED=$((TOTAL_FILES-NUM_FILES_COPIED))
-  NUM_FILES_COPIED=$((NUM_FILES_COPIED-NUM_FILES_ERROR))
+  declare -i NUM_FILES_COPIED=0
+  declare -i NUM_FILES_DELETED=0
+  declare -i NUM_FILES_SKIPPED=0
+  declare -i NUM_FILES_ERROR=0
+  read -r NUM_FILES_COPIED NUM_FILES_DELETED NUM_FILES_SKIPPED NUM_FILES_ERROR <<< "$counts" || true
 
   log "Copied $NUM_FILES_COPIED music file(s), deleted $NUM_FILES_DELETED, skipped $NUM_FILES_SKIPPED previously-copied files, and encountered $NUM_FILES_ERROR errors."
 
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Makes the music drive a copy of the music share, like rsync -r --delete
+would, without looking at every file on the share each time.
+
+What was found on the share is kept in a manifest in /mutable. A folder's
+modification time changes whenever files are added to, removed from or
+renamed in it, so the files of folders whose modification time hasn't
+changed are taken from the manifest rather than listed and stat-ed again
+over the network. Files that were changed in place without being renamed
+are only seen by a full scan, which is done once a day (or with --full).
+
+The music drive itself is local, so it's always scanned in full. Files that
+are missing from it or differ in size or modification time (allowing for
+FAT's 2 second resolution) are copied, by several workers at once, each
+through a fixed-size buffer. Files that are no longer on the share are
+deleted first, to make room. A file is copied to a temporary name and
+renamed when complete, so an interrupted sync doesn't leave partial files
+behind. The SHA-1 of every copied file is recorded, so that "verify" can
+check them later.
+
+Usage:
+  music_sync.py sync <share> <drive> [--full] [--workers 2]
+      Prints the number of files copied, deleted, skipped because they were
+      up to date, and that couldn't be copied or deleted.
+  music_sync.py verify <drive>
+      Check the copied files against their recorded SHA-1, and delete the
+      ones that don't match, so that the next sync copies them again.
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# This is installed into /root/bin, next to teslausb_common.py.
+from teslausb_common import log, write_atomically
+
+MANIFEST_FILE = '/mutable/music_manifest.json'
+MANIFEST_VERSION = 1
+# Scan every folder on the share at least this often, to catch files that
+# were changed in place.
+FULL_SCAN_INTERVAL = 24 * 3600
+# Modification times that are this close to the time of the scan can't be
+# trusted, since more changes could follow within the same second.
+RACY_WINDOW = 2
+# FAT only keeps modification times to 2 seconds.
+MODIFY_WINDOW = 2
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 2
+TEMP_SUFFIX = '.musicsync~'
+# Not copied, and not deleted from the drive either.
+EXCLUDE_NAMES = ('.fseventsd', '*.DS_Store', '.metadata_never_index', 'System Volume Information')
+
+
+def _excluded(name):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in EXCLUDE_NAMES)
+
+
+def _join(directory, name):
+    return directory + '/' + name if directory else name
+
+
+def load_manifest(path=MANIFEST_FILE):
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'full_scan_at': 0, 'source': {}, 'copied': {}}
+
+
+def _serialize_manifest(manifest):
+    return json.dumps(manifest, separators=(',', ':'))
+
+
+def save_manifest(manifest, path=MANIFEST_FILE):
+    write_atomically(path, _serialize_manifest(manifest))
+
+
+def scan_source(root, previous, full):
+    """
+    :param previous: the folders found by the last scan, as returned by this
+    :param full: whether to list every folder, even unchanged ones
+    :return: (dict of folder to {'mtime': ..., 'files': {name: [size, mtime]},
+              'dirs': [names]}, set of folders that couldn't be read)
+    """
+    result = {}
+    failed = set()
+    stack = ['']
+    while stack:
+        directory = stack.pop()
+        path = os.path.join(root, directory)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError as e:
+            log("couldn't read {}: {}".format(path, e))
+            failed.add(directory)
+            continue
+        entry = previous.get(directory)
+        if full or entry is None or entry['mtime'] is None or entry['mtime'] != mtime:
+            files = {}
+            dirs = []
+            try:
+                with os.scandir(path) as entries:
+                    for dir_entry in entries:
+                        if _excluded(dir_entry.name) or dir_entry.name.endswith(TEMP_SUFFIX):
+                            continue
+                        # Like rsync without -l, symlinks are left out.
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            dirs.append(dir_entry.name)
+                        elif dir_entry.is_file(follow_symlinks=False):
+                            st = dir_entry.stat(follow_symlinks=False)
+                            files[dir_entry.name] = [st.st_size, st.st_mtime]
+            except OSError as e:
+                log("couldn't list {}: {}".format(path, e))
+                failed.add(directory)
+                continue
+            racy = time.time() - mtime < RACY_WINDOW
+            entry = {'mtime': None if racy else mtime, 'files': files, 'dirs': sorted(dirs)}
+        result[directory] = entry
+        stack.extend(_join(directory, name) for name in entry['dirs'])
+    return result, failed
+
+
+def scan_drive(root):
+    """
+    Scan the drive, removing temporary files left behind by an interrupted
+    sync.
+    :return: dict of path to (size, mtime) of all files
+    """
+    result = {}
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [name for name in dirs if not _excluded(name)]
+        relative = os.path.relpath(directory, root)
+        relative = '' if relative == '.' else relative
+        for name in files:
+            path = os.path.join(directory, name)
+            if name.endswith(TEMP_SUFFIX):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if _excluded(name):
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            result[_join(relative, name)] = (st.st_size, st.st_mtime)
+    return result
+
+
+def _needs_copy(source, destination):
+    if destination is None:
+        return True
+    size, mtime = source
+    dest_size, dest_mtime = destination
+    # Like rsync -u, files that are newer on the drive are left alone.
+    if dest_mtime > mtime + MODIFY_WINDOW:
+        return False
+    return size != dest_size or abs(mtime - dest_mtime) > MODIFY_WINDOW
+
+
+def plan(source_dirs, failed, drive_files):
+    """
+    :return: (list of (path, size, mtime) to copy, list of paths to delete,
+              number of files that are up to date)
+    """
+    source_files = {}
+    for directory, entry in source_dirs.items():
+        for name, (size, mtime) in entry['files'].items():
+            source_files[_join(directory, name)] = (size, mtime)
+
+    copies = []
+    skipped = 0
+    for path in sorted(source_files):
+        size, mtime = source_files[path]
+        if _needs_copy((size, mtime), drive_files.get(path)):
+            copies.append((path, size, mtime))
+        else:
+            skipped += 1
+
+    def unknown(path):
+        # Files in folders that couldn't be read may still be on the share.
+        return any(path.startswith(directory + '/') for directory in failed)
+
+    deletes = [path for path in sorted(drive_files) if path not in source_files and not unknown(path)]
+    return copies, deletes, skipped
+
+
+def copy_file(source, destination, mtime):
+    """
+    :return: the SHA-1 of the file
+    """
+    directory, name = os.path.split(destination)
+    os.makedirs(directory, exist_ok=True)
+    temp = os.path.join(directory, '.' + name + TEMP_SUFFIX)
+    digest = hashlib.sha1()
+    try:
+        with open(source, 'rb') as fin, open(temp, 'wb') as fout:
+            while True:
+                chunk = fin.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                fout.write(chunk)
+        os.utime(temp, (mtime, mtime))
+        os.replace(temp, destination)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+    return digest.hexdigest()
+
+
+def sync(share, drive, manifest, full, workers):
+    """
+    :return: (number copied, number deleted, number skipped, number of errors)
+    """
+    full = full or time.time() - manifest['full_scan_at'] > FULL_SCAN_INTERVAL
+    start = time.monotonic()
+    source_dirs, failed = scan_source(share, manifest['source'], full)
+    if '' in failed:
+        raise OSError("couldn't read {}".format(share))
+    drive_files = scan_drive(drive)
+    copies, deletes, skipped = plan(source_dirs, failed, drive_files)
+    log('{} scan of {} folders and drive took {:.1f}s: {} to copy, {} to delete, {} up to date'.format(
+        'full' if full else 'quick', len(source_dirs), time.monotonic() - start, len(copies), len(deletes),
+        skipped))
+
+    manifest['source'] = source_dirs
+    if full and not failed:
+        manifest['full_scan_at'] = time.time()
+    copied = manifest['copied']
+    for path in list(copied):
+        if path not in drive_files:
+            del copied[path]
+
+    errors = 0
+    deleted = 0
+    for path in deletes:
+        try:
+            os.remove(os.path.join(drive, path))
+            copied.pop(path, None)
+            deleted += 1
+        except OSError as e:
+            log("couldn't delete {}: {}".format(path, e))
+            errors += 1
+
+    def copy(item):
+        path, size, mtime = item
+        return copy_file(os.path.join(share, path), os.path.join(drive, path), mtime)
+
+    done = 0
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        for item in copies:
+            futures.append((item, executor.submit(copy, item)))
+        for (path, size, mtime), future in futures:
+            try:
+                copied[path] = [size, mtime, future.result()]
+                done += 1
+            except OSError as e:
+                log("couldn't copy {}: {}".format(path, e))
+                errors += 1
+    finally:
+        # When stopped, only wait for the copies in progress. (shutdown()
+        # only takes cancel_futures from Python 3.9 on.)
+        for _, future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+    return done, deleted, skipped, errors
+
+
+def verify(drive, manifest):
+    """
+    :return: number of files that didn't match, and were deleted
+    """
+    bad = 0
+    for path, (_, _, sha1) in list(manifest['copied'].items()):
+        digest = hashlib.sha1()
+        try:
+            with open(os.path.join(drive, path), 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        except OSError:
+            continue
+        if digest.hexdigest() != sha1:
+            log('{} is damaged, deleting it'.format(path))
+            os.remove(os.path.join(drive, path))
+            del manifest['copied'][path]
+            bad += 1
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sync_parser = subparsers.add_parser('sync')
+    sync_parser.add_argument('share')
+    sync_parser.add_argument('drive')
+    sync_parser.add_argument('--full', action='store_true', help='List every folder on the share.')
+    sync_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of files to copy at once.')
+    verify_parser = subparsers.add_parser('verify')
+    verify_parser.add_argument('drive')
+    args = parser.parse_args()
+
+    # Keep what was done so far when stopped.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    manifest = load_manifest()
+    # Most syncs find nothing new, so only write the manifest when it changed.
+    loaded = _serialize_manifest(manifest)
+    try:
+        if args.command == 'verify':
+            print('{} damaged file(s) deleted'.format(verify(args.drive, manifest)))
+            return 0
+        print('{} {} {} {}'.format(*sync(args.share, args.drive, manifest, args.full, max(1, args.workers))))
+        return 0
+    except OSError as e:
+        log('music sync failed: {}'.format(e))
+        return 1
+    finally:
+        if _serialize_manifest(manifest) != loaded:
+            save_manifest(manifest)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
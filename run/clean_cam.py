@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Makes room on the cam drive by deleting recordings, oldest first, until
+there is enough free space, then deletes the folders that are left empty.
+
+Usage: clean_cam.py <mountpoint> [--target 20000000000]
+
+The files to delete are worked out up front from a single scan, rather than
+by checking the free space after deleting each one.
+"""
+import argparse
+import os
+import sys
+
+DEFAULT_TARGET = 20000000000
+CLIP_DIRS = ('TeslaCam', 'TeslaTrackMode')
+# Empty folders in these are removed.
+PRUNE_DIRS = ('TeslaCam/RecentClips', 'TeslaCam/SavedClips', 'TeslaCam/SentryClips', 'TeslaTrackMode')
+
+
+def free_space(mountpoint):
+    fs = os.statvfs(mountpoint)
+    return fs.f_bfree * fs.f_frsize
+
+
+def scan(mountpoint):
+    """
+    :return: (list of (ctime, space used, path) of all recordings, oldest
+              first, list of all folders)
+    """
+    files = []
+    dirs = []
+    for top in CLIP_DIRS:
+        for directory, _, filenames in os.walk(os.path.join(mountpoint, top)):
+            dirs.append(directory)
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                files.append((st.st_ctime, st.st_blocks * 512, path))
+    files.sort()
+    return files, dirs
+
+
+def plan(files, needed):
+    """
+    :param files: (ctime, space used, path) tuples, oldest first
+    :param needed: number of bytes to free up
+    :return: the number of oldest files to delete to free up that much
+    """
+    freed = 0
+    for count, (_, size, _) in enumerate(files):
+        if freed >= needed:
+            return count
+        freed += size
+    return len(files)
+
+
+def prune_empty_dirs(mountpoint, dirs):
+    prune = tuple(os.path.join(mountpoint, top) for top in PRUNE_DIRS)
+    removed = 0
+    # Deepest first, so that folders that only contain empty folders go too.
+    for directory in sorted(dirs, key=lambda d: d.count('/'), reverse=True):
+        if not any(directory == top or directory.startswith(top + '/') for top in prune):
+            continue
+        try:
+            os.rmdir(directory)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def clean(mountpoint, target):
+    """
+    :return: (number of files deleted, bytes freed, number of folders removed)
+    """
+    free_before = free_space(mountpoint)
+    files, dirs = scan(mountpoint)
+    count = plan(files, target - free_before) if free_before <= target else 0
+
+    deleted = 0
+    for _, _, path in files[:count]:
+        try:
+            os.remove(path)
+            deleted += 1
+        except OSError as e:
+            print('failed to delete {}: {}'.format(path, e), file=sys.stderr)
+
+    # The space a file takes up is only an estimate, so make sure the target
+    # was actually reached, and keep going one file at a time if it wasn't.
+    for _, _, path in files[count:]:
+        if free_space(mountpoint) > target:
+            break
+        try:
+            os.remove(path)
+            deleted += 1
+        except OSError:
+            pass
+
+    return deleted, free_space(mountpoint) - free_before, prune_empty_dirs(mountpoint, dirs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mountpoint')
+    parser.add_argument('--target', type=int, default=DEFAULT_TARGET, help='Bytes of free space to make.')
+    args = parser.parse_args()
+
+    deleted, freed, removed = clean(args.mountpoint, args.target)
+    print('deleted {} file(s), freeing {} bytes, and {} empty folder(s)'.format(deleted, freed, removed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
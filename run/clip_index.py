@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Maintains an index of the clips linked from /mutable/TeslaCam, for the web
+UI's clip list (cgi-bin/cliplist.py). snapshot_linker.py updates it as it
+adds, moves and removes links, so the web UI doesn't have to look at every
+link to show the list.
+
+Usage:
+  clip_index.py rebuild
+      Rebuild the index from the links in /mutable/TeslaCam.
+"""
+import os
+import re
+import sqlite3
+import sys
+
+LINK_DIR = '/mutable/TeslaCam'
+INDEX_FILE = '/mutable/clip_index.db'
+
+# cgi-bin/cliplist.py reads this, so keep the two in sync.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clips (
+    path TEXT PRIMARY KEY,
+    grp TEXT NOT NULL,
+    sequence TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    camera TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    snapshot TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS clips_by_time ON clips (grp, timestamp);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+'''
+
+# e.g. 2022-01-06_10-27-31-left_repeater.mp4
+CLIP_NAME = re.compile(r'^(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})-(\w+)\.')
+# e.g. 2021-12-24_20-38-38
+EVENT_NAME = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$')
+SNAPSHOT_NAME = re.compile(r'/(snap-\d+)/')
+
+
+def _row(path, target):
+    """
+    :param path: link path, relative to LINK_DIR
+    :param target: where the link points
+    :return: the index row for the link
+    """
+    parts = path.split('/')
+    group = parts[0]
+    sequence = parts[1] if len(parts) > 2 else ''
+    filename = parts[-1]
+    camera = ''
+    timestamp = ''
+    match = CLIP_NAME.match(filename)
+    if match:
+        timestamp, camera = match.groups()
+    elif EVENT_NAME.match(sequence):
+        timestamp = sequence
+    match = SNAPSHOT_NAME.search(target)
+    snapshot = match.group(1) if match else ''
+    return path, group, sequence, filename, camera, timestamp, snapshot
+
+
+def _bump_generation(db):
+    # Tells the web UI (through the ETag) that the list changed.
+    db.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+    db.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+
+def open_index(path=INDEX_FILE):
+    """
+    Open the index, building it from scratch if it doesn't exist yet.
+    :return: an sqlite3 connection
+    """
+    exists = os.path.exists(path)
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.executescript(SCHEMA)
+    # Identifies this copy of the index, since the generation starts over
+    # when it's deleted and built again.
+    with db:
+        db.execute("INSERT OR IGNORE INTO meta VALUES ('created', ?)",
+                   (int.from_bytes(os.urandom(7), 'big'),))
+    if not exists:
+        rebuild(db)
+    return db
+
+
+def rebuild(db):
+    rows = []
+    for directory, _, files in os.walk(LINK_DIR):
+        for filename in files:
+            link = os.path.join(directory, filename)
+            try:
+                target = os.readlink(link)
+            except OSError:
+                continue
+            rows.append(_row(os.path.relpath(link, LINK_DIR), target))
+    with db:
+        db.execute('DELETE FROM clips')
+        db.executemany('INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        _bump_generation(db)
+    return len(rows)
+
+
+def update(db, added=(), removed=()):
+    """
+    Update the index in a single transaction.
+    :param added: (link path, target) tuples of links that were made or changed
+    :param removed: link paths of links that were deleted
+    """
+    with db:
+        db.executemany('INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       [_row(os.path.relpath(link, LINK_DIR), target) for link, target in added])
+        db.executemany('DELETE FROM clips WHERE path = ?',
+                       [(os.path.relpath(link, LINK_DIR),) for link in removed])
+        _bump_generation(db)
+
+
+def main():
+    if sys.argv[1:] != ['rebuild']:
+        print(__doc__, file=sys.stderr)
+        return 2
+    db = open_index()
+    try:
+        print('indexed {} links'.format(rebuild(db)))
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
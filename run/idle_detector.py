@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Figures out when the car isn't writing to the drive, so snapshots can be
+taken in between writes.
+
+The car writes in bursts, at a fairly regular interval. The detector watches
+how much the mass storage gadget (the file-storage kernel thread) has
+written, several times a second, learns how long the bursts are and how far
+apart they start, and from that predicts when the next one will start.
+
+Usage:
+  idle_detector.py monitor
+      Keep watching, and write the current prediction to /tmp/idle_window.json.
+  idle_detector.py window
+      Print the current prediction.
+  idle_detector.py wait [--max-wait 90] [--need 3]
+      Wait until the drive is idle, and is predicted to stay idle for at
+      least --need seconds. Without a running monitor, it watches the writes
+      itself. Exits with 1 if no idle window was found within --max-wait
+      seconds.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+from teslausb_common import log, write_atomically
+
+WINDOW_FILE = '/tmp/idle_window.json'
+
+SAMPLE_INTERVAL = 0.25
+# Writes slower than this don't count as the car writing.
+ACTIVE_BYTES_PER_SECOND = 500000
+# Pauses shorter than this don't end a burst.
+BURST_GAP = 1.0
+# Without a learned cadence, the drive counts as idle after this long
+# without writes.
+IDLE_WITHOUT_CADENCE = 5.0
+# Number of recent bursts the cadence is learned from.
+HISTORY = 12
+# Keep this much distance from the predicted start of the next burst.
+GUARD = 1.0
+
+
+def find_mass_storage_pid():
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/comm'.format(pid), 'r') as f:
+                if f.read().strip() == 'file-storage':
+                    return int(pid)
+        except OSError:
+            pass
+    return None
+
+
+def read_write_bytes(pid):
+    with open('/proc/{}/io'.format(pid), 'r') as f:
+        for line in f:
+            if line.startswith('write_bytes:'):
+                return int(line.split()[1])
+    raise OSError('no write_bytes for {}'.format(pid))
+
+
+class Detector:
+    """
+    Turns a series of write counter samples into bursts, and bursts into a
+    prediction of the next idle window.
+    """
+    def __init__(self):
+        self.previous = None
+        self.first_sample = None
+        self.last_write = None
+        self.burst_start = None
+        # (start, end) of recent bursts, oldest first
+        self.bursts = []
+
+    def sample(self, now, written):
+        if self.first_sample is None:
+            self.first_sample = now
+        if self.previous is not None:
+            prev_time, prev_written = self.previous
+            rate = (written - prev_written) / max(now - prev_time, 0.001)
+            if rate > ACTIVE_BYTES_PER_SECOND:
+                if self.burst_start is None:
+                    self.burst_start = now
+                self.last_write = now
+            elif self.burst_start is not None and now - self.last_write >= BURST_GAP:
+                self.bursts.append((self.burst_start, self.last_write))
+                self.bursts = self.bursts[-HISTORY:]
+                self.burst_start = None
+        self.previous = (now, written)
+
+    def cadence(self):
+        """
+        :return: (median time between burst starts, median burst duration),
+                 or None if the bursts aren't regular enough to go by
+        """
+        if len(self.bursts) < 3:
+            return None
+        starts = [start for start, _ in self.bursts]
+        intervals = [b - a for a, b in zip(starts, starts[1:])]
+        period = statistics.median(intervals)
+        deviation = statistics.median(abs(interval - period) for interval in intervals)
+        if period <= 0 or deviation > period / 4:
+            return None
+        return period, statistics.median(end - start for start, end in self.bursts)
+
+    def window(self, now):
+        """
+        :return: dict describing the current state and the predicted idle
+                 window, with times in seconds since the epoch
+        """
+        writing = self.burst_start is not None
+        # If there haven't been any writes yet, the drive has been idle for
+        # at least as long as it's been watched.
+        idle_since = None if writing else (self.last_write or self.first_sample)
+        result = {
+            'updated': now,
+            'writing': writing,
+            'idle_since': idle_since,
+            'period': None,
+            'burst_duration': None,
+            'idle_from': None,
+            'idle_until': None,
+        }
+        cadence = self.cadence()
+        if cadence:
+            period, duration = cadence
+            result['period'] = round(period, 2)
+            result['burst_duration'] = round(duration, 2)
+            last_start = self.burst_start if writing else self.bursts[-1][0]
+            next_start = last_start + period
+            while next_start < now:
+                next_start += period
+            result['idle_from'] = max(now, last_start + duration + GUARD) if writing else now
+            result['idle_until'] = next_start - GUARD
+        elif idle_since is not None:
+            result['idle_from'] = max(now, idle_since + IDLE_WITHOUT_CADENCE)
+        return result
+
+
+def _write_window(window):
+    write_atomically(WINDOW_FILE, json.dumps(window))
+
+
+def _read_window():
+    try:
+        with open(WINDOW_FILE, 'r') as f:
+            window = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Only trust it if the monitor is still updating it.
+    return window if time.time() - window.get('updated', 0) < 3 else None
+
+
+def monitor():
+    detector = Detector()
+    pid = None
+    last_published = 0
+    last_search = 0
+    while True:
+        now = time.time()
+        # Looking for the process means reading every process's name, so
+        # while the drives aren't active, don't do that too often.
+        if pid is None and now - last_search >= 5:
+            pid = find_mass_storage_pid()
+            last_search = now
+            detector = Detector()
+        try:
+            if pid:
+                detector.sample(now, read_write_bytes(pid))
+        except OSError:
+            # The gadget was stopped, or restarted with a new thread.
+            pid = None
+        if now - last_published >= 1:
+            window = detector.window(now) if pid else {'updated': now, 'writing': False, 'active': False}
+            _write_window(window)
+            last_published = now
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def _is_idle(window, now, need):
+    if window.get('active') is False:
+        return True
+    if window['writing'] or window['idle_from'] is None or window['idle_from'] > now:
+        return False
+    return window['idle_until'] is None or window['idle_until'] - now >= need
+
+
+def _next_check(window, now):
+    # Sleep until the predicted start of the idle window, rather than
+    # checking over and over while the car is writing.
+    if window.get('idle_from') and window['idle_from'] > now:
+        return window['idle_from'] - now
+    if window.get('idle_until') and window['idle_until'] < now + 1:
+        return window['idle_until'] + GUARD - now
+    return SAMPLE_INTERVAL
+
+
+def wait(max_wait, need):
+    deadline = time.time() + max_wait
+    detector = None
+    pid = None
+    while time.time() < deadline:
+        now = time.time()
+        window = _read_window()
+        if window is None:
+            # No monitor running, so watch the writes here.
+            if detector is None:
+                pid = find_mass_storage_pid()
+                if not pid:
+                    log('mass storage process not active, OK to write')
+                    return 0
+                detector = Detector()
+                log('waiting up to {:.0f} seconds for idle interval'.format(max_wait))
+            try:
+                detector.sample(now, read_write_bytes(pid))
+            except OSError:
+                log('mass storage process not active, OK to write')
+                return 0
+            window = detector.window(now)
+
+        if _is_idle(window, now, need):
+            if window.get('active') is False:
+                log('mass storage process not active, OK to write')
+            elif window['idle_until']:
+                log('idle for the next {:.1f} seconds'.format(window['idle_until'] - now))
+            else:
+                log('no writes seen in the last {:.0f} seconds'.format(IDLE_WITHOUT_CADENCE))
+            return 0
+        delay = _next_check(window, now) if detector is None else SAMPLE_INTERVAL
+        time.sleep(max(SAMPLE_INTERVAL, min(delay, deadline - time.time())))
+
+    log("couldn't determine idle interval")
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('monitor')
+    subparsers.add_parser('window')
+    wait_parser = subparsers.add_parser('wait')
+    wait_parser.add_argument('--max-wait', type=float, default=90, help='Seconds to wait at most.')
+    wait_parser.add_argument('--need', type=float, default=3, help='Seconds of idle time needed.')
+    args = parser.parse_args()
+
+    if args.command == 'monitor':
+        monitor()
+    elif args.command == 'window':
+        window = _read_window()
+        if window is None:
+            print('no idle monitor running', file=sys.stderr)
+            return 1
+        print(json.dumps(window, indent=2))
+    else:
+        return wait(args.max_wait, args.need)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,82 +22,16 @@ then
   fi
 fi
 
-function linksnapshotfiletorecents {
-  local file=$1
-  local curmnt=$2
-  local finalmnt=$3
-  local recents=/mutable/TeslaCam/RecentClips
-
-  filename=${file##/*/}
-  filedate=${filename:0:10}
-  if [ ! -d "$recents/$filedate" ]
-  then
-    mkdir -p "$recents/$filedate"
-  fi
-  ln -sf "${file/"$curmnt"/$finalmnt}" "$recents/$filedate"
-}
-
 function make_links_for_snapshot {
-  local saved=/mutable/TeslaCam/SavedClips
-  local sentry=/mutable/TeslaCam/SentryClips
-  local track=/mutable/TeslaCam/TeslaTrackMode
-  if [ ! -d $saved ]
-  then
-    mkdir -p $saved
-  fi
-  if [ ! -d $sentry ]
-  then
-    mkdir -p $sentry
-  fi
   local curmnt="$1"
   local finalmnt="$2"
+  local toc="$3"
+  local previoustoc="$4"
   log "making links for $curmnt, retargeted to $finalmnt"
-  local restore_nullglob
-  restore_nullglob=$(shopt -p nullglob)
-  shopt -s nullglob
-  for f in "$curmnt/TeslaCam/RecentClips/"*
-  do
-    #log "linking $f"
-    linksnapshotfiletorecents "$f" "$curmnt" "$finalmnt"
-  done
-  # also link in any files that were moved to SavedClips
-  for f in "$curmnt/TeslaCam/SavedClips"/*/*
-  do
-    #log "linking $f"
-    linksnapshotfiletorecents "$f" "$curmnt" "$finalmnt"
-    # also link it into a SavedClips folder
-    local eventfolder=${f%/*}
-    local eventtime=${eventfolder##/*/}
-    if [ ! -d "$saved/$eventtime" ]
-    then
-      mkdir -p "$saved/$eventtime"
-    fi
-    ln -sf "${f/$curmnt/$finalmnt}" "$saved/$eventtime"
-  done
-  # and the same for SentryClips
-  for f in "$curmnt/TeslaCam/SentryClips/"*/*
-  do
-    #log "linking $f"
-    linksnapshotfiletorecents "$f" "$curmnt" "$finalmnt"
-    local eventfolder=${f%/*}
-    local eventtime=${eventfolder##/*/}
-    if [ ! -d "$sentry/$eventtime" ]
-    then
-      mkdir -p "$sentry/$eventtime"
-    fi
-    ln -sf "${f/$curmnt/$finalmnt}" "$sentry/$eventtime"
-  done
-  # and finally the TrackMode files
-  for f in "$curmnt/TeslaTrackMode/"*
-  do
-    if [ ! -d "$track" ]
-    then
-      mkdir -p "$track"
-    fi
-    ln -sf "$f" "$track"
-  done
-  log "made all links for $curmnt"
-  $restore_nullglob
+  # Only the files that are new or changed since the previous snapshot are
+  # linked. Links to the others keep pointing to earlier snapshots, and
+  # release_snapshot.sh moves them to newer ones as needed.
+  log "$(/root/bin/snapshot_linker.py link "$curmnt" "$finalmnt" "$toc" "$previoustoc")"
 }
 
 function dehumanize () {
@@ -105,17 +39,34 @@ function dehumanize () {
 }
 
 function manage_free_space {
-  # Try to make free space equal to 10 GB plus three percent of the total
-  # available space. This should be enough to hold the next hour of
-  # recordings without completely filling up the filesystem.
-  # todo: this could be put in a background task and with a lower free
-  # space requirement, to delete old snapshots just before running out
-  # of space and thus make better use of space
+  # snapshot_planner.py works out how much free space to keep from how fast
+  # the car has recently been writing, and which snapshots to delete to get
+  # there, based on how much space each one actually pins and how many
+  # unarchived clips it holds.
+  local plan
   local reserve
-  reserve=$(dehumanize "10G")
-  local threepctoftotalspace
-  threepctoftotalspace=$(eval "$(stat --file-system --format="echo \$((%b*%S/33))" /backingfiles/cam_disk.bin)")
-  reserve=$((reserve+threepctoftotalspace))
+  if plan=$(/root/bin/snapshot_planner.py plan 2>> "${LOG_FILE:-/dev/null}")
+  then
+    reserve=$(head -n 1 <<< "$plan")
+    local snap
+    while read -r snap
+    do
+      log "low space, deleting $snap"
+      /root/bin/release_snapshot.sh "$snap"
+      rm -rf "$snap"
+    done < <(tail -n +2 <<< "$plan")
+  else
+    # Without the block maps, keep 10 GB plus three percent of the total
+    # available space. This should be enough to hold the next hour of
+    # recordings without completely filling up the filesystem.
+    reserve=$(dehumanize "10G")
+    local threepctoftotalspace
+    threepctoftotalspace=$(eval "$(stat --file-system --format="echo \$((%b*%S/33))" /backingfiles/cam_disk.bin)")
+    reserve=$((reserve+threepctoftotalspace))
+  fi
+
+  # If the plan didn't free enough, or there was no plan, delete the oldest
+  # snapshots until there is enough free space.
   while true
   do
     local freespace
@@ -174,7 +125,14 @@ function snapshot {
   newsnapmnt=/tmp/snapshots/snap-$(printf "%06d" $newnum)
 
   local newsnapname=$newsnapdir/snap.bin
+  # If the idle monitor is running, it knows when the car will next write
+  # to the drive, so take the snapshot in between writes.
+  if [ -e /tmp/idle_window.json ]
+  then
+    /root/bin/idle_detector.py wait --max-wait 15 2>> "${LOG_FILE:-/dev/null}" || true
+  fi
   log "taking snapshot of cam disk in $newsnapdir"
+  local -r start_ns=$(date +%s%N)
   /root/bin/mount_snapshot.sh /backingfiles/cam_disk.bin "$newsnapname" "$newsnapmnt"
   while ! systemctl --quiet is-active autofs
   do
@@ -186,15 +144,24 @@ function snapshot {
   # check whether this snapshot is actually different from the previous one
   find "$newsnapmnt" -type f -printf '%s %P\n' > "${newsnapname}.toc_"
   log "comparing new snapshot with $oldname"
+  local duration_ms
   if [[ ! -e "${oldname}.toc" ]] || diff "${oldname}.toc" "${newsnapname}.toc_" | grep -qe '^>'
   then
     ln -s "$newsnapmnt" "$newsnapdir/mnt"
-    make_links_for_snapshot "$newsnapmnt" "$newsnapdir/mnt"
+    make_links_for_snapshot "$newsnapmnt" "$newsnapdir/mnt" "${newsnapname}.toc_" "${oldname}.toc"
     mv "${newsnapname}.toc_" "${newsnapname}.toc"
+    duration_ms=$((($(date +%s%N) - start_ns) / 1000000))
+    local -r duration=$(printf "%d.%03d" $((duration_ms / 1000)) $((duration_ms % 1000)))
+    /root/bin/teslausb_metrics.py add snapshots_taken=1 snapshot_seconds="$duration" || true
+    /root/bin/teslausb_metrics.py set last_snapshot_seconds="$duration" || true
+    # telemetry() is only there when run from archiveloop
+    telemetry snapshot snapshot="${newsnapdir##*/}" seconds="$duration" kept=1 || true
   else
     log "new snapshot is identical to previous one, discarding"
     /root/bin/release_snapshot.sh "$newsnapdir"
     rm -rf "$newsnapdir"
+    duration_ms=$((($(date +%s%N) - start_ns) / 1000000))
+    telemetry snapshot seconds="$(printf "%d.%03d" $((duration_ms / 1000)) $((duration_ms % 1000)))" kept=0 || true
   fi
 }
 
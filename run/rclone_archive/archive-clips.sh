@@ -1,6 +1,14 @@
 #!/bin/bash -eu
 
+# archive_scheduler.py runs ARCHIVE_WORKERS of these at once, so each moves
+# one file at a time, unless RCLONE_FLAGS has a --transfers of its own, which
+# overrides this one since it comes later.
 flags=("-L" "--transfers=1")
+# set by archive_scheduler.py, in KiB/s
+if [ -n "${ARCHIVE_BWLIMIT:-}" ]
+then
+  flags+=("--bwlimit=${ARCHIVE_BWLIMIT}k")
+fi
 if [[ -v RCLONE_FLAGS ]]
 then
   flags+=("${RCLONE_FLAGS[@]}")
@@ -7,8 +7,15 @@ umount "$IMAGE" || true
 # delete the snapshot folders
 rm -rf "/backingfiles/snapshots/$NAME"
 
-# delete all obsolete links
-find /mutable/TeslaCam/ -lname "*${NAME}*" -delete || true
+# point links to files that are also in other snapshots there, and delete
+# all obsolete links
+if ! /root/bin/snapshot_linker.py release "$NAME" > /dev/null
+then
+  # at least delete the links into this snapshot, and rebuild the clip index
+  # to match (or drop it, so that it's rebuilt when next used)
+  find /mutable/TeslaCam/ -lname "*${NAME}*" -delete || true
+  /root/bin/clip_index.py rebuild > /dev/null || rm -f /mutable/clip_index.db
+fi
 
 # delete all Sentry, saved and recent folders that are now empty
 find /mutable/TeslaCam/ -mindepth 2 -depth -type d -empty -exec rmdir "{}" \; || true
@@ -1,9 +1,27 @@
 #!/bin/bash -eu
 
+flags=()
+# set by archive_scheduler.py, in KiB/s
+if [ -n "${ARCHIVE_BWLIMIT:-}" ]
+then
+  flags+=("--bwlimit=$ARCHIVE_BWLIMIT")
+fi
+
+# archive_scheduler.py runs several of these at once, so each gets its own
+# log files.
+rm -f /tmp/archive-rsync-cmd.$$.log
+
 while [ -n "${1+x}" ]
 do
-  rsync -avhRL --timeout=60 --remove-source-files --no-perms --omit-dir-times --stats \
-        --log-file=/tmp/archive-rsync-cmd.log --ignore-missing-args \
-        --files-from="$2" "$1" "$RSYNC_USER@$RSYNC_SERVER:$RSYNC_PATH" &> /tmp/rsynclog || [[ "$?" = "24" ]]
+  if ! (rsync -avhRL --timeout=60 --remove-source-files --no-perms --omit-dir-times --stats \
+        --log-file=/tmp/archive-rsync-cmd.$$.log --ignore-missing-args "${flags[@]}" \
+        --files-from="$2" "$1" "$RSYNC_USER@$RSYNC_SERVER:$RSYNC_PATH" &> /tmp/rsynclog.$$ || [[ "$?" = "24" ]] )
+  then
+    cat /tmp/archive-rsync-cmd.$$.log /tmp/rsynclog.$$ >> /tmp/archive-error.log
+    rm -f /tmp/archive-rsync-cmd.$$.log /tmp/rsynclog.$$
+    exit 1
+  fi
   shift 2
 done
+
+rm -f /tmp/archive-rsync-cmd.$$.log /tmp/rsynclog.$$
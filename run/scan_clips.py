@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Helpers for archiveloop that look at the clips to be archived.
+
+Usage:
+  scan_clips.py filter <dir> <list> <ignorelist>
+      Remove short recordings (mp4 files under 100 kB) from <list>, and
+      write them to <ignorelist>. The paths in <list> are relative to <dir>,
+      and are generally symlinks into snapshots.
+  scan_clips.py count <list> <ignorelist>
+      Print the number of non-track mode files, track mode files, ignored
+      files, SavedClips event folders and SentryClips event folders.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from teslausb_common import read_lines, write_atomically
+
+MIN_CLIP_SIZE = 100000
+
+# The stat calls block on the automounter the first time a snapshot is
+# accessed, and on the SD card after that, so a few run at once.
+STAT_THREADS = 4
+
+
+def _snapshot_of(directory, path):
+    """
+    Figure out which snapshot a clip is in from its link target, without
+    following the link (which would mount the snapshot).
+    """
+    try:
+        target = os.readlink(os.path.join(directory, path))
+    except OSError:
+        return ''
+    for top in ('/TeslaCam/', '/TeslaTrackMode/'):
+        if top in target:
+            return target.split(top, 1)[0]
+    return os.path.dirname(target)
+
+
+def _is_short(directory, path):
+    if not path.endswith('.mp4'):
+        return False
+    try:
+        return os.stat(os.path.join(directory, path)).st_size < MIN_CLIP_SIZE
+    except OSError:
+        # Like find -L, treat a dangling link as the (short) link itself.
+        return True
+
+
+def find_short_clips(directory, paths):
+    """
+    Find the short recordings among the given clips. The clips are grouped
+    by snapshot, so each snapshot is mounted once, and the clips in each
+    snapshot are checked in parallel.
+    :param directory: the directory the paths are relative to
+    :param paths: list of clips
+    :return: set of the paths that are short recordings
+    """
+    by_snapshot = {}
+    for path in paths:
+        if path.endswith('.mp4'):
+            by_snapshot.setdefault(_snapshot_of(directory, path), []).append(path)
+
+    short = set()
+    with ThreadPoolExecutor(max_workers=STAT_THREADS) as executor:
+        for snapshot in sorted(by_snapshot):
+            group = by_snapshot[snapshot]
+            for path, is_short in zip(group, executor.map(lambda p: _is_short(directory, p), group)):
+                if is_short:
+                    short.add(path)
+    return short
+
+
+def filter_short_clips(directory, list_file, ignore_file):
+    paths = list(read_lines(list_file))
+    short = find_short_clips(directory, paths)
+    write_atomically(list_file, ''.join(path + '\n' for path in paths if path not in short))
+    write_atomically(ignore_file, ''.join(path + '\n' for path in sorted(short)))
+
+
+def count_clips(list_file, ignore_file):
+    """
+    :return: (non-track mode files, track mode files, ignored files,
+              SavedClips event folders, SentryClips event folders)
+    """
+    sentry = 0
+    trackmode = 0
+    saved_events = set()
+    sentry_events = set()
+    for path in read_lines(list_file):
+        if 'TeslaTrackMode' in path:
+            trackmode += 1
+        else:
+            sentry += 1
+        if 'SavedClips/' in path:
+            saved_events.add(os.path.dirname(path))
+        if 'SentryClips/' in path:
+            sentry_events.add(os.path.dirname(path))
+    ignored = sum(1 for _ in read_lines(ignore_file)) if os.path.exists(ignore_file) else 0
+    return sentry, trackmode, ignored, len(saved_events), len(sentry_events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    filter_parser = subparsers.add_parser('filter')
+    filter_parser.add_argument('directory')
+    filter_parser.add_argument('list')
+    filter_parser.add_argument('ignorelist')
+    count_parser = subparsers.add_parser('count')
+    count_parser.add_argument('list')
+    count_parser.add_argument('ignorelist')
+    args = parser.parse_args()
+
+    if args.command == 'filter':
+        filter_short_clips(args.directory, args.list, args.ignorelist)
+    else:
+        print(' '.join(str(count) for count in count_clips(args.list, args.ignorelist)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,35 +1,77 @@
 #!/usr/bin/env python3
 import sys
-import time
 import asyncio
+import json
+import os
 import socket
 
-from nio import AsyncClient, LoginResponse
+from nio import AsyncClient, LoginResponse, RoomSendError
 
-if len(sys.argv) != 6:
-    sys.stderr.write('usage: %s HOMESERVER_URL USERNAME PASSWORD ROOM_ID MESSAGE_TEXT\n' % sys.argv[0])
-    sys.exit(1)
+# The access token and device ID of the last login are kept here, so that
+# messages can be sent without logging in (and registering a new device)
+# every time.
+SESSION_FILE = '/mutable/matrix_session.json'
 
-(homeserver, username, password, room_id, message) = sys.argv[1:6]
 
-if homeserver.endswith('/'):
-    homeserver = homeserver[:-1]
+def _normalize(homeserver, username):
+    if homeserver.endswith('/'):
+        homeserver = homeserver[:-1]
 
-if username.startswith('@'):
-    username = username[1:]
+    if username.startswith('@'):
+        username = username[1:]
 
-if username.find(':') > 0:
-    username = username.split(':')[0]
+    if username.find(':') > 0:
+        username = username.split(':')[0]
 
-async def main() -> None:
-    client = AsyncClient(homeserver, username)
+    return homeserver, username
+
+
+def _load_session(homeserver, username):
+    try:
+        with open(SESSION_FILE, 'r') as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Only use it if it's for the currently configured account.
+    if session.get('homeserver') != homeserver or session.get('username') != username:
+        return None
+    return session
+
+
+def _save_session(homeserver, username, response):
+    session = {
+        'homeserver': homeserver,
+        'username': username,
+        'user_id': response.user_id,
+        'device_id': response.device_id,
+        'access_token': response.access_token,
+    }
+    try:
+        # The file holds a credential, so keep it private, and replace it
+        # atomically so a power loss can't leave a truncated file behind.
+        fd = os.open(SESSION_FILE + '.new', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session, f)
+        os.replace(SESSION_FILE + '.new', SESSION_FILE)
+    except OSError as e:
+        sys.stderr.write('Could not save Matrix session: {}\n'.format(e))
+
+
+async def _login(client, homeserver, username, password) -> bool:
+    # If the client has a device ID from a previous session, login() reuses
+    # it instead of registering a new device.
     response = await client.login(password, device_name=socket.gethostname())
 
     if not isinstance(response, LoginResponse):
         sys.stderr.write('Failed to connect to Matrix server.\n')
-        sys.exit(1)
+        return False
+
+    _save_session(homeserver, username, response)
+    return True
 
-    await client.room_send(
+
+async def _room_send(client, room_id, message):
+    return await client.room_send(
         room_id=room_id,
         message_type="m.room.message",
         content = {
@@ -37,7 +79,57 @@ async def main() -> None:
             "body": message
         }
     )
-    await client.sync(timeout=30000)
-    sys.exit(0)
 
-asyncio.get_event_loop().run_until_complete(main())
+
+async def _send(homeserver, username, password, room_id, message, sync) -> bool:
+    client = AsyncClient(homeserver, username)
+    try:
+        session = _load_session(homeserver, username)
+        if session:
+            client.restore_login(session['user_id'], session['device_id'], session['access_token'])
+        elif not await _login(client, homeserver, username, password):
+            return False
+
+        response = await _room_send(client, room_id, message)
+
+        # Log in again only if the server rejected the saved token.
+        if (session and isinstance(response, RoomSendError)
+                and response.status_code in ('M_UNKNOWN_TOKEN', 'M_MISSING_TOKEN')):
+            if not await _login(client, homeserver, username, password):
+                return False
+            response = await _room_send(client, room_id, message)
+
+        if isinstance(response, RoomSendError):
+            sys.stderr.write('Failed to send Matrix message: {}\n'.format(response.message))
+            return False
+
+        if sync:
+            await client.sync(timeout=30000)
+        return True
+    finally:
+        await client.close()
+
+
+def send_matrix(homeserver, username, password, room_id, message, sync=False) -> bool:
+    """
+    Send a text message to a Matrix room. Can be called from other scripts,
+    e.g. send_notifications.py, as well as from the command line.
+    :param sync: also wait for a sync with the server after sending, which
+                 isn't needed for the message to be delivered
+    :return: True if the message was sent
+    """
+    homeserver, username = _normalize(homeserver, username)
+    return asyncio.run(_send(homeserver, username, password, room_id, message, sync))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sync = '--sync' in args
+    if sync:
+        args.remove('--sync')
+
+    if len(args) != 5:
+        sys.stderr.write('usage: %s [--sync] HOMESERVER_URL USERNAME PASSWORD ROOM_ID MESSAGE_TEXT\n' % sys.argv[0])
+        sys.exit(1)
+
+    sys.exit(0 if send_matrix(*args, sync=sync) else 1)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Sends a notification to all enabled providers at once.
+
+The providers and their settings are taken from the same environment
+variables that send-push-message uses (PUSHOVER_ENABLED, PUSHOVER_USER_KEY,
+etc). HTTP based providers share one pooled requests session, and SNS and
+Matrix are sent from this process rather than from separate scripts.
+A line with the outcome for each provider is printed.
+
+With --queue, the message is instead written to a persistent outbox in
+/mutable and delivered by the long-lived sender started with --sender, which
+retries until every provider has it. If no sender is running, --queue
+delivers the outbox itself before exiting. A provider that rejects a message
+(an HTTP 4xx other than 408 and 429, or its Python package is missing) isn't
+sent it again, and messages are given up on after MAX_ATTEMPTS attempts or
+once they're MAX_AGE seconds old.
+
+Exit codes: 0 if all providers succeeded, 1 if any failed or timed out, 3 if
+a required Python package is missing, and 4 if the message was queued. For
+anything other than 4, send-push-message sends the message itself.
+"""
+import argparse
+import fcntl
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+from teslausb_common import write_atomically
+
+# Seconds each provider gets to deliver the message. All providers are sent
+# to in parallel, so this is also about how long sending can take overall.
+DEFAULT_TIMEOUT = 20
+
+EXIT_MISSING_PACKAGE = 3
+EXIT_QUEUED = 4
+
+OUTBOX_DIR = '/mutable/notification_outbox'
+# How often the sender looks for new messages, and the longest it waits
+# between attempts while messages can't be delivered.
+POLL_INTERVAL = 2
+MAX_RETRY_DELAY = 300
+# Give up on a message after this many attempts, or once it's this old.
+MAX_ATTEMPTS = 100
+MAX_AGE = 2 * 24 * 3600
+
+# The SNS client is slow to create, so it's created once and reused.
+sns_client = None
+sns_client_lock = threading.Lock()
+
+
+def _env(name, default=''):
+    return os.environ.get(name, default)
+
+
+class RejectedError(Exception):
+    """
+    The provider refused the message, and sending it again won't help.
+    """
+
+
+def _check_response(response):
+    if 200 <= response.status_code < 300:
+        return
+    error = 'HTTP {}: {}'.format(response.status_code, response.text[:200])
+    # 408 and 429 mean "not now", other 4xx that the request itself is bad,
+    # e.g. because of a wrong key or URL.
+    if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+        raise RejectedError(error)
+    raise RuntimeError(error)
+
+
+######################################
+# Providers
+######################################
+def send_pushover(session, title, message, timeout):
+    _check_response(session.post(
+        'https://api.pushover.net/1/messages',
+        data={
+            'token': _env('PUSHOVER_APP_KEY'),
+            'user': _env('PUSHOVER_USER_KEY'),
+            'title': title,
+            'message': message,
+        },
+        timeout=timeout))
+
+
+def send_gotify(session, title, message, timeout):
+    _check_response(session.post(
+        '{}/message'.format(_env('GOTIFY_DOMAIN')),
+        params={'token': _env('GOTIFY_APP_TOKEN')},
+        data={
+            'title': title,
+            'message': message,
+            'priority': _env('GOTIFY_PRIORITY'),
+        },
+        timeout=timeout))
+
+
+def send_discord(session, title, message, timeout):
+    _check_response(session.post(
+        _env('DISCORD_WEBHOOK_URL'),
+        json={'username': 'TeslaUSB', 'content': message},
+        timeout=timeout))
+
+
+def send_ifttt(session, title, message, timeout):
+    _check_response(session.post(
+        'https://maker.ifttt.com/trigger/{}/with/key/{}'.format(_env('IFTTT_EVENT_NAME'), _env('IFTTT_KEY')),
+        json={'value1': title, 'value2': message},
+        timeout=timeout))
+
+
+def send_sns(session, title, message, timeout):
+    global sns_client
+    from send_sns import send_sns as publish
+
+    with sns_client_lock:
+        if sns_client is None:
+            import boto3
+            sns_client = boto3.client('sns')
+    publish(_env('AWS_SNS_TOPIC_ARN'), title, message, sns=sns_client)
+
+
+def send_webhook(session, title, message, timeout):
+    _check_response(session.post(
+        _env('WEBHOOK_URL'),
+        json={'value1': title, 'value2': message},
+        timeout=timeout))
+
+
+def send_telegram(session, title, message, timeout):
+    _check_response(session.post(
+        'https://api.telegram.org/{}/sendMessage'.format(_env('TELEGRAM_BOT_TOKEN')),
+        json={
+            'chat_id': _env('TELEGRAM_CHAT_ID'),
+            'text': '{} {}'.format(title, message),
+            'disable_notification': _env('TELEGRAM_SILENT_NOTIFY', 'false') == 'true',
+        },
+        timeout=timeout))
+
+
+def send_matrix(session, title, message, timeout):
+    from send_matrix import send_matrix as send
+
+    if not send(_env('MATRIX_SERVER_URL'), _env('MATRIX_USERNAME'), _env('MATRIX_PASSWORD'),
+                _env('MATRIX_ROOM'), message, sync=_env('MATRIX_SYNC', 'false') == 'true'):
+        raise RuntimeError('failed to send Matrix message')
+
+
+def send_slack(session, title, message, timeout):
+    payload = {'text': message, 'username': 'Tesla', 'icon_emoji': ':tesla:'}
+    _check_response(session.post(
+        _env('SLACK_WEBHOOK_URL'),
+        data={'payload': json.dumps(payload)},
+        timeout=timeout))
+
+
+# Provider name, the variable that enables it, and the function sending to it,
+# in the order send-push-message has always used.
+PROVIDERS = [
+    ('pushover', 'PUSHOVER_ENABLED', send_pushover),
+    ('gotify', 'GOTIFY_ENABLED', send_gotify),
+    ('discord', 'DISCORD_ENABLED', send_discord),
+    ('ifttt', 'IFTTT_ENABLED', send_ifttt),
+    ('sns', 'SNS_ENABLED', send_sns),
+    ('webhook', 'WEBHOOK_ENABLED', send_webhook),
+    ('telegram', 'TELEGRAM_ENABLED', send_telegram),
+    ('matrix', 'MATRIX_ENABLED', send_matrix),
+    ('slack', 'SLACK_ENABLED', send_slack),
+]
+
+
+######################################
+# Dispatcher
+######################################
+def enabled_providers():
+    return [(name, send) for name, enabled_var, send in PROVIDERS if _env(enabled_var, 'false') == 'true']
+
+
+def make_session(pool_size):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def dispatch(providers, session, title, message, timeout):
+    """
+    Send the message to all the given providers in parallel.
+    :param providers: list of (name, send function) tuples
+    :return: dict of provider name to (status, detail, seconds taken), where
+             status is 'ok', 'failed', 'rejected' (not worth trying again) or
+             'timeout'
+    """
+    results = {}
+    threads = []
+
+    def run(name, send):
+        start = time.monotonic()
+        try:
+            send(session, title, message, timeout)
+            results[name] = ('ok', '', time.monotonic() - start)
+        except (RejectedError, ImportError) as e:
+            results[name] = ('rejected', str(e) or type(e).__name__, time.monotonic() - start)
+        except Exception as e:
+            results[name] = ('failed', str(e) or type(e).__name__, time.monotonic() - start)
+
+    # Daemon threads, so that a provider that hangs past its timeout (SNS
+    # and Matrix don't take one) can't keep this process from exiting.
+    for name, send in providers:
+        thread = threading.Thread(target=run, args=(name, send), daemon=True)
+        thread.start()
+        threads.append((name, thread))
+
+    deadline = time.monotonic() + timeout
+    for name, thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+        if name not in results:
+            results[name] = ('timeout', 'no response after {} seconds'.format(timeout), timeout)
+
+    return results
+
+
+######################################
+# Outbox
+######################################
+def queue_message(outbox, title, message):
+    """
+    Write a message to the outbox, to be delivered to all currently enabled
+    providers. Each message is a separate file, named so that they sort in
+    the order they were queued.
+    """
+    os.makedirs(outbox, exist_ok=True)
+    entry = {
+        'title': title,
+        'message': message,
+        'queued_at': time.time(),
+        'providers': [name for name, _ in enabled_providers()],
+    }
+    path = os.path.join(outbox, '{:020d}-{}.json'.format(time.time_ns(), os.getpid()))
+    write_atomically(path, json.dumps(entry))
+
+
+def _read_outbox(outbox):
+    entries = []
+    for name in sorted(os.listdir(outbox)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(outbox, name)
+        try:
+            with open(path, 'r') as f:
+                entries.append((path, json.load(f)))
+        except (OSError, ValueError):
+            print('Discarding unreadable outbox entry {}'.format(name), file=sys.stderr)
+            os.remove(path)
+    return entries
+
+
+def _is_archive_start(message):
+    return message.startswith('Archiving ') and ' starting at ' in message
+
+
+def _is_archive_end(message):
+    return message.startswith(('Archiving completed', 'Error during archiving'))
+
+
+def coalesce(entries):
+    """
+    Merge each "Archiving ... starting" message with the "Archiving completed"
+    message right after it, when both are still waiting to be delivered to
+    the same providers. By then the first one is old news, so there's no
+    point in sending it separately.
+    :param entries: list of (path, entry) tuples, oldest first
+    :return: list of (paths, entry) tuples
+    """
+    result = []
+    for path, entry in entries:
+        if result:
+            prev_paths, prev = result[-1]
+            if (len(prev_paths) == 1
+                    and _is_archive_start(prev['message'])
+                    and _is_archive_end(entry['message'])
+                    and prev['title'] == entry['title']
+                    and prev['providers'] == entry['providers']):
+                merged = dict(entry, message='{}\n{}'.format(prev['message'], entry['message']))
+                result[-1] = (prev_paths + [path], merged)
+                continue
+        result.append(([path], entry))
+    return result
+
+
+def flush_outbox(outbox, session, timeout):
+    """
+    Try once to deliver everything in the outbox. Messages are removed once
+    every provider has them or rejected them, or once they've been tried
+    MAX_ATTEMPTS times or are older than MAX_AGE, and otherwise kept with the
+    list of providers that still need them.
+    :return: True if the outbox is empty afterwards
+    """
+    if not os.path.isdir(outbox):
+        return True
+    providers = dict((name, send) for name, _, send in PROVIDERS)
+    delivered_all = True
+    for paths, entry in coalesce(_read_outbox(outbox)):
+        pending = [(name, providers[name]) for name in entry['providers'] if name in providers]
+        results = dispatch(pending, session, entry['title'], entry['message'], timeout) if pending else {}
+        for name, (status, detail, seconds) in sorted(results.items()):
+            print('{}: {} ({:.1f}s){}'.format(name, status, seconds, ': ' + detail if detail else ''), flush=True)
+
+        remaining = [name for name, _ in pending if results[name][0] not in ('ok', 'rejected')]
+        rejected = [name for name, _ in pending if results[name][0] == 'rejected']
+        if rejected:
+            print('Not sending "{}" to {} again'.format(entry['message'], ', '.join(rejected)), file=sys.stderr)
+        attempts = entry.get('attempts', 0) + 1
+        if remaining and (attempts >= MAX_ATTEMPTS or time.time() - entry['queued_at'] > MAX_AGE):
+            print('Giving up on "{}" for {} after {} attempt(s)'.format(
+                entry['message'], ', '.join(remaining), attempts), file=sys.stderr)
+            remaining = []
+        if remaining:
+            delivered_all = False
+            write_atomically(paths[-1], json.dumps(dict(entry, providers=remaining, attempts=attempts)))
+            paths = paths[:-1]
+        for path in paths:
+            os.remove(path)
+    return delivered_all
+
+
+def _lock_outbox(outbox, blocking):
+    # Only one process delivers messages at a time. The long-lived sender
+    # holds this lock for as long as it runs.
+    os.makedirs(outbox, exist_ok=True)
+    lock = open(os.path.join(outbox, '.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def run_sender(outbox, timeout):
+    """
+    Deliver queued messages as they come in, until killed. While messages
+    can't be delivered, retry with increasing delays.
+    """
+    with _lock_outbox(outbox, blocking=True):
+        session = make_session(len(PROVIDERS))
+        delay = POLL_INTERVAL
+        while True:
+            try:
+                delivered_all = flush_outbox(outbox, session, timeout)
+            except OSError as e:
+                print('Error delivering queued messages: {}'.format(e), file=sys.stderr)
+                delivered_all = False
+            delay = POLL_INTERVAL if delivered_all else min(delay * 2, MAX_RETRY_DELAY)
+            time.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('title', nargs='?', help='The title of the message.')
+    parser.add_argument('message', nargs='?', help='The message to send.')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=float(_env('NOTIFICATION_TIMEOUT', DEFAULT_TIMEOUT)),
+        help='Seconds each provider gets to deliver the message.'
+    )
+    parser.add_argument(
+        '--queue',
+        action='store_true',
+        help='Put the message in the outbox instead of sending it right away.'
+    )
+    parser.add_argument(
+        '--sender',
+        action='store_true',
+        help='Keep running and deliver messages from the outbox.'
+    )
+    args = parser.parse_args()
+    outbox = _env('NOTIFICATION_OUTBOX', OUTBOX_DIR)
+
+    if args.sender:
+        try:
+            run_sender(outbox, args.timeout)
+        except ImportError as e:
+            print('Not sending notifications: {}'.format(e), file=sys.stderr)
+            return EXIT_MISSING_PACKAGE
+
+    if args.title is None or args.message is None:
+        parser.error('title and message are required')
+
+    providers = enabled_providers()
+    if not providers:
+        return 0
+
+    if importlib.util.find_spec('requests') is None:
+        print('Not sending notifications: requests is not installed', file=sys.stderr)
+        return EXIT_MISSING_PACKAGE
+
+    if args.queue:
+        queue_message(outbox, args.title, args.message)
+        # If there's no sender running to pick it up, deliver it now. The
+        # message is safely queued either way, so a failure here only
+        # delays it.
+        try:
+            lock = _lock_outbox(outbox, blocking=False)
+            if lock:
+                with lock:
+                    flush_outbox(outbox, make_session(len(providers)), args.timeout)
+        except Exception as e:
+            print('Error delivering queued messages: {}'.format(e), file=sys.stderr)
+        return EXIT_QUEUED
+
+    results = dispatch(providers, make_session(len(providers)), args.title, args.message, args.timeout)
+
+    exit_code = 0
+    for name, _ in providers:
+        status, detail, seconds = results[name]
+        print('{}: {} ({:.1f}s){}'.format(name, status, seconds, ': ' + detail if detail else ''), flush=True)
+        if status != 'ok':
+            exit_code = 1
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
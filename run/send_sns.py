@@ -1,8 +1,11 @@
 import argparse
 import boto3
 
-def send_sns(topic: str, subject: str, message: str):
-    sns = boto3.client('sns')
+def send_sns(topic: str, subject: str, message: str, sns=None):
+    # Callers sending more than one message can pass in their own client,
+    # since creating one is much slower than publishing.
+    if sns is None:
+        sns = boto3.client('sns')
     response = sns.publish(TopicArn=topic, Message=message, Subject=subject)
     return response
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Maintains the links in /mutable/TeslaCam to the clips in the snapshots, and
+the index of them that clip_index.py keeps.
+
+Every clip is linked from /mutable/TeslaCam/RecentClips/<date>/, and saved
+and sentry clips also from /mutable/TeslaCam/{SavedClips,SentryClips}/<event>/.
+Track mode files are linked from /mutable/TeslaCam/TeslaTrackMode/.
+
+Usage:
+  snapshot_linker.py link <mountpoint> <final mountpoint> <toc> [<previous toc>]
+      Make links for the files in a new snapshot, mounted at <mountpoint>,
+      with links pointing into <final mountpoint> instead. Only files that
+      are new or changed since the previous snapshot (i.e. are in <toc>, but
+      not in <previous toc>) are linked; links to the other files keep
+      pointing to the previous snapshots.
+  snapshot_linker.py release <snapshot name>
+      Before a snapshot is deleted, point links to its files to the newest
+      other snapshot that has the same file, and delete the links to files
+      that aren't in any other snapshot.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+import clip_index
+
+LINK_DIR = '/mutable/TeslaCam'
+SNAPSHOTS_DIR = '/backingfiles/snapshots'
+
+
+def read_toc(path):
+    """
+    :param path: a snapshot's table of contents, with a "<size> <path>" line
+                 per file
+    :return: set of the lines
+    """
+    with open(path, 'r', errors='surrogateescape') as f:
+        return set(line.rstrip('\n') for line in f if line.strip())
+
+
+def links_for(path):
+    """
+    :param path: path of a file in a snapshot, relative to its mountpoint
+    :return: list of link paths, relative to LINK_DIR, the file should have
+    """
+    parts = path.split('/')
+    if len(parts) == 3 and parts[:2] == ['TeslaCam', 'RecentClips']:
+        return ['RecentClips/{}/{}'.format(parts[2][:10], parts[2])]
+    if len(parts) == 4 and parts[0] == 'TeslaCam' and parts[1] in ('SavedClips', 'SentryClips'):
+        return ['RecentClips/{}/{}'.format(parts[3][:10], parts[3]),
+                '{}/{}/{}'.format(parts[1], parts[2], parts[3])]
+    if len(parts) == 2 and parts[0] == 'TeslaTrackMode':
+        return ['TeslaTrackMode/{}'.format(parts[1])]
+    return []
+
+
+def _update_index(added=(), removed=()):
+    try:
+        db = clip_index.open_index()
+        try:
+            clip_index.update(db, added, removed)
+        finally:
+            db.close()
+    except (OSError, sqlite3.Error) as e:
+        # Start over the next time, rather than keep a stale index around.
+        print('failed to update clip index: {}'.format(e), file=sys.stderr)
+        try:
+            os.remove(clip_index.INDEX_FILE)
+        except OSError:
+            pass
+
+
+def _force_symlink(target, link):
+    # Like ln -sf, but atomic.
+    try:
+        os.symlink(target, link)
+    except FileExistsError:
+        temp = link + '.new'
+        if os.path.lexists(temp):
+            os.remove(temp)
+        os.symlink(target, temp)
+        os.replace(temp, link)
+
+
+def link_snapshot(mountpoint, final_mountpoint, toc, previous_toc=None):
+    """
+    :return: number of links made
+    """
+    added = read_toc(toc)
+    if previous_toc and os.path.exists(previous_toc):
+        added -= read_toc(previous_toc)
+
+    links = []
+    for line in sorted(added):
+        path = line.split(' ', 1)[1]
+        # Track mode files have always been linked to the snapshot's actual
+        # mountpoint.
+        target_root = mountpoint if path.startswith('TeslaTrackMode/') else final_mountpoint
+        for link in links_for(path):
+            links.append((os.path.join(target_root, path), os.path.join(LINK_DIR, link)))
+
+    directories = set(os.path.dirname(link) for _, link in links)
+    directories.update(os.path.join(LINK_DIR, name) for name in ('SavedClips', 'SentryClips'))
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    for target, link in links:
+        _force_symlink(target, link)
+    _update_index(added=[(link, target) for target, link in links])
+    return len(links)
+
+
+class _Snapshots:
+    """
+    The paths in the tables of contents of the snapshots, loaded as needed,
+    newest snapshot first.
+    """
+    def __init__(self, exclude):
+        names = [name for name in os.listdir(SNAPSHOTS_DIR) if name.startswith('snap-') and name != exclude]
+        self.names = sorted(names, reverse=True)
+        self.paths = {}
+
+    def newest_with(self, path):
+        for name in self.names:
+            if name not in self.paths:
+                try:
+                    toc = read_toc(os.path.join(SNAPSHOTS_DIR, name, 'snap.bin.toc'))
+                except OSError:
+                    toc = set()
+                self.paths[name] = set(line.split(' ', 1)[1] for line in toc)
+            if path in self.paths[name]:
+                return name
+        return None
+
+
+def release_snapshot(name):
+    """
+    :return: (number of links retargeted, number of links deleted)
+    """
+    marker = '/{}/'.format(name)
+    snapshots = _Snapshots(name)
+    retargeted = []
+    deleted = []
+    for directory, _, files in os.walk(LINK_DIR):
+        for filename in files:
+            link = os.path.join(directory, filename)
+            try:
+                target = os.readlink(link)
+            except OSError:
+                continue
+            if marker not in target:
+                continue
+            path = target.split(marker, 1)[1]
+            if path.startswith('mnt/'):
+                path = path[len('mnt/'):]
+            newer = snapshots.newest_with(path)
+            if newer:
+                target = target.replace(marker, '/{}/'.format(newer), 1)
+                _force_symlink(target, link)
+                retargeted.append((link, target))
+            else:
+                os.remove(link)
+                deleted.append(link)
+    _update_index(added=retargeted, removed=deleted)
+    return len(retargeted), len(deleted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    link_parser = subparsers.add_parser('link')
+    link_parser.add_argument('mountpoint')
+    link_parser.add_argument('final_mountpoint')
+    link_parser.add_argument('toc')
+    link_parser.add_argument('previous_toc', nargs='?')
+    release_parser = subparsers.add_parser('release')
+    release_parser.add_argument('name')
+    args = parser.parse_args()
+
+    if args.command == 'link':
+        count = link_snapshot(args.mountpoint, args.final_mountpoint, args.toc, args.previous_toc)
+        print('made {} links for {}'.format(count, args.mountpoint))
+    else:
+        retargeted, deleted = release_snapshot(args.name)
+        print('moved {} links to newer snapshots, deleted {}'.format(retargeted, deleted))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
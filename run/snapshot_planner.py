@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Decides which snapshots to delete to keep enough free space for the car's
+recordings.
+
+The snapshots are reflinked copies of the cam disk image, so deleting one
+only frees the blocks that no other snapshot (and not the cam disk image
+itself) still uses. The planner gets the block map of every image with the
+FIEMAP ioctl, and works out from that how much space deleting each snapshot,
+or a combination of them, actually frees.
+
+How much free space to keep is based on how fast the car has been writing
+new data recently, as seen from how much each snapshot differs from the one
+before it, rather than on a fixed amount. It's kept between half of and the
+10 GB plus 3% of the filesystem that was always kept free before.
+
+Snapshots are then picked, one at a time, by fewest unarchived clips lost per
+byte freed, then by most space freed. A clip is lost when the last snapshot
+that has it is deleted, and it hasn't been archived. Snapshots that lose no
+clips go oldest first. Without an archive the snapshots hold the only copy of
+every clip, so they're simply deleted oldest first. The newest snapshot is
+never deleted.
+
+Usage:
+  snapshot_planner.py plan
+      Print the amount of free space to keep, followed by the snapshots to
+      delete, one per line. Exits with 1 if the block maps couldn't be read,
+      in which case the caller should go by age.
+  snapshot_planner.py show
+      Print what each snapshot pins, and the recent recording rate.
+"""
+import argparse
+import array
+import fcntl
+import os
+import sqlite3
+import struct
+import sys
+import time
+
+import snapshot_linker
+from teslausb_common import log
+
+SNAPSHOTS_DIR = '/backingfiles/snapshots'
+CAM_DISK = '/backingfiles/cam_disk.bin'
+LEDGER_FILE = '/mutable/archive_ledger.db'
+
+# What was always kept free before: 10 GB plus 3% of the filesystem. The
+# planner never asks for more than this.
+LEGACY_RESERVE = 10 * 1024 * 1024 * 1024
+LEGACY_RESERVE_FRACTION = 1 / 33
+# ... and never for less than this much of it, so that a quiet day doesn't
+# leave too little room for a busy one.
+MIN_RESERVE_FRACTION = 0.5
+# Snapshots are taken (and old ones cleaned up) about once an hour, so the
+# free space has to last at least that long.
+RESERVE_HORIZON = 3600
+RESERVE_MARGIN = 1.5
+# The recording rate is the highest seen over this long.
+RATE_HISTORY = 24 * 3600
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+# Extents that don't have a location on disk yet.
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+EXTENTS_PER_CALL = 512
+
+
+def extents(path):
+    """
+    :return: list of (physical start, physical end) of the file's extents
+    """
+    result = []
+    start = 0
+    with open(path, 'rb') as f:
+        while True:
+            buf = array.array('B', bytes(FIEMAP_HEADER.size + FIEMAP_EXTENT.size * EXTENTS_PER_CALL))
+            FIEMAP_HEADER.pack_into(buf, 0, start, 0xFFFFFFFFFFFFFFFF - start, FIEMAP_FLAG_SYNC, 0,
+                                    EXTENTS_PER_CALL, 0)
+            fcntl.ioctl(f, FS_IOC_FIEMAP, buf)
+            mapped = FIEMAP_HEADER.unpack_from(buf, 0)[3]
+            if mapped == 0:
+                return result
+            for i in range(mapped):
+                logical, physical, length, _, _, flags, _, _, _ = FIEMAP_EXTENT.unpack_from(
+                    buf, FIEMAP_HEADER.size + i * FIEMAP_EXTENT.size)
+                if not flags & FIEMAP_EXTENT_UNKNOWN:
+                    result.append((physical, physical + length))
+                if flags & FIEMAP_EXTENT_LAST:
+                    return result
+            start = logical + length
+
+
+def shared_bytes(owners):
+    """
+    :param owners: dict of name to the list of extents of that image
+    :return: dict of frozenset of names to the number of bytes used by
+             exactly those images
+    """
+    events = []
+    for name, owner_extents in owners.items():
+        for start, end in owner_extents:
+            events.append((start, 1, name))
+            events.append((end, -1, name))
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    result = {}
+    counts = {}
+    active = frozenset()
+    position = 0
+    for offset, change, name in events:
+        if active and offset > position:
+            result[active] = result.get(active, 0) + offset - position
+        position = offset
+        count = counts.get(name, 0) + change
+        counts[name] = count
+        if count == 0 and change < 0:
+            active = active - {name}
+        elif count == 1 and change > 0:
+            active = active | {name}
+    return result
+
+
+def recording_rate(snapshots, times, shared):
+    """
+    :param snapshots: snapshot names, oldest first
+    :param times: dict of snapshot name to when it was taken
+    :param shared: the result of shared_bytes()
+    :return: the highest rate, in bytes per second, at which the car wrote
+             new data recently, or None if it can't be told
+    """
+    # The data a snapshot doesn't share with the one before it was written
+    # in between the two.
+    pairs = []
+    for older, newer in zip(snapshots, snapshots[1:]):
+        written = sum(size for names, size in shared.items() if newer in names and older not in names)
+        pairs.append((times[newer] - times[older], written))
+
+    # Going back from the newest, measure the rate over periods of at least
+    # RESERVE_HORIZON, so that a burst of writes just before a snapshot isn't
+    # taken to go on for the whole hour.
+    rates = []
+    duration = written = total_duration = 0
+    for interval, size in reversed(pairs):
+        if total_duration >= RATE_HISTORY:
+            break
+        duration += max(interval, 0)
+        written += size
+        total_duration += max(interval, 0)
+        if duration >= RESERVE_HORIZON:
+            rates.append(written / duration)
+            duration = written = 0
+    if duration > 0 and not rates:
+        rates.append(written / max(duration, RESERVE_HORIZON))
+    return max(rates) if rates else None
+
+
+def reserve_for(rate, total_space):
+    """
+    :return: (bytes to keep free, bytes that were always kept free before)
+    """
+    legacy = LEGACY_RESERVE + int(total_space * LEGACY_RESERVE_FRACTION)
+    if rate is None:
+        return legacy, legacy
+    return min(legacy, max(int(legacy * MIN_RESERVE_FRACTION), int(rate * RESERVE_HORIZON * RESERVE_MARGIN))), legacy
+
+
+def _archived():
+    try:
+        db = sqlite3.connect('file:{}?mode=ro'.format(LEDGER_FILE), uri=True)
+        try:
+            return set(path for (path,) in db.execute('SELECT path FROM archived'))
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return set()
+
+
+def unarchived_clips(snapshots):
+    """
+    :param snapshots: snapshot names
+    :return: dict of frozenset of snapshot names to the number of clips
+             that haven't been archived and are only in those snapshots,
+             or an empty dict if nothing gets archived
+    """
+    # Every snapshot would lose clips then, so going by clips is pointless.
+    if os.environ.get('ARCHIVE_SYSTEM', 'none') == 'none':
+        return {}
+    archived = _archived()
+    holders = {}
+    for name in snapshots:
+        try:
+            toc = snapshot_linker.read_toc(os.path.join(SNAPSHOTS_DIR, name, 'snap.bin.toc'))
+        except OSError:
+            continue
+        for line in toc:
+            path = line.split(' ', 1)[1]
+            # Clips from groups that don't get archived, e.g. RecentClips by
+            # default, are only ever in the snapshots.
+            links = snapshot_linker.links_for(path)
+            if links and not any(link in archived for link in links):
+                holders.setdefault(path, set()).add(name)
+
+    result = {}
+    for names in holders.values():
+        names = frozenset(names)
+        result[names] = result.get(names, 0) + 1
+    return result
+
+
+def _freed_by(deleted, counts):
+    return sum(count for names, count in counts.items() if names <= deleted)
+
+
+def plan(snapshots, shared, clips, needed):
+    """
+    :param snapshots: snapshot names, oldest first
+    :param shared: the result of shared_bytes()
+    :param clips: the result of unarchived_clips()
+    :param needed: number of bytes to free up
+    :return: list of (snapshot name, bytes freed, clips lost) to delete, in
+             order
+    """
+    result = []
+    deleted = frozenset()
+    freed = 0
+    # The newest snapshot was likely just taken, so it's always kept.
+    candidates = list(snapshots[:-1])
+    while freed < needed and candidates:
+        best = None
+        for age, name in enumerate(candidates):
+            more = _freed_by(deleted | {name}, shared) - freed
+            if more <= 0:
+                continue
+            lost = _freed_by(deleted | {name}, clips) - _freed_by(deleted, clips)
+            # Among those that lose nothing, go oldest first.
+            key = (lost / more, -more, age) if lost else (0, age, -more)
+            if best is None or key < best[0]:
+                best = (key, name, more, lost)
+        if best is None:
+            # None of them frees anything by itself, because they all share
+            # their blocks with another one. Deleting the oldest lets the
+            # next one free them.
+            name = candidates[0]
+            more = 0
+            lost = _freed_by(deleted | {name}, clips) - _freed_by(deleted, clips)
+        else:
+            _, name, more, lost = best
+        candidates.remove(name)
+        deleted = deleted | {name}
+        freed += more
+        result.append((name, more, lost))
+    return result
+
+
+def scan():
+    """
+    :return: (snapshot names oldest first, dict of name to when it was taken,
+              result of shared_bytes())
+    """
+    snapshots = []
+    times = {}
+    owners = {'': extents(CAM_DISK)}
+    for name in sorted(os.listdir(SNAPSHOTS_DIR)):
+        image = os.path.join(SNAPSHOTS_DIR, name, 'snap.bin')
+        if not name.startswith('snap-') or not os.path.exists(image):
+            continue
+        snapshots.append(name)
+        times[name] = os.stat(image).st_mtime
+        owners[name] = extents(image)
+    return snapshots, times, shared_bytes(owners)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('plan')
+    subparsers.add_parser('show')
+    args = parser.parse_args()
+
+    try:
+        start = time.monotonic()
+        snapshots, times, shared = scan()
+    except OSError as e:
+        log("couldn't read snapshot block maps: {}".format(e))
+        return 1
+    fs = os.statvfs(CAM_DISK)
+    free = fs.f_bfree * fs.f_frsize
+    rate = recording_rate(snapshots, times, shared)
+    reserve, legacy_reserve = reserve_for(rate, fs.f_blocks * fs.f_frsize)
+    clips = unarchived_clips(snapshots)
+
+    if args.command == 'show':
+        print('recording rate: {}'.format('{:.0f} bytes/s'.format(rate) if rate is not None else 'unknown'))
+        print('free: {}, reserve: {}'.format(free, reserve))
+        for name in snapshots:
+            print('{}: frees {} bytes, loses {} unarchived clip(s)'.format(
+                name, _freed_by(frozenset([name]), shared), _freed_by(frozenset([name]), clips)))
+        return 0
+
+    log('scanned {} snapshots in {:.1f} seconds, {} bytes free, keeping {} free'.format(
+        len(snapshots), time.monotonic() - start, free, reserve))
+    if reserve < legacy_reserve:
+        log('keeping {} bytes less free than the fixed reserve of {}, since the car recorded at most {:.0f} bytes/s '
+            'lately'.format(legacy_reserve - reserve, legacy_reserve, rate))
+    print(reserve)
+    if free > reserve:
+        return 0
+    for name, freed, lost in plan(snapshots, shared, clips, reserve - free):
+        log('deleting {} frees {} bytes and loses {} unarchived clip(s)'.format(name, freed, lost))
+        print(os.path.join(SNAPSHOTS_DIR, name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
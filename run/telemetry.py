@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Collects structured events (archive runs, per-file transfers, snapshots, car
+wake-ups) into /mutable/teslausb_telemetry.jsonl, one JSON object per line.
+
+Scripts don't write to /mutable themselves. They append their events to a
+spool file in /tmp, which is in RAM, either as JSON lines (see emit()) or,
+from the shell, as tab-separated lines of the time, the event name and
+name=value pairs (see telemetry() in archiveloop). The collector moves them
+to /mutable in batches, to spare the SD card, and starts a new file once it
+gets too big, keeping a few old ones.
+
+Usage:
+  telemetry.py collect [--interval 60] [--flush-interval 300]
+      Keep collecting events from the spool.
+  telemetry.py emit <event> [<name>=<value>...]
+      Queue an event.
+  telemetry.py summary [--runs 10] [--json]
+      Report archive throughput percentiles per run, and snapshot and wake
+      timings.
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import sys
+import time
+
+# archiveloop exports this for the scripts it runs, and its own telemetry().
+SPOOL_FILE = os.environ.get('TELEMETRY_SPOOL', '/tmp/teslausb_telemetry.spool')
+TELEMETRY_FILE = '/mutable/teslausb_telemetry.jsonl'
+# Start a new file once the current one reaches this size, and keep this
+# many old ones, as .1 (the newest) to .<n>.
+MAX_FILE_SIZE = 1024 * 1024
+KEEP_FILES = 3
+# Write to TELEMETRY_FILE once this much is waiting, even if the flush
+# interval hasn't passed yet.
+FLUSH_BYTES = 64 * 1024
+
+
+def emit(event, spool=SPOOL_FILE, **fields):
+    """
+    Queue an event. This never fails, since telemetry isn't worth failing
+    for.
+    """
+    record = {'time': round(time.time(), 3), 'event': event}
+    record.update(fields)
+    line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+    try:
+        # A single write to a file opened for appending, so that lines from
+        # several writers don't get mixed up.
+        fd = os.open(spool, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def _value(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_line(line):
+    """
+    :return: the event in a spool line, as a dict, or None if it isn't one
+    """
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        return record if isinstance(record, dict) and 'event' in record else None
+    fields = line.split('\t')
+    if len(fields) < 2:
+        return None
+    try:
+        record = {'time': float(fields[0]), 'event': fields[1]}
+    except ValueError:
+        return None
+    for field in fields[2:]:
+        name, _, value = field.partition('=')
+        if name:
+            record[name] = _value(value)
+    return record
+
+
+######################################
+# Collecting
+######################################
+class Collector:
+    def __init__(self, spool=SPOOL_FILE, path=TELEMETRY_FILE, max_size=MAX_FILE_SIZE, keep=KEEP_FILES):
+        self.spool = spool
+        self.path = path
+        self.max_size = max_size
+        self.keep = keep
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffered_since = None
+
+    def collect(self):
+        """
+        Take the events from the spool into the buffer.
+        Writers that opened the spool just before it's moved aside may still
+        be writing to it, so it's only read on the next call.
+        """
+        taken = self.spool + '.taken'
+        try:
+            with open(taken, 'r', errors='replace') as f:
+                lines = f.readlines()
+            os.remove(taken)
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            record = parse_line(line)
+            if record is None:
+                continue
+            data = json.dumps(record, separators=(',', ':')) + '\n'
+            self.buffer.append(data)
+            self.buffered_bytes += len(data)
+            if self.buffered_since is None:
+                self.buffered_since = time.monotonic()
+        try:
+            os.rename(self.spool, taken)
+        except FileNotFoundError:
+            pass
+
+    def _rotate(self):
+        for number in range(self.keep, 0, -1):
+            older = '{}.{}'.format(self.path, number)
+            newer = '{}.{}'.format(self.path, number - 1) if number > 1 else self.path
+            if number == self.keep and os.path.exists(older):
+                os.remove(older)
+            if os.path.exists(newer):
+                os.rename(newer, older)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer)
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size and size + len(data) > self.max_size:
+            self._rotate()
+        with open(self.path, 'a') as f:
+            f.write(data)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffered_since = None
+
+    def should_flush(self, flush_interval):
+        return bool(self.buffer) and (self.buffered_bytes >= FLUSH_BYTES
+                                      or time.monotonic() - self.buffered_since >= flush_interval)
+
+
+def run_collector(interval, flush_interval):
+    collector = Collector()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            collector.collect()
+            if collector.should_flush(flush_interval):
+                collector.flush()
+            time.sleep(interval)
+    finally:
+        # Take whatever is still in the spool along.
+        collector.collect()
+        time.sleep(0.1)
+        collector.collect()
+        collector.flush()
+
+
+######################################
+# Summary
+######################################
+def read_events(path=TELEMETRY_FILE, spool=SPOOL_FILE, keep=KEEP_FILES):
+    """
+    :return: all events, from the oldest file to the ones not collected yet
+    """
+    paths = ['{}.{}'.format(path, number) for number in range(keep, 0, -1)]
+    paths += [path, spool + '.taken', spool]
+    events = []
+    for name in paths:
+        try:
+            with open(name, 'r', errors='replace') as f:
+                for line in f:
+                    record = parse_line(line)
+                    if record is not None:
+                        events.append(record)
+        except OSError:
+            pass
+    events.sort(key=lambda record: record.get('time', 0))
+    return events
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    :return: dict of 'p<point>' to the value at that percentile, using the
+             nearest rank
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    return dict(('p{}'.format(point), values[min(len(values) - 1, max(0, -(-point * len(values) // 100) - 1))])
+                for point in points)
+
+
+def summarize(events, runs):
+    """
+    :return: dict with the last runs archive runs, and snapshot and wake
+             timings
+    """
+    archive_runs = {}
+    for record in events:
+        run = record.get('run')
+        if run is None or not record['event'].startswith('archive_'):
+            continue
+        summary = archive_runs.setdefault(run, {'run': run, 'files': 0, 'bytes': 0, 'rates': []})
+        if record['event'] == 'archive_start':
+            summary['started'] = record['time']
+            summary['files_total'] = record.get('files')
+        elif record['event'] == 'archive_file':
+            summary['files'] += 1
+            summary['bytes'] += record.get('bytes', 0)
+            if record.get('seconds', 0) > 0:
+                summary['rates'].append(record.get('bytes', 0) / record['seconds'])
+        elif record['event'] == 'archive_end':
+            summary['seconds'] = record.get('seconds')
+            summary['failed'] = record.get('failed', False)
+
+    result_runs = []
+    for summary in sorted(archive_runs.values(), key=lambda summary: summary.get('started', 0))[-runs:]:
+        rates = summary.pop('rates')
+        if summary.get('seconds'):
+            summary['bytes_per_second'] = round(summary['bytes'] / summary['seconds'])
+        summary['file_bytes_per_second'] = dict((name, round(value)) for name, value in percentiles(rates).items())
+        result_runs.append(summary)
+
+    def timings(event):
+        seconds = [record['seconds'] for record in events
+                   if record['event'] == event and isinstance(record.get('seconds'), (int, float))]
+        result = {'count': len(seconds)}
+        if seconds:
+            result['mean'] = round(statistics.mean(seconds), 2)
+            result.update((name, round(value, 2)) for name, value in percentiles(seconds).items())
+        return result
+
+    return {'archive_runs': result_runs, 'snapshot_seconds': timings('snapshot'), 'wake_seconds': timings('wake')}
+
+
+def _size(value):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if value < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(value, unit) if unit != 'B' else '{} B'.format(value)
+        value /= 1024
+
+
+def print_summary(summary):
+    for run in summary['archive_runs']:
+        started = time.strftime('%Y-%m-%d %H:%M', time.localtime(run['started'])) if 'started' in run else '?'
+        line = '{}  {} file(s), {}'.format(started, run['files'], _size(run['bytes']))
+        if run.get('seconds') is not None:
+            line += ' in {:.0f}s'.format(run['seconds'])
+        if run.get('bytes_per_second'):
+            line += ', {}/s'.format(_size(run['bytes_per_second']))
+        rates = run['file_bytes_per_second']
+        if rates:
+            line += '; per file {}'.format(', '.join('{} {}/s'.format(name, _size(value))
+                                                    for name, value in rates.items()))
+        if run.get('failed'):
+            line += ' (failed)'
+        print(line)
+    for name in ('snapshot_seconds', 'wake_seconds'):
+        timing = summary[name]
+        if timing['count']:
+            print('{}: {} times, mean {}s, {}'.format(
+                name.split('_')[0], timing['count'], timing['mean'],
+                ', '.join('{} {}s'.format(point, timing[point]) for point in ('p50', 'p90', 'p99'))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    collect_parser = subparsers.add_parser('collect')
+    collect_parser.add_argument('--interval', type=float, default=60, help='Seconds between looks at the spool.')
+    collect_parser.add_argument('--flush-interval', type=float, default=300,
+                                help='Seconds events are kept in memory at most.')
+    emit_parser = subparsers.add_parser('emit')
+    emit_parser.add_argument('event')
+    emit_parser.add_argument('fields', nargs='*', metavar='name=value')
+    summary_parser = subparsers.add_parser('summary')
+    summary_parser.add_argument('--runs', type=int, default=10, help='Number of archive runs to show.')
+    summary_parser.add_argument('--json', action='store_true', help='Print the summary as JSON.')
+    args = parser.parse_args()
+
+    if args.command == 'collect':
+        run_collector(args.interval, args.flush_interval)
+    elif args.command == 'emit':
+        fields = {}
+        for field in args.fields:
+            name, _, value = field.partition('=')
+            fields[name] = _value(value)
+        emit(args.event, **fields)
+    else:
+        summary = summarize(read_events(), args.runs)
+        if args.json:
+            print(json.dumps(summary, indent=2))
+        else:
+            print_summary(summary)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
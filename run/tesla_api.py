@@ -1,27 +1,71 @@
 #!/usr/bin/python3
+# Keep the imports here to the ones every run needs. Everything else, in
+# particular requests and teslapy, is imported where it's used, so that
+# e.g. a call forwarded to the daemon starts up as quickly as possible.
 import argparse
-import base64
+import contextlib
+import io
 import json
 import os
 import random
-import requests
-import teslapy
+import socket
 import time
 import sys
+import threading
 from datetime import datetime, timedelta
-# Only used for debugging.
-from pprint import pprint
 
 
 # Global vars for use by various functions.
 base_url = 'https://owner-api.teslamotors.com/api/1/vehicles'
+# If set, teslapy refreshes access tokens with this server rather than with
+# Tesla's. See main().
+auth_url = ''
 SETTINGS = {
     'DEBUG': False,
     'REFRESH_TOKEN': False,
+    # Refresh the access token when it's due to expire within this many seconds.
+    'token_refresh_margin': 600,
     'tesla_email': 'dummy@local',
     'tesla_password': '',
     'tesla_access_token': '',
     'tesla_vin': '',
+    # Seconds to wait for the connection to be established, and for the
+    # server to send a response, respectively.
+    'connect_timeout': 10,
+    'read_timeout': 30,
+    # How often, and with what backoff bounds in seconds, a failed request is
+    # retried, and how long a single call may take in all, retries included.
+    'request_retries': 3,
+    'request_initial_delay': 1,
+    'request_max_delay': 8,
+    'request_budget': 60,
+    # After this many failed requests in a row, stop sending any for this
+    # many seconds.
+    'breaker_threshold': 5,
+    'breaker_cooldown': 120,
+    # Skip waking the car if it was seen online this many seconds ago.
+    'online_cache_seconds': 60,
+    # Backoff bounds and overall deadline, in seconds, for waking the car.
+    'wake_initial_delay': 1,
+    'wake_max_delay': 16,
+    'wake_resend_interval': 30,
+    'wake_timeout': 180,
+    # How many seconds vehicle data is reused for, and optionally a file to
+    # keep it in between runs.
+    'vehicle_data_ttl': 10,
+    'vehicle_data_file': '',
+    # The streaming server used by --keep_awake, and the longest it waits
+    # before reconnecting to it.
+    'streaming_url': 'wss://streaming.vn.teslamotors.com/streaming/',
+    'keep_awake_max_delay': 60,
+    # How many seconds the list of vehicles on the account is reused for by
+    # --fleet, and the most cars it talks to at the same time.
+    'fleet_list_ttl': 3600,
+    'fleet_max_workers': 8,
+    # Seconds a client waits for the daemon to accept a call, and to answer
+    # it, before giving up on it.
+    'daemon_connect_timeout': 5,
+    'daemon_timeout': 900,
 }
 date_format = '%Y-%m-%d %H:%M:%S'
 # This dict stores the data that will be written to /mutable/tesla_api.json.
@@ -32,68 +76,309 @@ tesla_api_json = {
     'refresh_token': '',
     'id': 0,
     'vehicle_id': 0,
+    'expires_at': 0,
 }
+# The contents of /mutable/tesla_api.json as last read or written, so that
+# the file is only rewritten when something actually changed.
+tesla_api_json_on_disk = None
+# The modification time of /mutable/tesla_api.json as last read or written, so
+# that the daemon notices when another tesla_api.py run rewrote it.
+tesla_api_json_mtime = None
+# Serializes access to the token between daemon requests and the daemon's
+# background refresh.
+token_lock = threading.Lock()
 
 mutable_dir = '/mutable'
+# The (VIN, name) pair that _get_id() last resolved, so that a long-running
+# daemon doesn't call list_vehicles() again for every request.
+resolved_vehicle = None
+# The vehicle the API functions act on in the current thread, when --fleet
+# runs them for several vehicles at once. Otherwise they act on the one in
+# tesla_api_json. See _current_vehicle().
+fleet_context = threading.local()
+# Per vehicle ID, until when (in seconds since the epoch) the vehicle is
+# assumed to be online, because it answered a request shortly before.
+vehicle_online_until = {}
+# Per vehicle ID, the last vehicle_data response and the time it was fetched,
+# as used by _get_cached_vehicle_data().
+vehicle_data_cache = None
+# Serializes writes to SETTINGS['vehicle_data_file'].
+vehicle_data_lock = threading.Lock()
+# The requests.Session shared by all API calls, created by _get_session().
+# Reusing it keeps the TLS connections to the Tesla servers alive between
+# requests, instead of doing a new handshake for every one of them.
+session = None
+# State of the circuit breaker, see _check_breaker() and _record_breaker().
+breaker = {'failures': 0, 'open_until': 0}
+breaker_lock = threading.Lock()
+# Names of the API functions, as built by _get_api_functions().
+api_functions = None
+# Unix socket used to talk to a resident tesla_api.py started with --daemon.
+socket_path = '/tmp/tesla_api.sock'
 
 def _invalidate_access_token():
     if not tesla_api_json.get('refresh_token') or tesla_api_json['refresh_token'] == '':
         tesla_api_json['refresh_token'] = SETTINGS['refresh_token']
     tesla_api_json['access_token'] = None
+    tesla_api_json['expires_at'] = 0
     _write_tesla_api_json()
 
-def _execute_request(url=None, method=None, data=None, require_vehicle_online=True):
+def _execute_request(url=None, method=None, data=None, require_vehicle_online=True, idempotent=None):
     """
     Wrapper around requests to the Tesla REST Service which ensures the vehicle is online before proceeding
     :param url: the url to send the request to
     :param method: the request method ('GET' or 'POST')
     :param data: the request data (optional)
+    :param idempotent: whether the request can safely be repeated (optional)
     :return: JSON response
     """
     if require_vehicle_online:
-        vehicle_online = False
-        while not vehicle_online:
-            _log("Attempting to wake up Vehicle (ID:{})".format(tesla_api_json['id']))
-            result = _rest_request(
-                '{}/{}/wake_up'.format(base_url, tesla_api_json['id']),
-                method='POST'
-            )
-
-            # Tesla REST Service sometimes misbehaves... this seems to be caused by an invalid/expired auth token
-            # TODO: Remove auth token and retry?
-            if result['response'] is None:
-                _error("Fatal Error: Tesla REST Service returned an invalid response")
-                sys.exit(1)
-
-            vehicle_online = result['response']['state'] == "online"
-            if vehicle_online:
-                _log("Vehicle (ID:{}) is Online".format(tesla_api_json['id']))
-            else:
-                _log("Vehicle (ID:{}) is Asleep; Waiting 5 seconds before retry...".format(tesla_api_json['id']))
-                time.sleep(5)
+        state = _wake_up_vehicle()
 
     if url is None:
-        return result['response']['state']
+        return state
 
-    json_response = _rest_request(url, method, data)
+    try:
+        json_response = _rest_request(url, method, data, idempotent)
+    except _RequestFailed as e:
+        vehicle_online_until.pop(_current_vehicle()['id'], None)
+        _error('Fatal Error: {}'.format(e))
+        sys.exit(1)
+
+    # Commands change the vehicle's state, so whatever was cached is stale.
+    if method and method.upper() == 'POST':
+        _invalidate_vehicle_data()
 
     # Error handling
     error = json_response.get('error')
     if error:
+        # Don't assume the vehicle is still online after a failed request.
+        vehicle_online_until.pop(_current_vehicle()['id'], None)
         # Log error and die
         _error(json.dumps(json_response, indent=2))
         sys.exit(1)
 
+    if require_vehicle_online:
+        _mark_vehicle_online()
+
     return json_response
 
 
-def _rest_request(url, method=None, data=None):
+def _current_vehicle():
+    """
+    :return: dict with the 'id' and 'vehicle_id' of the vehicle to act on
+    """
+    return getattr(fleet_context, 'vehicle', None) or tesla_api_json
+
+
+def _mark_vehicle_online():
+    vehicle_online_until[_current_vehicle()['id']] = time.time() + SETTINGS['online_cache_seconds']
+
+
+def _get_listed_vehicle_state():
+    """
+    Get the vehicle's state from list_vehicles(), which doesn't wake it up.
+    :return: the state, e.g. 'online' or 'asleep', or None if it couldn't be determined
+    """
+    result = list_vehicles()
+    for vehicle_dict in result.get('response') or []:
+        if str(vehicle_dict.get('id_s')) == str(_current_vehicle()['id']):
+            return vehicle_dict.get('state')
+    return None
+
+
+def _wake_up_vehicle():
+    """
+    Wake up the vehicle and wait for it to come online.
+    A single wake_up command is sent, after which the vehicle's state is polled
+    through list_vehicles() with exponential backoff. The wake_up command is
+    repeated every SETTINGS['wake_resend_interval'] seconds in case the car
+    missed it. Gives up after SETTINGS['wake_timeout'] seconds.
+    :return: the vehicle's state, which is always 'online'
+    """
+    vehicle_id = _current_vehicle()['id']
+    if time.time() < vehicle_online_until.get(vehicle_id, 0):
+        _log("Vehicle (ID:{}) was online moments ago, not waking it".format(vehicle_id))
+        return 'online'
+
+    import telemetry
+
+    start = time.time()
+    deadline = start + SETTINGS['wake_timeout']
+    delay = SETTINGS['wake_initial_delay']
+    next_wake_up = 0
+    wake_ups = 0
+    while True:
+        if time.time() >= next_wake_up:
+            _log("Attempting to wake up Vehicle (ID:{})".format(vehicle_id))
+            wake_ups += 1
+            try:
+                result = _rest_request(
+                    '{}/{}/wake_up'.format(base_url, vehicle_id),
+                    method='POST',
+                    idempotent=True
+                )
+                next_wake_up = time.time() + SETTINGS['wake_resend_interval']
+            except _RequestFailed as e:
+                if e.kind != RETRYABLE:
+                    telemetry.emit('wake', vehicle=vehicle_id, seconds=round(time.time() - start, 1),
+                                   wake_ups=wake_ups, outcome='failed')
+                    _error('Fatal Error: {}'.format(e))
+                    sys.exit(1)
+                # The car never got it, so send it again next time around,
+                # and keep trying until the wake timeout.
+                result = {}
+            state = (result.get('response') or {}).get('state')
+        else:
+            state = _get_listed_vehicle_state()
+
+        if state == 'online':
+            _log("Vehicle (ID:{}) is Online".format(vehicle_id))
+            _mark_vehicle_online()
+            telemetry.emit('wake', vehicle=vehicle_id, seconds=round(time.time() - start, 1),
+                           wake_ups=wake_ups, outcome='online')
+            return state
+
+        if time.time() + delay > deadline:
+            telemetry.emit('wake', vehicle=vehicle_id, seconds=round(time.time() - start, 1),
+                           wake_ups=wake_ups, outcome='timeout')
+            _error("Fatal Error: Vehicle (ID:{}) did not come online within {} seconds".format(
+                vehicle_id, SETTINGS['wake_timeout']))
+            sys.exit(1)
+
+        # Tesla REST Service sometimes misbehaves and returns no state at all,
+        # which is worth another try rather than giving up.
+        if state is None:
+            _log("Tesla REST Service returned an invalid response")
+        # Full jitter, so that several scripts waking the same car don't
+        # end up polling in lockstep.
+        sleep_time = random.uniform(delay / 2, delay)
+        _log("Vehicle (ID:{}) is {}; Waiting {:.1f} seconds before retry...".format(
+            vehicle_id, state or 'unknown', sleep_time))
+        time.sleep(sleep_time)
+        delay = min(delay * 2, SETTINGS['wake_max_delay'])
+
+
+class _RequestFailed(Exception):
+    """
+    A request to the Tesla REST Service that failed. kind is one of
+    RETRYABLE (worth trying again, e.g. a timeout, a 408 "vehicle
+    unavailable", a 429 or a 5xx), AUTH (the access token was rejected) or
+    FATAL (trying again won't help).
+    """
+    def __init__(self, message, kind, retry_after=None, counts_for_breaker=False):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+        self.counts_for_breaker = counts_for_breaker
+
+
+RETRYABLE = 'retryable'
+AUTH = 'auth'
+FATAL = 'fatal'
+
+
+def _check_breaker():
+    """
+    Fail fast while the circuit breaker is open, i.e. while the Tesla REST
+    Service is assumed to be down.
+    """
+    with breaker_lock:
+        remaining = breaker['open_until'] - time.time()
+        failures = breaker['failures']
+    if remaining > 0:
+        raise _RequestFailed(
+            'Tesla REST Service failed {} times in a row, not sending requests for another {:.0f} seconds'.format(
+                failures, remaining),
+            FATAL)
+
+
+def _record_breaker(succeeded):
+    with breaker_lock:
+        if succeeded:
+            breaker['failures'] = 0
+            breaker['open_until'] = 0
+            return
+        breaker['failures'] += 1
+        if breaker['failures'] >= SETTINGS['breaker_threshold']:
+            breaker['open_until'] = time.time() + SETTINGS['breaker_cooldown']
+            _error('Tesla REST Service failed {} times in a row, pausing requests for {} seconds'.format(
+                breaker['failures'], SETTINGS['breaker_cooldown']))
+
+
+def _send_request(url, method, data, token, read_timeout, idempotent):
     """
-    Executes a REST request
+    Sends a single request, and sorts out what went wrong, if anything.
+    :return: JSON response
+    :raises _RequestFailed: if the request failed
+    """
+    import requests
+
+    headers = {
+      'Authorization': 'Bearer {}'.format(token),
+      'User-Agent': 'github.com/marcone/teslausb',
+    }
+    timeout = (SETTINGS['connect_timeout'], read_timeout)
+    # Whether a failed request may still have reached the car. If so, it's
+    # only repeated if doing the same thing twice is harmless.
+    retryable_if_sent = RETRYABLE if idempotent else FATAL
+    try:
+        if method.upper() == 'GET':
+            response = _get_session().get(url, headers=headers, timeout=timeout)
+        elif method.upper() == 'POST':
+            response = _get_session().post(url, headers=headers, data=data, timeout=timeout)
+        else:
+            raise ValueError('Unsupported Request Method: {}'.format(method))
+    except requests.exceptions.ConnectTimeout as e:
+        raise _RequestFailed('Connecting timed out: {}'.format(e), RETRYABLE, counts_for_breaker=True)
+    except requests.exceptions.Timeout as e:
+        raise _RequestFailed('No response in time: {}'.format(e), retryable_if_sent, counts_for_breaker=True)
+    except requests.exceptions.ConnectionError as e:
+        raise _RequestFailed('Connection failed: {}'.format(e), retryable_if_sent, counts_for_breaker=True)
+
+    status = response.status_code
+    if status == 401 or 'invalid bearer token' in response.text:
+        raise _RequestFailed('Invalid Access token', AUTH)
+    retry_after = None
+    with contextlib.suppress(TypeError, ValueError):
+        retry_after = float(response.headers.get('Retry-After'))
+    if status == 408:
+        # Vehicle unavailable: the car is asleep or offline, so the request
+        # never got to it.
+        raise _RequestFailed('Vehicle unavailable (HTTP 408)', RETRYABLE, retry_after)
+    if status in (429, 503):
+        # Rate limited or overloaded, in which case the request wasn't handled.
+        raise _RequestFailed('Tesla REST Service busy (HTTP {})'.format(status), RETRYABLE, retry_after, True)
+    if status >= 500:
+        raise _RequestFailed('Tesla REST Service error (HTTP {})'.format(status), retryable_if_sent, retry_after,
+                             True)
+    if not response.text:
+        raise _RequestFailed('Tesla REST Service failed to return a response (HTTP {})'.format(status),
+                             retryable_if_sent, counts_for_breaker=True)
+    try:
+        json_response = response.json()
+    except ValueError:
+        raise _RequestFailed('Tesla REST Service returned an invalid response (HTTP {})'.format(status),
+                             retryable_if_sent, counts_for_breaker=True)
+    if status >= 400 and not json_response.get('error'):
+        raise _RequestFailed('Request failed (HTTP {}): {}'.format(status, response.text), FATAL)
+    return json_response
+
+
+def _rest_request(url, method=None, data=None, idempotent=None):
+    """
+    Executes a REST request. Failures that are worth retrying are retried
+    with exponential backoff, as long as the call stays within
+    SETTINGS['request_budget'] seconds, and a rejected access token is
+    refreshed once. While the Tesla REST Service keeps failing, the circuit
+    breaker stops requests from being sent at all.
     :param url: the url to send the request to
     :param method: the request method ('GET' or 'POST')
     :param data: the request data (optional)
+    :param idempotent: whether sending the request twice is harmless, which
+                       by default only GET requests are
     :return: JSON response
+    :raises _RequestFailed: if the request didn't succeed
     """
     # set default method value
     if method is None:
@@ -101,30 +386,72 @@ def _rest_request(url, method=None, data=None):
     # set default data value
     if data is None:
         data = {}
-    headers = {
-      'Authorization': 'Bearer {}'.format(_get_api_token()),
-      'User-Agent': 'github.com/marcone/teslausb',
-    }
-
-    _log("Sending {} Request: {}; Data: {}".format(method, url, data))
-    if method.upper() == 'GET':
-        response = requests.get(url, headers=headers)
-    elif method.upper() == 'POST':
-        response = requests.post(url, headers=headers, data=data)
-    else:
-        raise ValueError('Unsupported Request Method: {}'.format(method))
-    if not response.text:
-        _error("Fatal Error: Tesla REST Service failed to return a response, access token may have expired")
-        sys.exit(1)
-    if  'invalid bearer token' in response.text:
-        _error("Invalid Access token, removing from cache...")
-        _invalidate_access_token()
-    json_response = response.json()
-
-    # log full JSON response for debugging
-    _log(json.dumps(json_response, indent=2))
-
-    return json_response
+    if idempotent is None:
+        idempotent = method.upper() == 'GET'
+
+    deadline = time.time() + SETTINGS['request_budget']
+    delay = SETTINGS['request_initial_delay']
+    attempt = 0
+    refreshed = False
+    while True:
+        _check_breaker()
+        attempt += 1
+        token = _get_api_token()
+        _log("Sending {} Request: {}; Data: {}".format(method, url, data))
+        try:
+            read_timeout = max(1, min(SETTINGS['read_timeout'], deadline - time.time()))
+            json_response = _send_request(url, method, data, token, read_timeout, idempotent)
+        except _RequestFailed as e:
+            if e.counts_for_breaker:
+                _record_breaker(False)
+            if e.kind == AUTH and not refreshed:
+                _error("Invalid Access token, removing from cache...")
+                with token_lock:
+                    # Another thread may have gotten a new one already.
+                    if tesla_api_json['access_token'] == token:
+                        _invalidate_access_token()
+                refreshed = True
+                continue
+            if e.kind != RETRYABLE or attempt > SETTINGS['request_retries']:
+                raise
+            sleep_time = random.uniform(delay / 2, delay)
+            if e.retry_after is not None:
+                sleep_time = max(sleep_time, e.retry_after)
+            if time.time() + sleep_time >= deadline:
+                raise _RequestFailed('{}, and no time left to retry'.format(e), e.kind)
+            _log('{}; Waiting {:.1f} seconds before retry...'.format(e, sleep_time))
+            time.sleep(sleep_time)
+            delay = min(delay * 2, SETTINGS['request_max_delay'])
+            continue
+
+        _record_breaker(True)
+        # log full JSON response for debugging
+        _log(json.dumps(json_response, indent=2))
+        return json_response
+
+
+def _get_session():
+    """
+    Returns the shared requests.Session, creating it on first use.
+    """
+    global session
+    if session is None:
+        # requests is imported here rather than at the top of the file, so that
+        # calls forwarded to the daemon don't pay for importing it.
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        # One pool per host (owner-api and the streaming server), and retries
+        # are left to the callers, which know whether a request is safe to
+        # repeat.
+        # --fleet talks to owner-api for several vehicles at once, so keep
+        # a connection for each of them.
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(2, SETTINGS['fleet_max_workers']),
+                              max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
 
 
 def _get_api_token():
@@ -133,53 +460,131 @@ def _get_api_token():
     SETTINGS, or from the Tesla API by using the credentials in SETTINGS.
     If those are also not available, kill the script, since it can't continue.
     """
-    os.chdir(mutable_dir)
-    # If the token was already saved, work with that.
-    if tesla_api_json['access_token']:
-        # Due to what appears to be a bug with the fake-hwclock service,
-        # sometimes the system thinks it's still November 2016. If that's the
-        # case, we can't accurately determine the age of the token, so we just
-        # use it. Later executions of the script should run after the date has
-        # updated correctly, at which point we can properly compare the dates.
-        now = datetime.now()
-        if now.year < 2019: # This script was written in 2019.
+    with token_lock:
+        # If the token was already saved, work with that.
+        if tesla_api_json['access_token']:
+            # Due to what appears to be a bug with the fake-hwclock service,
+            # sometimes the system thinks it's still November 2016. If that's the
+            # case, we can't accurately determine the age of the token, so we just
+            # use it. Later executions of the script should run after the date has
+            # updated correctly, at which point we can properly compare the dates.
+            now = datetime.now()
+            if now.year < 2019: # This script was written in 2019.
+                return tesla_api_json['access_token']
+
+            if SETTINGS['REFRESH_TOKEN'] or _access_token_needs_refresh():
+                _log('Refreshing api token')
+                _refresh_access_token()
+                # Only force a refresh once, not for every request.
+                SETTINGS['REFRESH_TOKEN'] = False
+
             return tesla_api_json['access_token']
 
-        tesla = teslapy.Tesla(SETTINGS['tesla_email'], None)
-        if SETTINGS['REFRESH_TOKEN'] or 0 < tesla.expires_at < time.time():
-            _log('Refreshing api token')
-            tesla.refresh_token()
-            tesla_api_json['access_token'] = tesla.token.get('access_token')
+        # If the access token is not already stored in tesla_api_json AND
+        # the user provided a refresh_token force it into the client to get a proper token
+        elif tesla_api_json['refresh_token']:
+            _log('Force setting a refresh token')
+            _refresh_access_token()
+            return tesla_api_json['access_token']
 
-        return tesla_api_json['access_token']
+    _error('Unable to perform Tesla API functions: no credentials or token.')
+    sys.exit(1)
+
+
+def _get_access_token_expiry():
+    """
+    Returns the time the access token expires at, in seconds since the epoch,
+    or 0 if it isn't known. The expiry is kept in tesla_api_json, so the token
+    only needs to be inspected once.
+    """
+    if tesla_api_json.get('expires_at'):
+        return tesla_api_json['expires_at']
+
+    import base64
+
+    # Tokens issued by auth.tesla.com are JWTs, which carry their own expiry.
+    expires_at = 0
+    try:
+        payload = tesla_api_json['access_token'].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        expires_at = json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        # Not a JWT, so fall back to the expiry teslapy keeps in its cache.
+        import teslapy
+
+        os.chdir(mutable_dir)
+        expires_at = teslapy.Tesla(SETTINGS['tesla_email'], None).expires_at
+
+    tesla_api_json['expires_at'] = expires_at
+    return expires_at
+
+
+def _access_token_needs_refresh():
+    """
+    True if the access token has expired, or will expire within
+    SETTINGS['token_refresh_margin'] seconds.
+    """
+    expires_at = _get_access_token_expiry()
+    return 0 < expires_at < time.time() + SETTINGS['token_refresh_margin']
+
+
+def _refresh_access_token():
+    """
+    Gets a new access token from the Tesla auth service and saves it, along
+    with its expiry and the possibly updated refresh token, in tesla_api.json.
+    The caller needs to hold token_lock.
+    """
+    import teslapy
 
-    # If the access token is not already stored in tesla_api_json AND
-    # the user provided a refresh_token force it into the client to get a proper token
-    elif tesla_api_json['refresh_token']:
-        tesla = teslapy.Tesla(SETTINGS['tesla_email'], None)
-        _log('Force setting a refresh token')
+    os.chdir(mutable_dir)
+    tesla = teslapy.Tesla(SETTINGS['tesla_email'], None, sso_base_url=auth_url or None)
+    if not tesla_api_json['access_token'] or not tesla.token.get('refresh_token'):
+        # teslapy has no usable token cached, so force the refresh token from
+        # tesla_api.json into the client.
         tesla.access_token = "DUMMY"
         tesla.token['refresh_token'] = tesla_api_json['refresh_token']
-        tesla.refresh_token()
-        tesla_api_json['access_token'] = tesla.token.get('access_token')
-        # if the refresh token is changed we store the new one, never saw it happen but...
-        tesla_api_json['refresh_token'] = tesla.token['refresh_token']
-        _write_tesla_api_json()
-        return tesla_api_json['access_token']
+    tesla.refresh_token()
+    tesla_api_json['access_token'] = tesla.token.get('access_token')
+    tesla_api_json['expires_at'] = tesla.expires_at
+    # if the refresh token is changed we store the new one, never saw it happen but...
+    tesla_api_json['refresh_token'] = tesla.token.get('refresh_token', tesla_api_json['refresh_token'])
+    _write_tesla_api_json()
 
-    _error('Unable to perform Tesla API functions: no credentials or token.')
-    sys.exit(1)
+
+def _refresh_access_token_in_background():
+    """
+    Used by the daemon to refresh the access token ahead of its expiry, so
+    that calls never have to wait for a refresh.
+    """
+    while True:
+        time.sleep(60)
+        _reload_tesla_api_json_if_changed()
+        with token_lock:
+            if not tesla_api_json['access_token'] or not _access_token_needs_refresh():
+                continue
+            try:
+                _refresh_access_token()
+            except Exception as e:
+                # The next API call will try again.
+                _error('Background token refresh failed: {}'.format(e))
 
 
 def _get_id():
     """
     Put the vehicle's ID into tesla_api_json['id'].
     """
+    global resolved_vehicle
+    # --fleet picked the vehicle already.
+    if getattr(fleet_context, 'vehicle', None):
+        return
+
     # If it was already set by _load_tesla_api_json(), and a new
     # VIN or name wasn't specified on the command line, we're done.
     if tesla_api_json['id'] and tesla_api_json['vehicle_id']:
       if SETTINGS['tesla_name'] == '' and SETTINGS['tesla_vin'] == '':
         return
+      if resolved_vehicle == (SETTINGS['tesla_vin'], SETTINGS['tesla_name']):
+        return
 
     # Call list_vehicles() and use the provided name or VIN to get the vehicle ID.
     result = list_vehicles()
@@ -189,6 +594,7 @@ def _get_id():
           or ( SETTINGS['tesla_vin'] == '' and SETTINGS['tesla_name'] == '')):
             tesla_api_json['id'] = vehicle_dict['id_s']
             tesla_api_json['vehicle_id'] = vehicle_dict['vehicle_id']
+            resolved_vehicle = (SETTINGS['tesla_vin'], SETTINGS['tesla_name'])
             _log('Retrieved Vehicle ID from Tesla API.')
             _write_tesla_api_json()
             return
@@ -202,10 +608,12 @@ def _load_tesla_api_json():
     Load the data stored in /mutable/tesla_api.json, if it exists.
     If it doesn't exist, write a file to that location with default values.
     """
+    global tesla_api_json_on_disk, tesla_api_json_mtime
     try:
         with open(mutable_dir + '/tesla_api.json', 'r') as f:
             _log('Loading mutable data from disk...')
             json_string = f.read()
+            tesla_api_json_mtime = os.fstat(f.fileno()).st_mtime_ns
     except FileNotFoundError:
         # Write a dict with the default data to the file.
         _log("Mutable data didn't exist, writing defaults...")
@@ -224,22 +632,59 @@ def _load_tesla_api_json():
         # Need to declare this as a global since we assign to it directly.
         global tesla_api_json
         tesla_api_json = json.loads(json_string, object_hook=datetime_parser)
+        tesla_api_json_on_disk = _serialize_tesla_api_json()
 
 
-def _write_tesla_api_json():
+def _reload_tesla_api_json_if_changed():
     """
-    Write the contents of the tesla_api_json dict to /mutable/tesla_api.json.
+    Used by the daemon to pick up the token and vehicle ID that a tesla_api.py
+    run without the daemon, e.g. one with --refresh_token, wrote in the
+    meantime, instead of going on with a refresh token that may have been
+    revoked.
     """
+    global resolved_vehicle
+    try:
+        mtime = os.stat(mutable_dir + '/tesla_api.json').st_mtime_ns
+    except OSError:
+        return
+    with token_lock:
+        if mtime == tesla_api_json_mtime:
+            return
+        _log('tesla_api.json changed on disk, reloading it.')
+        _load_tesla_api_json()
+        resolved_vehicle = None
+
+
+def _serialize_tesla_api_json():
     def convert_dt(obj):
         # Converts datetime objects into 'YYYY-MM-DD HH:MM:SS' strings, since
         # json.dumps() can't serialize them itself.
         if isinstance(obj, datetime):
             return obj.strftime(date_format)
 
-    with open(mutable_dir + '/tesla_api.json', 'w') as f:
-        _log('Writing ' + mutable_dir + '/tesla_api.json...')
-        json_string = json.dumps(tesla_api_json, indent=2, default=convert_dt)
+    return json.dumps(tesla_api_json, indent=2, default=convert_dt)
+
+
+def _write_tesla_api_json():
+    """
+    Write the contents of the tesla_api_json dict to /mutable/tesla_api.json,
+    if they differ from what's already there. The file is replaced atomically,
+    so losing power halfway through doesn't leave a truncated file behind.
+    """
+    global tesla_api_json_on_disk, tesla_api_json_mtime
+    json_string = _serialize_tesla_api_json()
+    if json_string == tesla_api_json_on_disk:
+        return
+
+    path = mutable_dir + '/tesla_api.json'
+    _log('Writing ' + path + '...')
+    with open(path + '.new', 'w') as f:
         f.write(json_string)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.new', path)
+    tesla_api_json_on_disk = json_string
+    tesla_api_json_mtime = os.stat(path).st_mtime_ns
 
 
 def _get_log_timestamp():
@@ -271,39 +716,37 @@ def list_vehicles():
 
 def get_service_data():
     return _execute_request(
-        '{}/{}/service_data'.format(base_url, tesla_api_json['id'])
+        '{}/{}/service_data'.format(base_url, _current_vehicle()['id'])
     )
 
 
 def get_vehicle_summary():
     return _execute_request(
-        '{}/{}'.format(base_url, tesla_api_json['id'])
+        '{}/{}'.format(base_url, _current_vehicle()['id'])
     )
 
 
 def get_vehicle_legacy_data():
     return _execute_request(
-        '{}/{}/data'.format(base_url, tesla_api_json['id'])
+        '{}/{}/data'.format(base_url, _current_vehicle()['id'])
     )
 
 
 def get_nearby_charging():
     return _execute_request(
-        '{}/{}//nearby_charging_sites'.format(base_url, tesla_api_json['id'])
+        '{}/{}//nearby_charging_sites'.format(base_url, _current_vehicle()['id'])
     )
 
 
 def get_vehicle_data():
-    return _execute_request(
-        '{}/{}/vehicle_data'.format(base_url, tesla_api_json['id'])
-    )
+    return _get_cached_vehicle_data()
 
 
 def get_vehicle_online_state():
     # list_vehicles gets the state of each vehicle without waking them up
     result = list_vehicles()
     for vehicle_dict in result['response']:
-        if ( vehicle_dict['vehicle_id'] == tesla_api_json['vehicle_id']):
+        if ( vehicle_dict['vehicle_id'] == _current_vehicle()['vehicle_id']):
             return vehicle_dict['state']
     _error("Could not find vehicle");
     sys.exit(1)
@@ -313,38 +756,139 @@ def is_vehicle_online():
 
 
 def get_charge_state():
-    return _execute_request(
-        '{}/{}/data_request/charge_state'.format(base_url, tesla_api_json['id'])
-    )
+    return _get_vehicle_data_section('charge_state')
 
 
 def get_climate_state():
-    return _execute_request(
-        '{}/{}/data_request/climate_state'.format(base_url, tesla_api_json['id'])
-    )
+    return _get_vehicle_data_section('climate_state')
 
 
 def get_drive_state():
-    return _execute_request(
-        '{}/{}/data_request/drive_state'.format(base_url, tesla_api_json['id'])
-    )
+    return _get_vehicle_data_section('drive_state')
 
 
 def get_gui_settings():
-    return _execute_request(
-        '{}/{}/data_request/gui_settings'.format(base_url, tesla_api_json['id'])
-    )
+    return _get_vehicle_data_section('gui_settings')
 
 
 def get_vehicle_state():
-    return _execute_request(
-        '{}/{}/data_request/vehicle_state'.format(base_url, tesla_api_json['id'])
+    return _get_vehicle_data_section('vehicle_state')
+
+
+######################################
+# Vehicle Data Cache
+######################################
+def _load_vehicle_data_cache():
+    # Called with vehicle_data_lock held.
+    global vehicle_data_cache
+    if vehicle_data_cache is None:
+        vehicle_data_cache = {}
+        if SETTINGS['vehicle_data_file']:
+            try:
+                with open(SETTINGS['vehicle_data_file'], 'r') as f:
+                    vehicle_data_cache = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+
+def _write_vehicle_data_cache():
+    # Called with vehicle_data_lock held. Like tesla_api.json, the file is
+    # replaced atomically.
+    path = SETTINGS['vehicle_data_file']
+    with open(path + '.new', 'w') as f:
+        json.dump(vehicle_data_cache, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.new', path)
+
+
+def _get_cached_vehicle_data():
+    """
+    Returns the response of the vehicle_data endpoint, which has the charge,
+    climate, drive, gui and vehicle states all in one. It is fetched at most
+    once every SETTINGS['vehicle_data_ttl'] seconds, and optionally kept in
+    SETTINGS['vehicle_data_file'] so that separate runs can share it.
+    """
+    vehicle_id = str(_current_vehicle()['id'])
+    with vehicle_data_lock:
+        _load_vehicle_data_cache()
+        cached = vehicle_data_cache.get(vehicle_id)
+
+    if (isinstance(cached, dict)
+            and 0 <= time.time() - cached['fetched_at'] < SETTINGS['vehicle_data_ttl']):
+        _log('Using vehicle data from {:.0f} seconds ago'.format(time.time() - cached['fetched_at']))
+        return cached['data']
+
+    data = _execute_request(
+        '{}/{}/vehicle_data'.format(base_url, vehicle_id)
     )
+    with vehicle_data_lock:
+        vehicle_data_cache[vehicle_id] = {
+            'fetched_at': time.time(),
+            'data': data,
+        }
+        if SETTINGS['vehicle_data_file']:
+            _write_vehicle_data_cache()
+    return data
+
+
+def _invalidate_vehicle_data():
+    """
+    Forget the vehicle's cached data, e.g. after sending a command that
+    changes it. The other vehicles' data is kept.
+    """
+    with vehicle_data_lock:
+        _load_vehicle_data_cache()
+        if (vehicle_data_cache.pop(str(_current_vehicle()['id']), None) is not None
+                and SETTINGS['vehicle_data_file']):
+            _write_vehicle_data_cache()
+
+
+def _get_vehicle_data_section(section):
+    """
+    Returns one of the states included in the vehicle data, in the same
+    shape as the corresponding data_request endpoint would.
+    """
+    return {'response': _get_cached_vehicle_data()['response'][section]}
+
+
+def _lookup_vehicle_data_field(response, name):
+    # A field is either a dotted path like 'charge_state.battery_level', or
+    # a bare name that is looked up in each of the states in turn.
+    if '.' in name:
+        value = response
+        for key in name.split('.'):
+            value = value[key]
+        return value
+    if name in response:
+        return response[name]
+    for section in response.values():
+        if isinstance(section, dict) and name in section:
+            return section[name]
+    raise KeyError(name)
 
 
 ######################################
 # Custom Functions
 ######################################
+def get_fields(names):
+    """
+    Gets several vehicle data fields with a single request, e.g.
+    --arguments names:locked+sentry_mode+charge_state.battery_level
+    :return: one 'name=value' line per field
+    """
+    response = _get_cached_vehicle_data()['response']
+    lines = []
+    for name in names.split('+'):
+        try:
+            value = _lookup_vehicle_data_field(response, name)
+        except (KeyError, TypeError):
+            _error('Unknown vehicle data field: {}'.format(name))
+            sys.exit(1)
+        lines.append('{}={}'.format(name, value))
+    return '\n'.join(lines)
+
+
 def get_odometer():
     data = get_vehicle_state()
     return int(data['response']['odometer'])
@@ -365,6 +909,8 @@ This accesses the streaming endpoint, but doesn't
 stick around to wait for continuous results.
 '''
 def streaming_ping():
+    import base64
+
     # the car needs to be awake for the streaming endpoint to work
     wake_up_vehicle()
 
@@ -377,10 +923,18 @@ def streaming_ping():
       'Sec-WebSocket-Version': '13',
     }
 
-    url = 'https://streaming.vn.teslamotors.com/connect/{}'.format(tesla_api_json['vehicle_id'])
+    url = 'https://streaming.vn.teslamotors.com/connect/{}'.format(_current_vehicle()['vehicle_id'])
 
     _log("Sending streaming request")
-    response = requests.get(url, headers=headers, stream=True)
+    response = _get_session().get(
+        url,
+        headers=headers,
+        stream=True,
+        timeout=(SETTINGS['connect_timeout'], SETTINGS['read_timeout'])
+    )
+    # The upgraded connection can't be reused for anything else, so give it
+    # back rather than leaving it open in the pool.
+    response.close()
     if not response:
         _error("Fatal Error: Tesla REST Service failed to return a response, access token may have expired")
         sys.exit(1)
@@ -388,6 +942,80 @@ def streaming_ping():
     return response
 
 
+######################################
+# Keep Awake
+######################################
+async def _subscribe_to_stream(websocket):
+    import asyncio
+
+    token = await asyncio.get_running_loop().run_in_executor(None, _get_api_token)
+    await websocket.send(json.dumps({
+        'msg_type': 'data:subscribe_oauth',
+        'token': token,
+        'value': 'speed,odometer,soc,elevation,est_heading,est_lat,est_lng,power,shift_state,range,est_range,heading',
+        'tag': str(_current_vehicle()['vehicle_id']),
+    }))
+    _log('Subscribed to streaming data for Vehicle (ID:{})'.format(_current_vehicle()['id']))
+
+
+async def _wake_up_vehicle_async():
+    # _wake_up_vehicle() blocks, so run it on a worker thread. It exits with
+    # SystemExit when the car doesn't wake up, which is passed back here.
+    import asyncio
+
+    vehicle_online_until.pop(_current_vehicle()['id'], None)
+    await asyncio.get_running_loop().run_in_executor(None, _wake_up_vehicle)
+
+
+async def _keep_awake():
+    """
+    Keep the car awake by holding a single streaming websocket connection open
+    and staying subscribed to its data. The websockets library answers the
+    server's pings and sends its own. When the connection drops or the car
+    goes to sleep anyway, the car is woken up again and the connection is
+    reestablished, with exponential backoff between attempts.
+    """
+    import asyncio
+    import websockets
+
+    delay = SETTINGS['wake_initial_delay']
+    while True:
+        connected_at = None
+        try:
+            await _wake_up_vehicle_async()
+            _log('Connecting to {}'.format(SETTINGS['streaming_url']))
+            async with websockets.connect(
+                    SETTINGS['streaming_url'],
+                    open_timeout=SETTINGS['connect_timeout'],
+                    ping_interval=30,
+                    ping_timeout=SETTINGS['read_timeout']) as websocket:
+                connected_at = time.time()
+                await _subscribe_to_stream(websocket)
+                async for message in websocket:
+                    message = json.loads(message)
+                    if message.get('msg_type') != 'data:error':
+                        continue
+                    _log('Streaming error: {}'.format(message))
+                    if message.get('error_type') == 'vehicle_disconnected':
+                        # The car fell asleep or lost its connection, so
+                        # wake it up and subscribe again on the same socket.
+                        await _wake_up_vehicle_async()
+                        await _subscribe_to_stream(websocket)
+                    else:
+                        break
+        except (SystemExit, OSError, ValueError, asyncio.TimeoutError,
+                websockets.exceptions.WebSocketException) as e:
+            _error('Streaming connection failed: {}'.format(str(e) or type(e).__name__))
+
+        # Start over with short delays if the connection was good for a while.
+        if connected_at and time.time() - connected_at > 60:
+            delay = SETTINGS['wake_initial_delay']
+        sleep_time = random.uniform(delay / 2, delay)
+        _log('Reconnecting in {:.1f} seconds'.format(sleep_time))
+        await asyncio.sleep(sleep_time)
+        delay = min(delay * 2, SETTINGS['keep_awake_max_delay'])
+
+
 ######################################
 # API POST Functions
 ######################################
@@ -397,14 +1025,15 @@ def wake_up_vehicle():
 
 def set_charge_limit(percent):
     return _execute_request(
-        '{}/{}/command/set_charge_limit'.format(base_url, tesla_api_json['id']),
+        '{}/{}/command/set_charge_limit'.format(base_url, _current_vehicle()['id']),
         method='POST',
-        data={'percent': percent}
+        data={'percent': percent},
+        idempotent=True
     )
 
 def actuate_trunk():
     result = _execute_request(
-        '{}/{}/command/actuate_trunk'.format(base_url, tesla_api_json['id']),
+        '{}/{}/command/actuate_trunk'.format(base_url, _current_vehicle()['id']),
         method='POST',
         data={'which_trunk': 'rear'}
     )
@@ -412,7 +1041,7 @@ def actuate_trunk():
 
 def actuate_frunk():
     result = _execute_request(
-        '{}/{}/command/actuate_trunk'.format(base_url, tesla_api_json['id']),
+        '{}/{}/command/actuate_trunk'.format(base_url, _current_vehicle()['id']),
         method='POST',
         data={'which_trunk': 'front'}
     )
@@ -420,7 +1049,7 @@ def actuate_frunk():
 
 def flash_lights():
     result = _execute_request(
-        '{}/{}/command/flash_lights'.format(base_url, tesla_api_json['id']),
+        '{}/{}/command/flash_lights'.format(base_url, _current_vehicle()['id']),
         method='POST'
     )
     return result['response']['result']
@@ -433,9 +1062,10 @@ def set_sentry_mode(enabled: bool):
     """
     _log("Setting Sentry Mode Enabled: {}".format(enabled))
     result = _execute_request(
-        '{}/{}/command/set_sentry_mode'.format(base_url, tesla_api_json['id']),
+        '{}/{}/command/set_sentry_mode'.format(base_url, _current_vehicle()['id']),
         method='POST',
-        data={'on': enabled}
+        data={'on': enabled},
+        idempotent=True
     )
     return result['response']['result']
 
@@ -477,19 +1107,22 @@ def toggle_sentry_mode():
 # Utility Functions
 ######################################
 def _get_api_functions():
-    # Build the list of available Tesla API function names by getting the
-    # callables from globals() and skipping the non-API functions.
-    non_api_names = ['main', 'pprint', 'datetime', 'timedelta']
-    function_names = []
-    for name, func in globals().items():
-        if (callable(func)
+    """
+    Returns the sorted list of API function names that can be called from the
+    command line. It is built once, on first use.
+    """
+    global api_functions
+    if api_functions is None:
+        # Build the list of available Tesla API function names by getting the
+        # callables from globals() and skipping the non-API functions.
+        non_api_names = ['main', 'datetime', 'timedelta']
+        api_functions = sorted(
+            name for name, func in globals().items()
+            if (callable(func)
                 and not name.startswith('_')
-                and name not in non_api_names):
-            function_names.append(name)
-    function_names.sort()
-    function_names_string = '\n'.join(function_names)
-
-    return function_names_string
+                and name not in non_api_names)
+        )
+    return api_functions
 
 
 def _get_arg_parser():
@@ -497,7 +1130,8 @@ def _get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'function',
-        help="The name of the function to run. Available functions are:\n {}".format(_get_api_functions()))
+        nargs='?',
+        help="The name of the function to run. Available functions are:\n {}".format('\n'.join(_get_api_functions())))
     parser.add_argument(
         '--arguments',
         help="Add arguments to the function by passing comma-separated key:value pairs."
@@ -519,15 +1153,464 @@ def _get_arg_parser():
         "--name",
         help="name of the car."
     )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Seconds to wait for a response from the Tesla servers."
+    )
+    parser.add_argument(
+        "--data_ttl",
+        type=float,
+        help="Seconds for which vehicle data is reused between calls."
+    )
+    parser.add_argument(
+        "--batch",
+        help="Run a ';'-separated sequence of functions, each optionally followed by "
+             "'if [not] <function>', and print one tab-separated result line per step."
+    )
+    parser.add_argument(
+        "--fleet",
+        help="Run the function for several vehicles at once: 'all', or a comma-separated list of "
+             "VINs or names. One tab-separated result line is printed per vehicle."
+    )
+    parser.add_argument(
+        "--keep_awake",
+        action="store_true",
+        help="Keep the car awake by holding a streaming connection open until killed."
+    )
+    parser.add_argument(
+        "--streaming_url",
+        help="URL of the streaming server used by --keep_awake."
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Stay resident and serve function calls on {}.".format(socket_path)
+    )
+    parser.add_argument(
+        "--no-daemon",
+        dest="use_daemon",
+        action="store_false",
+        help="Don't forward the call to a running daemon."
+    )
 
     return parser
 
 
+def _parse_function_arguments(arguments):
+    # Turn the comma-separated key:value pairs from --arguments into a dict.
+    kwargs = {}
+    if arguments:
+        for kwarg_string in [arg.strip() for arg in arguments.split(',')]:
+            key, value = kwarg_string.split(':')
+            kwargs[key] = value
+    return kwargs
+
+
+def _print_result(result):
+    # Write the output of the API call to stdout, if DEBUG is true.
+    is_json = False
+    try:
+        # check to see if result is json
+        if isinstance(result, str):
+            json.loads(result)
+            is_json = True
+    except ValueError as e:
+        pass
+
+    if is_json:
+        _log(json.dumps(result, indent=2))
+    else:
+        print(result, flush=True)
+
+
+def _call_function(name, kwargs):
+    """
+    Look up an API function by name and call it with the given arguments.
+    """
+    # Render the arguments as a POST body.
+    kwargs_string = ''
+    if kwargs:
+        kwargs_string = ', '.join(
+            '{}={}'.format(key, value) for key, value in kwargs.items()
+        )
+
+    # We need to call this before calling any API function, because those need
+    # to know the ID before they call _execute_request()
+    _get_id()
+
+    # Get the function by name from the globals() dict and call it with the
+    # specified args.
+    function = globals()[name]
+    _log('Calling {}({})...'.format(name, kwargs_string))
+    return function(**kwargs)
+
+
+######################################
+# Batch Mode
+######################################
+def _parse_batch_step(step):
+    """
+    Parse one step of a batch, which looks like
+      function [key:value,...] [if [not] condition_function]
+    :return: (function name, kwargs, condition function name, negate)
+    """
+    words = step.split()
+    condition = None
+    negate = False
+    if 'if' in words:
+        index = words.index('if')
+        condition_words = words[index + 1:]
+        words = words[:index]
+        if condition_words and condition_words[0] == 'not':
+            negate = True
+            condition_words = condition_words[1:]
+        if len(condition_words) != 1:
+            raise ValueError('Invalid condition in batch step: {}'.format(step))
+        condition = condition_words[0]
+    if not 1 <= len(words) <= 2:
+        raise ValueError('Invalid batch step: {}'.format(step))
+
+    for name in (words[0], condition):
+        if name is not None and name not in _get_api_functions():
+            raise ValueError('Unknown function in batch step: {}'.format(name))
+
+    kwargs = _parse_function_arguments(words[1] if len(words) == 2 else None)
+    return words[0], kwargs, condition, negate
+
+
+def _run_batch(batch):
+    """
+    Run a ';'-separated sequence of functions, for example
+      is_sentry_mode_enabled; enable_sentry_mode if not is_sentry_mode_enabled
+    The vehicle is only woken once, and vehicle data is shared between the
+    steps. For each step, a tab-separated line with the function name, a
+    status ('ok', 'skipped', 'failed', or 'error' with the exception as the
+    result) and the result is printed. The batch stops at the first step that
+    failed or raised an error.
+    :return: the exit code, 0 if all steps succeeded
+    """
+    try:
+        steps = [_parse_batch_step(step) for step in batch.split(';') if step.strip()]
+    except ValueError as e:
+        _error(str(e))
+        return 1
+
+    for name, kwargs, condition, negate in steps:
+        try:
+            if condition and bool(_call_function(condition, {})) == negate:
+                print('{}\tskipped\t'.format(name), flush=True)
+                continue
+            result = _call_function(name, kwargs)
+        except SystemExit:
+            print('{}\tfailed\t'.format(name), flush=True)
+            return 1
+        except Exception as e:
+            print('{}\terror\t{}: {}'.format(name, type(e).__name__, str(e).replace('\n', ' ')), flush=True)
+            return 1
+        print('{}\tok\t{}'.format(name, str(result).replace('\n', ' ')), flush=True)
+
+    return 0
+
+
+######################################
+# Fleet Mode
+######################################
+def _list_fleet(refresh=False):
+    """
+    Returns the vehicles on the account, as dicts with their 'id',
+    'vehicle_id', 'vin' and 'display_name'. The list is kept in
+    tesla_api_json, and only fetched again once it's older than
+    SETTINGS['fleet_list_ttl'] seconds, or when refresh is True.
+    """
+    listed_at = tesla_api_json.get('vehicles_listed_at', 0)
+    if (refresh or not tesla_api_json.get('vehicles')
+            or not 0 <= time.time() - listed_at < SETTINGS['fleet_list_ttl']):
+        result = list_vehicles()
+        tesla_api_json['vehicles'] = [
+            {
+                'id': vehicle_dict['id_s'],
+                'vehicle_id': vehicle_dict['vehicle_id'],
+                'vin': vehicle_dict['vin'],
+                'display_name': vehicle_dict['display_name'],
+            }
+            for vehicle_dict in result['response']
+        ]
+        tesla_api_json['vehicles_listed_at'] = int(time.time())
+        _write_tesla_api_json()
+    return tesla_api_json['vehicles']
+
+
+def _select_fleet(selection):
+    """
+    :param selection: 'all', or a comma-separated list of VINs and/or names
+    :return: the selected vehicles, in the order they were given
+    """
+    wanted = [] if selection == 'all' else [word.strip() for word in selection.split(',') if word.strip()]
+    # If a vehicle isn't in the cached list, it may have been added to the
+    # account since, so look again before giving up.
+    for refresh in (False, True):
+        vehicles = _list_fleet(refresh)
+        if not wanted:
+            return vehicles
+        selected = []
+        missing = []
+        for word in wanted:
+            matches = [vehicle for vehicle in vehicles if word in (vehicle['vin'], vehicle['display_name'])]
+            if matches:
+                selected.extend(vehicle for vehicle in matches if vehicle not in selected)
+            else:
+                missing.append(word)
+        if not missing:
+            return selected
+
+    _error('Unable to find vehicles: Unknown name or VIN: {}'.format(', '.join(missing)))
+    sys.exit(1)
+
+
+def _run_on_fleet(name, kwargs, vehicles):
+    """
+    Call an API function for each of the given vehicles at the same time, so
+    that e.g. waking several cars takes as long as waking the slowest one.
+    The access token, session and vehicle list are shared, while each thread
+    sets fleet_context to the vehicle it acts on.
+    :return: list of (vehicle, True if the call succeeded, result), in the
+             order of vehicles
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(vehicle):
+        fleet_context.vehicle = vehicle
+        try:
+            return vehicle, True, _call_function(name, kwargs)
+        except SystemExit:
+            # The function already printed why.
+            return vehicle, False, ''
+        except Exception as e:
+            _error('Vehicle (ID:{}): {}: {}'.format(vehicle['id'], type(e).__name__, e))
+            return vehicle, False, '{}: {}'.format(type(e).__name__, e)
+        finally:
+            fleet_context.vehicle = None
+
+    workers = max(1, min(len(vehicles), SETTINGS['fleet_max_workers']))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(call, vehicles))
+
+
+def _run_fleet(name, kwargs, selection):
+    """
+    Run a function for several vehicles at once, for example
+      tesla_api.py --fleet all enable_sentry_mode
+    and print a tab-separated line with each vehicle's VIN, name, status
+    ('ok' or 'failed') and the result.
+    :return: the exit code, 0 if the function succeeded for all vehicles
+    """
+    vehicles = _select_fleet(selection)
+    exit_code = 0
+    for vehicle, succeeded, result in _run_on_fleet(name, kwargs, vehicles):
+        print('{}\t{}\t{}\t{}'.format(
+            vehicle['vin'], vehicle['display_name'], 'ok' if succeeded else 'failed',
+            str(result).replace('\n', ' ')), flush=True)
+        if not succeeded:
+            exit_code = 1
+    return exit_code
+
+
+######################################
+# Daemon
+######################################
+class _RequestOutput:
+    """
+    Stands in for sys.stdout or sys.stderr in the daemon. Output from the
+    thread handling a request goes into that request's reply, while output
+    from the background threads still goes to the daemon's own log.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def capture(self):
+        self._local.buffer = io.StringIO()
+        try:
+            yield self._local.buffer
+        finally:
+            self._local.buffer = None
+
+    def _target(self):
+        buffer = getattr(self._local, 'buffer', None)
+        return self._stream if buffer is None else buffer
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _handle_daemon_request(rfile, wfile):
+    """
+    Handles one call from a tesla_api.py client. The request is a single line
+    of JSON naming the function, its arguments and the caller's settings. The
+    reply is a single line of JSON with the stdout and stderr output the call
+    would have produced if run directly, and its exit code.
+    """
+    request = json.loads(rfile.readline().decode('utf-8'))
+
+    # Only the API functions may be called, not the helpers around them.
+    if not request.get('batch') and request.get('function') not in _get_api_functions():
+        reply = {'stdout': '', 'stderr': 'unknown function: {}\n'.format(request.get('function')), 'exit_code': 1}
+        wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+        return
+
+    SETTINGS['DEBUG'] = request.get('debug', False)
+    SETTINGS['tesla_vin'] = request.get('vin', '')
+    SETTINGS['tesla_name'] = request.get('name', '')
+    SETTINGS['read_timeout'] = request.get('read_timeout', SETTINGS['read_timeout'])
+    SETTINGS['vehicle_data_ttl'] = request.get('data_ttl', SETTINGS['vehicle_data_ttl'])
+
+    exit_code = 0
+    with sys.stdout.capture() as out, sys.stderr.capture() as err:
+        try:
+            _reload_tesla_api_json_if_changed()
+            if request.get('batch'):
+                exit_code = _run_batch(request['batch'])
+            elif request.get('fleet'):
+                exit_code = _run_fleet(request['function'], request.get('arguments', {}), request['fleet'])
+            else:
+                _print_result(_call_function(request['function'], request.get('arguments', {})))
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            _error('{}: {}'.format(type(e).__name__, e))
+            exit_code = 1
+
+    reply = {'stdout': out.getvalue(), 'stderr': err.getvalue(), 'exit_code': exit_code}
+    wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+def _serve():
+    """
+    Keep the token and vehicle ID in memory and run API functions on behalf of
+    clients connecting to socket_path. Requests are handled one at a time,
+    since they all share the global state of this module.
+    """
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            _handle_daemon_request(self.rfile, self.wfile)
+
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+
+    # Run the daemon with debug output if it was started with --debug,
+    # regardless of what the clients ask for.
+    daemon_debug = SETTINGS['DEBUG']
+    vin = SETTINGS['tesla_vin']
+    name = SETTINGS['tesla_name']
+    read_timeout = SETTINGS['read_timeout']
+    data_ttl = SETTINGS['vehicle_data_ttl']
+
+    # Only root should be able to drive the car through the socket.
+    old_umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, RequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    sys.stdout = _RequestOutput(sys.stdout)
+    sys.stderr = _RequestOutput(sys.stderr)
+    threading.Thread(target=_refresh_access_token_in_background, daemon=True).start()
+
+    _error('tesla_api.py daemon listening on {}'.format(socket_path))
+    try:
+        with server:
+            while True:
+                server.handle_request()
+                SETTINGS['DEBUG'] = daemon_debug
+                SETTINGS['tesla_vin'] = vin
+                SETTINGS['tesla_name'] = name
+                SETTINGS['read_timeout'] = read_timeout
+                SETTINGS['vehicle_data_ttl'] = data_ttl
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+
+
+def _call_daemon(function, kwargs, batch=None, fleet=None):
+    """
+    Forward a call, or a batch of calls, to a running daemon and reproduce
+    its output.
+    :return: the exit code of the call, or None if no daemon is running, or
+             it didn't accept the call in time
+    """
+    request = {
+        'function': function,
+        'arguments': kwargs,
+        'batch': batch,
+        'fleet': fleet,
+        'debug': SETTINGS['DEBUG'],
+        'vin': SETTINGS['tesla_vin'],
+        'name': SETTINGS['tesla_name'],
+        'read_timeout': SETTINGS['read_timeout'],
+        'data_ttl': SETTINGS['vehicle_data_ttl'],
+    }
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(SETTINGS['daemon_connect_timeout'])
+            try:
+                sock.connect(socket_path)
+                sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            except socket.timeout:
+                return None
+            # The call was sent, so from here on running it again directly
+            # could do it twice.
+            sock.settimeout(SETTINGS['daemon_timeout'])
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    except socket.timeout:
+        _error('tesla_api.py daemon did not answer within {} seconds'.format(SETTINGS['daemon_timeout']))
+        return 1
+
+    if not line:
+        # The daemon went away while handling the call.
+        return None
+
+    reply = json.loads(line.decode('utf-8'))
+    sys.stdout.write(reply['stdout'])
+    sys.stdout.flush()
+    sys.stderr.write(reply['stderr'])
+    sys.stderr.flush()
+    return reply['exit_code']
+
+
 ######################################
 # MAIN
 ######################################
 def main():
-    args = _get_arg_parser().parse_args()
+    parser = _get_arg_parser()
+    args = parser.parse_args()
+    if not args.function and not args.daemon and not args.batch and not args.keep_awake:
+        parser.error('the following arguments are required: function')
+    if args.function and args.function not in _get_api_functions():
+        parser.error('unknown function: {}'.format(args.function))
+    if args.fleet and (not args.function or args.batch or args.keep_awake or args.daemon):
+        parser.error('--fleet needs a function, and works with neither --batch, --keep_awake nor --daemon')
+
+    # These allow running against a local stand-in for the Tesla servers,
+    # e.g. tools/mock_owner_api.py.
+    global base_url, auth_url, mutable_dir, socket_path
+    base_url = os.environ.get('TESLA_API_BASE_URL', base_url)
+    auth_url = os.environ.get('TESLA_API_AUTH_URL', auth_url)
+    mutable_dir = os.environ.get('TESLA_API_MUTABLE_DIR', mutable_dir)
+    socket_path = os.environ.get('TESLA_API_SOCKET', socket_path)
 
     SETTINGS['DEBUG'] = args.debug
     SETTINGS['REFRESH_TOKEN'] = args.refresh_token
@@ -547,6 +1630,35 @@ def main():
     else:
         SETTINGS['tesla_name'] = os.environ.get('TESLA_NAME', '')
 
+    if args.timeout:
+        SETTINGS['read_timeout'] = args.timeout
+    elif os.environ.get('TESLA_API_TIMEOUT'):
+        SETTINGS['read_timeout'] = float(os.environ['TESLA_API_TIMEOUT'])
+
+    if os.environ.get('TESLA_API_BUDGET'):
+        SETTINGS['request_budget'] = float(os.environ['TESLA_API_BUDGET'])
+
+    if args.data_ttl is not None:
+        SETTINGS['vehicle_data_ttl'] = args.data_ttl
+    elif os.environ.get('TESLA_API_DATA_TTL'):
+        SETTINGS['vehicle_data_ttl'] = float(os.environ['TESLA_API_DATA_TTL'])
+    SETTINGS['vehicle_data_file'] = os.environ.get('TESLA_API_DATA_FILE', '')
+
+    # Apply any arguments that the user may have provided.
+    kwargs = _parse_function_arguments(args.arguments)
+
+    if args.streaming_url:
+        SETTINGS['streaming_url'] = args.streaming_url
+
+    # If a daemon is running, let it make the call with its already loaded
+    # token and vehicle ID. A new refresh token has to be handled here, since
+    # the daemon wouldn't know about it.
+    if (not args.daemon and not args.keep_awake
+            and args.use_daemon and not args.refresh_token):
+        exit_code = _call_daemon(args.function, kwargs, args.batch, args.fleet)
+        if exit_code is not None:
+            sys.exit(exit_code)
+
     # We call this now so DEBUG will be set correctly.
     _load_tesla_api_json()
 
@@ -554,43 +1666,33 @@ def main():
         tesla_api_json['refresh_token'] = SETTINGS['refresh_token']
         _write_tesla_api_json()
 
-    # Apply any arguments that the user may have provided.
-    kwargs = {}
-    if args.arguments:
-        for kwarg_string in [arg.strip() for arg in args.arguments.split(',')]:
-            key, value = kwarg_string.split(':')
-            kwargs[key] = value
-    # Render the arguments as a POST body.
-    kwargs_string = ''
-    if kwargs:
-        kwargs_string = ', '.join(
-            '{}={}'.format(key, value) for key, value in kwargs.items()
-        )
-
-    # We need to call this before calling any API function, because those need
-    # to know the ID before they call _execute_request()
-    _get_id()
-
-    # Get the function by name from the globals() dict and call it with the
-    # specified args.
-    function = globals()[args.function]
-    _log('Calling {}({})...'.format(args.function, kwargs_string))
-    result = function(**kwargs)
+    if args.daemon:
+        _serve()
+        return
 
-    # Write the output of the API call to stdout, if DEBUG is true.
-    is_json = False
-    try:
-        # check to see if result is json
-        if isinstance(result, str):
-            json.loads(result)
-            is_json = True
-    except ValueError as e:
-        pass
+    if args.batch:
+        sys.exit(_run_batch(args.batch))
+
+    if args.fleet:
+        sys.exit(_run_fleet(args.function, kwargs, args.fleet))
+
+    if args.keep_awake:
+        try:
+            import websockets
+        except ImportError:
+            _error('--keep_awake needs the websockets package')
+            sys.exit(1)
+        # Older ones, e.g. the one Raspbian packages, lack open_timeout.
+        if int(websockets.version.version.split('.')[0]) < 10:
+            _error('--keep_awake needs websockets 10 or later, not {}'.format(websockets.version.version))
+            sys.exit(1)
+        import asyncio
+
+        _get_id()
+        asyncio.run(_keep_awake())
+        return
 
-    if is_json:
-        _log(json.dumps(result, indent=2))
-    else:
-        print(result, flush=True)
+    _print_result(_call_function(args.function, kwargs))
 
 
 main()
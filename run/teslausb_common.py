@@ -0,0 +1,38 @@
+"""
+Helpers shared by the Python scripts in /root/bin.
+"""
+import os
+import sys
+import time
+
+
+def log(message):
+    """
+    Print a message to stderr, with a timestamp in the format archiveloop's
+    log() uses, since the output usually ends up in archiveloop.log.
+    """
+    print('{}: {}'.format(time.strftime('%a %d %b %H:%M:%S %Z %Y'), message), file=sys.stderr, flush=True)
+
+
+def read_lines(path):
+    """
+    :return: iterator over the lines of the file that aren't blank, without
+             their line endings
+    """
+    with open(path, 'r', errors='surrogateescape') as f:
+        for line in f:
+            if line.strip():
+                yield line.rstrip('\n')
+
+
+def write_atomically(path, content):
+    """
+    Replace the file with one that has the given content, such that losing
+    power halfway through leaves either the old or the new file behind, and
+    never a truncated one.
+    """
+    with open(path + '.new', 'w', errors='surrogateescape') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.new', path)
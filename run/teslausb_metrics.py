@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Collects teslausb's status and metrics, so that the web UI's status requests
+don't each have to look at the snapshots and disks themselves.
+
+Usage:
+  teslausb_metrics.py sample [--interval 10]
+      Keep sampling the status, and write it to /tmp/teslausb_status.json
+      (in the format of cgi-bin/status.sh) and /tmp/teslausb_metrics.prom
+      (in the Prometheus text format).
+  teslausb_metrics.py add <name>=<value>...
+      Add to counters, which are kept in /mutable so they survive reboots.
+  teslausb_metrics.py set <name>=<value>...
+      Set values that are kept along with the counters.
+"""
+import argparse
+import fcntl
+import json
+import os
+import signal
+import sys
+import time
+
+from teslausb_common import write_atomically
+
+COUNTERS_FILE = '/mutable/teslausb_counters.json'
+ARCHIVE_PROGRESS_FILE = '/tmp/archive_progress.json'
+STATUS_FILE = '/tmp/teslausb_status.json'
+METRICS_FILE = '/tmp/teslausb_metrics.prom'
+
+SNAPSHOTS_DIR = '/backingfiles/snapshots'
+CAM_DISK = '/backingfiles/cam_disk.bin'
+GADGET_DIR = '/sys/kernel/config/usb_gadget/teslausb'
+TEMPERATURE_FILE = '/sys/class/thermal/thermal_zone0/temp'
+
+# name in COUNTERS_FILE -> (Prometheus name, type, help)
+COUNTERS = {
+    'archived_bytes': ('teslausb_archived_bytes_total', 'counter', 'Bytes of clips archived.'),
+    'archived_files': ('teslausb_archived_files_total', 'counter', 'Number of clips archived.'),
+    'archive_runs': ('teslausb_archive_runs_total', 'counter', 'Number of times clips were archived.'),
+    'archive_seconds': ('teslausb_archive_duration_seconds_total', 'counter', 'Time spent archiving clips.'),
+    'last_archive_seconds': ('teslausb_last_archive_duration_seconds', 'gauge', 'Duration of the last archive run.'),
+    'snapshots_taken': ('teslausb_snapshots_taken_total', 'counter', 'Number of snapshots taken.'),
+    'snapshot_seconds': ('teslausb_snapshot_duration_seconds_total', 'counter', 'Time spent taking snapshots.'),
+    'last_snapshot_seconds': ('teslausb_last_snapshot_duration_seconds', 'gauge',
+                              'Time it took to take the last snapshot.'),
+}
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_counters(add=None, values=None):
+    """
+    :param add: dict of counter name to amount to add
+    :param values: dict of name to value to set
+    """
+    with open(COUNTERS_FILE + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        counters = _read_json(COUNTERS_FILE)
+        for name, value in (add or {}).items():
+            counters[name] = counters.get(name, 0) + value
+        counters.update(values or {})
+        write_atomically(COUNTERS_FILE, json.dumps(counters))
+
+
+def set_archive_progress(**progress):
+    write_atomically(ARCHIVE_PROGRESS_FILE, json.dumps(progress))
+
+
+######################################
+# Sampling
+######################################
+def _read_first_word(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return ''
+
+
+def sample_status():
+    """
+    :return: dict with the same (string) values status.sh returns
+    """
+    snapshots = []
+    try:
+        for name in sorted(os.listdir(SNAPSHOTS_DIR)):
+            try:
+                snapshots.append(int(os.stat(os.path.join(SNAPSHOTS_DIR, name, 'snap.bin')).st_mtime))
+            except OSError:
+                pass
+    except OSError:
+        pass
+
+    try:
+        fs = os.statvfs(CAM_DISK)
+        total_space = str(fs.f_blocks * fs.f_frsize)
+        free_space = str(fs.f_bfree * fs.f_frsize)
+    except OSError:
+        total_space = free_space = ''
+
+    return {
+        'cpu_temp': _read_first_word(TEMPERATURE_FILE),
+        'num_snapshots': str(len(snapshots)),
+        'snapshot_oldest': str(snapshots[0]) if snapshots else '',
+        'snapshot_newest': str(snapshots[-1]) if snapshots else '',
+        'total_space': total_space,
+        'free_space': free_space,
+        'uptime': _read_first_word('/proc/uptime'),
+        'drives_active': 'yes' if os.path.exists(GADGET_DIR) else 'no',
+    }
+
+
+def format_metrics(status, progress, counters):
+    lines = []
+
+    def metric(name, metric_type, help_text, value):
+        if value in ('', None):
+            return
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        lines.append('{} {}'.format(name, value))
+
+    temperature = status['cpu_temp']
+    metric('teslausb_cpu_temperature_celsius', 'gauge', 'CPU temperature.',
+           int(temperature) / 1000 if temperature else None)
+    metric('teslausb_snapshots', 'gauge', 'Number of snapshots.', status['num_snapshots'])
+    metric('teslausb_snapshot_oldest_timestamp_seconds', 'gauge', 'When the oldest snapshot was taken.',
+           status['snapshot_oldest'])
+    metric('teslausb_snapshot_newest_timestamp_seconds', 'gauge', 'When the newest snapshot was taken.',
+           status['snapshot_newest'])
+    metric('teslausb_backingfiles_size_bytes', 'gauge', 'Size of the backingfiles filesystem.', status['total_space'])
+    metric('teslausb_backingfiles_free_bytes', 'gauge', 'Free space on the backingfiles filesystem.',
+           status['free_space'])
+    metric('teslausb_uptime_seconds', 'gauge', 'System uptime.', status['uptime'])
+    metric('teslausb_drives_active', 'gauge', 'Whether the car can see the drives.',
+           1 if status['drives_active'] == 'yes' else 0)
+
+    metric('teslausb_archive_in_progress', 'gauge', 'Whether clips are being archived.',
+           1 if progress.get('in_progress') else 0)
+    metric('teslausb_archive_files', 'gauge', 'Number of clips in the current or last archive run.',
+           progress.get('files_total'))
+    metric('teslausb_archive_files_done', 'gauge', 'Number of clips archived so far in the current or last run.',
+           progress.get('files_done'))
+    metric('teslausb_archive_bytes_done', 'gauge', 'Bytes archived so far in the current or last run.',
+           progress.get('bytes_done'))
+
+    for name, (prometheus_name, metric_type, help_text) in COUNTERS.items():
+        metric(prometheus_name, metric_type, help_text, counters.get(name, 0))
+    return '\n'.join(lines) + '\n'
+
+
+def sample_once():
+    status = sample_status()
+    progress = _read_json(ARCHIVE_PROGRESS_FILE)
+    counters = _read_json(COUNTERS_FILE)
+    write_atomically(STATUS_FILE, json.dumps(status, indent=3))
+    write_atomically(METRICS_FILE, format_metrics(status, progress, counters))
+
+
+def run_sampler(interval):
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            sample_once()
+            time.sleep(interval)
+    finally:
+        # Don't let status.sh serve values that are no longer being updated.
+        for path in (STATUS_FILE, METRICS_FILE):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _parse_values(values):
+    result = {}
+    for value in values:
+        name, _, number = value.partition('=')
+        result[name] = float(number) if '.' in number else int(number)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sample_parser = subparsers.add_parser('sample')
+    sample_parser.add_argument('--interval', type=float, default=10, help='Seconds between samples.')
+    add_parser = subparsers.add_parser('add')
+    add_parser.add_argument('values', nargs='+', metavar='name=value')
+    set_parser = subparsers.add_parser('set')
+    set_parser.add_argument('values', nargs='+', metavar='name=value')
+    args = parser.parse_args()
+
+    if args.command == 'sample':
+        run_sampler(args.interval)
+    elif args.command == 'add':
+        update_counters(add=_parse_values(args.values))
+    else:
+        update_counters(values=_parse_values(args.values))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
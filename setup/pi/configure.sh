@@ -161,7 +161,7 @@ function install_and_configure_tesla_api () {
     log_progress "Updating tesla_api.py"
     get_script /root/bin tesla_api.py run
     install_python3_pip
-    pip3 install teslapy
+    pip3 install teslapy 'websockets>=10'
     # check if the json file needs to be updated
     readonly json=/mutable/tesla_api.json
     if [ -e $json ] && ! grep -q '"id"' $json
@@ -180,7 +180,7 @@ function install_and_configure_tesla_api () {
     log_progress "Installing tesla_api.py"
     get_script /root/bin tesla_api.py run
     install_python3_pip
-    pip3 install teslapy
+    pip3 install teslapy 'websockets>=10'
     # Perform the initial authentication
     mount /mutable || log_progress "Failed to mount /mutable"
     if ! /root/bin/tesla_api.py list_vehicles
@@ -198,7 +198,12 @@ function install_archive_scripts () {
 
   log_progress "Installing base archive scripts into $install_path"
   get_script "$install_path" archiveloop run
+  get_script "$install_path" archive_ledger.py run
+  get_script "$install_path" scan_clips.py run
+  get_script "$install_path" archive_scheduler.py run
   get_script "$install_path" waitforidle run
+  get_script "$install_path" idle_detector.py run
+  get_script "$install_path" clean_cam.py run
   get_script "$install_path" remountfs_rw run
   get_script "$install_path" awake_start run
   get_script "$install_path" awake_stop run
@@ -212,6 +217,7 @@ function install_archive_scripts () {
   if [ -n "${MUSIC_SHARE_NAME:+x}" ] && grep cifs <<< "$archive_module"
   then
     get_script "$install_path" copy-music.sh "$archive_module"
+    get_script "$install_path" music_sync.py "$archive_module"
   fi
 }
 
@@ -562,6 +568,12 @@ function install_push_message_scripts() {
   get_script "$install_path" send-push-message run
   get_script "$install_path" send_sns.py run
   get_script "$install_path" send_matrix.py run
+  get_script "$install_path" send_notifications.py run
+  if ! python3 -c 'import requests' &> /dev/null
+  then
+    setup_progress "Installing python requests package..."
+    apt-get --assume-yes install python3-requests
+  fi
 }
 
 if [[ $EUID -ne 0 ]]
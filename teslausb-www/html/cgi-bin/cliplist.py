@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Lists clips as JSON, from the index that /root/bin/clip_index.py maintains.
+
+Query parameters, all optional:
+  group       RecentClips, SavedClips, SentryClips or TeslaTrackMode
+  sequence    event folder (or, for RecentClips, date folder)
+  camera      e.g. front, back, left_repeater, right_repeater
+  since/until timestamps in the clip name format, e.g. 2022-01-06_10-27-31
+  order       asc or desc (default), by timestamp
+  offset      number of clips to skip
+  limit       number of clips to return (default 500, at most 5000)
+  view        "sequences" to list event/date folders, with their number of
+              files and first and last timestamp, instead of clips
+  format      "text" for all matching paths, one per line and sorted by
+              path, like videolist.sh has always returned
+
+Responses carry an ETag, so unchanged lists aren't sent again.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+from urllib.parse import parse_qs
+
+INDEX_FILE = '/mutable/clip_index.db'
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+COLUMNS = ('path', 'grp', 'sequence', 'filename', 'camera', 'timestamp', 'snapshot')
+
+
+def reply(status, body=None, etag=None):
+    sys.stdout.write('HTTP/1.0 {}\n'.format(status))
+    if etag:
+        sys.stdout.write('ETag: {}\n'.format(etag))
+        sys.stdout.write('Cache-Control: no-cache\n')
+    if body is None:
+        sys.stdout.write('\n')
+    elif isinstance(body, str):
+        sys.stdout.write('Content-type: text/plain\n\n')
+        sys.stdout.write(body)
+    else:
+        sys.stdout.write('Content-type: application/json\n\n')
+        json.dump(body, sys.stdout, separators=(',', ':'))
+
+
+def _int(params, name, default, maximum=None):
+    try:
+        value = max(0, int(params.get(name, [default])[0]))
+    except ValueError:
+        value = default
+    return min(value, maximum) if maximum is not None else value
+
+
+def query(db, params):
+    where = []
+    args = []
+    for name, column in (('group', 'grp'), ('sequence', 'sequence'), ('camera', 'camera')):
+        if name in params:
+            where.append('{} = ?'.format(column))
+            args.append(params[name][0])
+    if 'since' in params:
+        where.append('timestamp >= ?')
+        args.append(params['since'][0])
+    if 'until' in params:
+        where.append('timestamp <= ?')
+        args.append(params['until'][0])
+    where_clause = ' WHERE ' + ' AND '.join(where) if where else ''
+    if params.get('format', [''])[0] == 'text':
+        rows = db.execute('SELECT path FROM clips{} ORDER BY path'.format(where_clause), args)
+        return ''.join(path + '\n' for (path,) in rows)
+    order = 'ASC' if params.get('order', [''])[0] == 'asc' else 'DESC'
+    offset = _int(params, 'offset', 0)
+    limit = _int(params, 'limit', DEFAULT_LIMIT, MAX_LIMIT)
+
+    if params.get('view', [''])[0] == 'sequences':
+        from_clause = ('FROM (SELECT grp, sequence, COUNT(*) AS files, MIN(timestamp) AS first, '
+                       'MAX(timestamp) AS last FROM clips{} GROUP BY grp, sequence)').format(where_clause)
+        total = db.execute('SELECT COUNT(*) ' + from_clause, args).fetchone()[0]
+        rows = db.execute('SELECT * {} ORDER BY last {}, grp LIMIT ? OFFSET ?'.format(from_clause, order),
+                          args + [limit, offset])
+        items = [dict(zip(('group', 'sequence', 'files', 'first', 'last'), row)) for row in rows]
+        key = 'sequences'
+    else:
+        total = db.execute('SELECT COUNT(*) FROM clips' + where_clause, args).fetchone()[0]
+        rows = db.execute('SELECT {} FROM clips{} ORDER BY timestamp {}, path LIMIT ? OFFSET ?'.format(
+            ', '.join(COLUMNS), where_clause, order), args + [limit, offset])
+        items = [dict(zip(('path', 'group') + COLUMNS[2:], row)) for row in rows]
+        key = 'clips'
+    return {'total': total, 'offset': offset, 'limit': limit, key: items}
+
+
+def main():
+    query_string = os.environ.get('QUERY_STRING', '')
+    params = parse_qs(query_string)
+    try:
+        db = sqlite3.connect('file:{}?mode=ro'.format(INDEX_FILE), uri=True)
+        meta = dict(db.execute("SELECT key, value FROM meta WHERE key IN ('generation', 'created')"))
+        generation = meta['generation']
+    except (sqlite3.Error, KeyError):
+        # videolist.sh falls back to listing the links itself.
+        if params.get('format', [''])[0] != 'text':
+            reply('503 Service Unavailable', {'error': 'clip index is not available'})
+        return 1
+
+    try:
+        # The list only changes when the index does. The generation starts
+        # over when the index is built anew, so which index it is goes in too.
+        etag = '"{:x}-{}-{}"'.format(meta.get('created', 0), generation,
+                                     hashlib.md5(query_string.encode('utf-8')).hexdigest()[:12])
+        if os.environ.get('HTTP_IF_NONE_MATCH') == etag:
+            reply('304 Not Modified', etag=etag)
+            return 0
+        result = query(db, params)
+    finally:
+        db.close()
+    if isinstance(result, dict):
+        result['generation'] = generation
+    reply('200 OK', result, etag)
+    return 0
+
+
+sys.exit(main())
@@ -0,0 +1,24 @@
+#!/bin/bash
+
+# Prometheus-style metrics, kept up to date by teslausb_metrics.py (every 10
+# seconds by default), and not served once they haven't been for a while.
+readonly max_metrics_age=60
+if [[ ! -r /tmp/teslausb_metrics.prom ]] ||
+   ! metrics_time=$(stat --format="%Y" /tmp/teslausb_metrics.prom 2> /dev/null) ||
+   (( $(printf '%(%s)T' -1) - metrics_time >= max_metrics_age ))
+then
+  cat << EOF
+HTTP/1.0 503 Service Unavailable
+Content-type: text/plain
+
+metrics are not available
+EOF
+  exit 0
+fi
+
+cat << EOF
+HTTP/1.0 200 OK
+Content-type: text/plain; version=0.0.4
+
+EOF
+cat /tmp/teslausb_metrics.prom
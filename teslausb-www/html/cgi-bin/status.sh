@@ -3,6 +3,24 @@
 # SC2016 shellcheck wants double quotes for the free/used space calculation
 # below, but that requires additional ugly escaping
 
+# teslausb_metrics.py, which archiveloop runs, keeps this up to date (every 10
+# seconds by default). If it hasn't in a while, e.g. because the sampler was
+# killed, the status is collected here instead.
+readonly max_status_age=60
+if [[ -r /tmp/teslausb_status.json ]] &&
+   status_time=$(stat --format="%Y" /tmp/teslausb_status.json 2> /dev/null) &&
+   (( $(printf '%(%s)T' -1) - status_time < max_status_age )) &&
+   status=$(< /tmp/teslausb_status.json)
+then
+  cat << EOF
+HTTP/1.0 200 OK
+Content-type: application/json
+
+$status
+EOF
+  exit 0
+fi
+
 if [[ -e /sys/kernel/config/usb_gadget/teslausb ]]
 then
   drives_active=yes
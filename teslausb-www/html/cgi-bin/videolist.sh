@@ -1,5 +1,12 @@
 #!/bin/bash
 
+# Use the clip index that make_snapshot.sh maintains, if there is one, which
+# is much faster than looking at every link.
+if [ -r /mutable/clip_index.db ]
+then
+  QUERY_STRING="format=text" "$(dirname "$0")/cliplist.py" && exit 0
+fi
+
 cat << EOF
 HTTP/1.0 200 OK
 Content-type: text/plain
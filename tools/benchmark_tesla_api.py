@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+"""
+Benchmarks tesla_api.py against the local stand-in for the Tesla servers in
+mock_owner_api.py. Run this on the Pi after changing tesla_api.py, to catch
+performance regressions. It measures:
+
+  startup    how long tesla_api.py takes to start, and until its first
+             request reaches the server
+  functions  end-to-end time and number of requests of each of a set of CLI
+             calls, run directly and through the daemon
+  wake       how long waking a sleeping car takes, and how many requests it
+             takes, also with injected latency and errors
+  token      calls that have to refresh a rejected access token first
+  fleet      waking several cars with --fleet, compared to one after another
+
+The report can be written as JSON, and compared to one from an earlier
+release, e.g.
+
+  benchmark_tesla_api.py --output new.json --compare old.json --max-regression 20
+
+Usage: benchmark_tesla_api.py [--script /root/bin/tesla_api.py] [-n 5] [--only startup,functions]
+                              [--json] [--output <file>] [--compare <file>] [--max-regression <percent>]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_owner_api import MockOwnerApi
+
+REPORT_VERSION = 1
+SUITES = ('startup', 'functions', 'wake', 'token', 'fleet')
+
+# name -> tesla_api.py arguments
+FUNCTIONS = {
+    'list_vehicles': ['list_vehicles'],
+    'get_vehicle_online_state': ['get_vehicle_online_state'],
+    'is_sentry_mode_enabled': ['is_sentry_mode_enabled'],
+    'get_charge_state': ['get_charge_state'],
+    'get_fields': ['get_fields', '--arguments', 'names:locked+sentry_mode+charge_state.battery_level'],
+    'enable_sentry_mode': ['enable_sentry_mode'],
+    'set_charge_limit': ['set_charge_limit', '--arguments', 'percent:80'],
+    'batch': ['--batch', 'is_sentry_mode_enabled; enable_sentry_mode if not is_sentry_mode_enabled'],
+}
+
+# name -> MockOwnerApi options; the car starts out asleep in all of them
+WAKE_SCENARIOS = {
+    'asleep': {'wake_delay': 3},
+    'latency': {'wake_delay': 3, 'latency': 0.2},
+    'errors': {'wake_delay': 3, 'error_rate': 0.3, 'error_status': 503},
+    'rate_limited': {'wake_delay': 3, 'error_rate': 0.3, 'error_status': 429},
+    'outage': {'wake_delay': 3, 'fail_first': 4, 'error_status': 502},
+}
+FLEET_CARS = 3
+
+
+class Environment:
+    """
+    A mock server, and a mutable directory with a tesla_api.json that has
+    the server's tokens in it.
+    """
+    def __init__(self, script, **options):
+        self.script = script
+        self.api = MockOwnerApi(**options)
+        self.api.start()
+        self.mutable_dir = tempfile.mkdtemp(prefix='tesla_api_bench_')
+        with open(os.path.join(self.mutable_dir, 'tesla_api.json'), 'w') as f:
+            json.dump({
+                'access_token': self.api.access_token,
+                'refresh_token': self.api.refresh_token,
+                'id': self.api.vehicles[0].id,
+                'vehicle_id': self.api.vehicles[0].vehicle_id,
+            }, f)
+        self.env = dict(os.environ)
+        self.env.update({
+            'TESLA_API_BASE_URL': self.api.vehicles_url,
+            'TESLA_API_AUTH_URL': self.api.url,
+            # teslapy only talks plain HTTP to the mock with this.
+            'OAUTHLIB_INSECURE_TRANSPORT': '1',
+            'TESLA_API_MUTABLE_DIR': self.mutable_dir,
+            'TESLA_API_SOCKET': os.path.join(self.mutable_dir, 'tesla_api.sock'),
+            'TELEMETRY_SPOOL': os.path.join(self.mutable_dir, 'telemetry.spool'),
+            'TESLA_VIN': '',
+            'TESLA_NAME': '',
+        })
+        self.daemon = None
+
+    def command(self, arguments, daemon=False):
+        return [sys.executable, self.script] + arguments + ([] if daemon else ['--no-daemon'])
+
+    def run(self, arguments, daemon=False):
+        """
+        :return: (seconds, seconds until the first request reached the
+                  server or None, number of requests, exit code)
+        """
+        start = time.perf_counter()
+        requests_before = self.api.count()
+        result = subprocess.run(self.command(arguments, daemon), env=self.env, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, check=False)
+        elapsed = time.perf_counter() - start
+        first = self.api.first_request_at(since=start)
+        return (elapsed, first - start if first is not None else None, self.api.count() - requests_before,
+                result.returncode)
+
+    def start_daemon(self):
+        self.daemon = subprocess.Popen([sys.executable, self.script, '--daemon'], env=self.env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            if os.path.exists(self.env['TESLA_API_SOCKET']):
+                return
+            time.sleep(0.1)
+        raise RuntimeError('tesla_api.py daemon did not start')
+
+    def close(self):
+        if self.daemon:
+            self.daemon.terminate()
+            self.daemon.wait()
+        self.api.stop()
+        shutil.rmtree(self.mutable_dir, ignore_errors=True)
+
+
+def summarize(times):
+    if not times:
+        return None
+    return {
+        'min_ms': round(min(times) * 1000, 1),
+        'median_ms': round(statistics.median(times) * 1000, 1),
+        'max_ms': round(max(times) * 1000, 1),
+    }
+
+
+def summarize_runs(runs):
+    """
+    :param runs: results of Environment.run()
+    """
+    result = summarize([elapsed for elapsed, _, _, _ in runs]) or {}
+    result['requests'] = round(statistics.mean(count for _, _, count, _ in runs), 2)
+    result['failures'] = sum(1 for _, _, _, code in runs if code != 0)
+    return result
+
+
+def time_command(command, iterations):
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+######################################
+# Suites
+######################################
+def bench_startup(script, iterations):
+    python = sys.executable
+    results = {
+        'python_startup': summarize(time_command([python, '-c', 'pass'], iterations)),
+        'import_requests': summarize(time_command([python, '-c', 'import requests'], iterations)),
+        'help': summarize(time_command([python, script, '--help'], iterations)),
+    }
+    environment = Environment(script)
+    try:
+        runs = [environment.run(['is_sentry_mode_enabled']) for _ in range(iterations)]
+    finally:
+        environment.close()
+    results['first_request'] = summarize([first for _, first, _, _ in runs if first is not None])
+    results['call'] = summarize_runs(runs)
+    return results
+
+
+def bench_functions(script, iterations):
+    results = {}
+    for mode in ('direct', 'daemon'):
+        environment = Environment(script)
+        try:
+            if mode == 'daemon':
+                environment.start_daemon()
+            for name, arguments in FUNCTIONS.items():
+                runs = [environment.run(arguments, daemon=mode == 'daemon') for _ in range(iterations)]
+                results.setdefault(name, {})[mode] = summarize_runs(runs)
+        finally:
+            environment.close()
+    return results
+
+
+def bench_wake(script, iterations):
+    results = {}
+    for name, options in WAKE_SCENARIOS.items():
+        runs = []
+        wake_ups = []
+        polls = []
+        for iteration in range(iterations):
+            # Start every run with a sleeping car, and the same faults.
+            environment = Environment(script, asleep=True, seed=iteration, **options)
+            try:
+                runs.append(environment.run(['wake_up_vehicle']))
+                wake_ups.append(environment.api.count('POST', '/wake_up'))
+                polls.append(environment.api.count('GET', '/api/1/vehicles'))
+            finally:
+                environment.close()
+        result = summarize_runs(runs)
+        result['wake_up_requests'] = round(statistics.mean(wake_ups), 2)
+        result['state_polls'] = round(statistics.mean(polls), 2)
+        results[name] = result
+    return results
+
+
+def bench_token(script, iterations):
+    environment = Environment(script)
+    runs = []
+    refreshes = 0
+    try:
+        for _ in range(iterations):
+            environment.api.revoke_tokens()
+            before = environment.api.count('POST', '/oauth2/v3/token')
+            runs.append(environment.run(['is_sentry_mode_enabled']))
+            refreshes += environment.api.count('POST', '/oauth2/v3/token') - before
+    finally:
+        environment.close()
+    result = summarize_runs(runs)
+    result['token_requests'] = round(refreshes / iterations, 2)
+    return {'refresh_and_retry': result}
+
+
+def bench_fleet(script, iterations):
+    concurrent = []
+    sequential = []
+    for _ in range(iterations):
+        environment = Environment(script, cars=FLEET_CARS, asleep=True, wake_delay=2)
+        try:
+            concurrent.append(environment.run(['--fleet', 'all', 'wake_up_vehicle']))
+        finally:
+            environment.close()
+
+        environment = Environment(script, cars=FLEET_CARS, asleep=True, wake_delay=2)
+        try:
+            runs = [environment.run(['--vin', vehicle.vin, 'wake_up_vehicle']) for vehicle in environment.api.vehicles]
+            sequential.append((sum(run[0] for run in runs), None, sum(run[2] for run in runs),
+                               max(run[3] for run in runs)))
+        finally:
+            environment.close()
+    return {'wake_concurrent': summarize_runs(concurrent), 'wake_one_after_another': summarize_runs(sequential)}
+
+
+######################################
+# Reports
+######################################
+def _revision(script):
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(script),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _medians(results, prefix=''):
+    """
+    :return: dict of 'suite.name[.mode]' to the median time in milliseconds
+    """
+    medians = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        if 'median_ms' in value:
+            medians[prefix + key] = value['median_ms']
+        else:
+            medians.update(_medians(value, prefix + key + '.'))
+    return medians
+
+
+def compare(old, new, max_regression):
+    """
+    Print how the median times changed between two reports.
+    :return: the names of the measurements that got slower by more than
+             max_regression percent
+    """
+    old_medians = _medians(old['results'])
+    new_medians = _medians(new['results'])
+    regressions = []
+    print('{:<48} {:>10} {:>10} {:>8}'.format('', 'old ms', 'new ms', 'change'))
+    for name in sorted(set(old_medians) & set(new_medians)):
+        before = old_medians[name]
+        after = new_medians[name]
+        change = (after - before) / before * 100 if before else 0
+        flag = ''
+        if max_regression is not None and change > max_regression:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print('{:<48} {:>10.1f} {:>10.1f} {:>+7.1f}%{}'.format(name, before, after, change, flag))
+    return regressions
+
+
+def print_report(report):
+    for suite, results in report['results'].items():
+        print(suite)
+        for name, median in _medians(results).items():
+            print('  {:<46} median {:>9.1f} ms'.format(name, median))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run', 'tesla_api.py'),
+                        help='tesla_api.py to benchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=5, help='runs per measurement')
+    parser.add_argument('--only', help='comma-separated suites to run, out of ' + ', '.join(SUITES))
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--compare', help='compare with the report in this file')
+    parser.add_argument('--max-regression', type=float,
+                        help='exit with 1 if a median time is more than this many percent slower than in --compare')
+    args = parser.parse_args()
+
+    suites = args.only.split(',') if args.only else SUITES
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error('unknown suite: {}'.format(suite))
+    script = os.path.abspath(args.script)
+
+    report = {
+        'version': REPORT_VERSION,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'script': script,
+        'revision': _revision(script),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'results': {},
+    }
+    for suite in suites:
+        report['results'][suite] = globals()['bench_' + suite](script, args.iterations)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif not args.compare:
+        print_report(report)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            old = json.load(f)
+        if compare(old, report, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+"""
+A local stand-in for the webhook style notification providers (webhook,
+Discord, Slack, Gotify), to run send_notifications.py against without
+sending real notifications, e.g.
+
+  mock_notification_endpoint.py --port 8081
+  WEBHOOK_ENABLED=true WEBHOOK_URL=http://127.0.0.1:8081/webhook \\
+  NOTIFICATION_OUTBOX=/tmp/outbox send_notifications.py --queue title message
+
+Every request is printed, and answered with --status.
+
+With --check, it instead runs send_notifications.py's outbox through
+delivery while offline, coalescing, rejected messages, expiry and the exit
+code send-push-message relies on, and exits with 1 if any of that doesn't
+work as expected.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+RUN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run')
+
+
+class MockEndpoint:
+    """
+    Answers every POST with the status set for its path (default 200), and
+    records the path and body of each.
+    """
+    def __init__(self, status=200):
+        self.status = status
+        self.statuses = {}
+        # (path, body) of every request
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self, port=0):
+        """
+        Serve on 127.0.0.1 from a background thread.
+        :return: the base URL of the server
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def received(self, path=None):
+        """
+        :return: the bodies of the requests to path, or of all requests
+        """
+        with self.lock:
+            return [body for request_path, body in self.requests if path is None or request_path == path]
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+
+    def _handler_class(self):
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                raw = self.rfile.read(length).decode('utf-8') if length else ''
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    body = json.loads(raw or '{}')
+                else:
+                    body = dict((key, values[0]) for key, values in parse_qs(raw).items())
+                path = self.path.split('?')[0]
+                with endpoint.lock:
+                    status = endpoint.statuses.get(path, endpoint.status)
+                    if status < 300:
+                        endpoint.requests.append((path, body))
+                data = b'{}'
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+######################################
+# Check
+######################################
+class Check:
+    def __init__(self, script):
+        self.script = script
+        self.endpoint = MockEndpoint()
+        self.endpoint.start()
+        self.outbox = tempfile.mkdtemp(prefix='notification_outbox_')
+        self.env = dict(os.environ)
+        self.env.update({
+            'NOTIFICATION_OUTBOX': self.outbox,
+            'NOTIFICATION_TIMEOUT': '5',
+            'WEBHOOK_ENABLED': 'true',
+            'WEBHOOK_URL': self.endpoint.url + '/webhook',
+            'DISCORD_ENABLED': 'true',
+            'DISCORD_WEBHOOK_URL': self.endpoint.url + '/discord',
+        })
+        for name in ('PUSHOVER', 'GOTIFY', 'IFTTT', 'SNS', 'TELEGRAM', 'MATRIX', 'SLACK'):
+            self.env.pop(name + '_ENABLED', None)
+        self.failures = 0
+
+    def close(self):
+        self.endpoint.stop()
+        shutil.rmtree(self.outbox, ignore_errors=True)
+
+    def expect(self, what, condition):
+        print('{}: {}'.format('ok' if condition else 'FAILED', what))
+        if not condition:
+            self.failures += 1
+
+    def run(self, *args, env=None):
+        return subprocess.run([sys.executable, self.script] + list(args), env=env or self.env,
+                              stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60)
+
+    def queued(self):
+        return sorted(name for name in os.listdir(self.outbox) if name.endswith('.json'))
+
+    def flush(self):
+        # What the sender does on each pass.
+        return self.run('--queue', 'title', 'flush').returncode
+
+    def clear(self):
+        for name in self.queued():
+            os.remove(os.path.join(self.outbox, name))
+        self.endpoint.statuses = {}
+        self.endpoint.status = 200
+        self.endpoint.reset()
+
+    def direct(self):
+        result = self.run('title', 'direct message')
+        self.expect('sending directly exits with 0', result.returncode == 0)
+        self.expect('both providers got the message',
+                    len(self.endpoint.received('/webhook')) == 1 and len(self.endpoint.received('/discord')) == 1)
+
+    def offline(self):
+        self.endpoint.status = 503
+        start = self.run('--queue', 'host:', 'Archiving 2 event folder(s) starting at noon')
+        end = self.run('--queue', 'host:', 'Archiving completed successfully. Archived 12 files in 3 minutes')
+        self.expect('queueing while offline exits with 4', start.returncode == 4 and end.returncode == 4)
+        entries = [json.load(open(os.path.join(self.outbox, name))) for name in self.queued()]
+        self.expect('the start and end messages are merged in the outbox',
+                    len(entries) == 1 and 'starting at noon\nArchiving completed' in entries[0]['message'])
+        self.expect('attempts are counted', all(entry.get('attempts') for entry in entries))
+
+        self.endpoint.status = 200
+        self.flush()
+        self.expect('the outbox is empty once back online', not self.queued())
+        messages = [body['content'] for body in self.endpoint.received('/discord')]
+        merged = [message for message in messages if 'starting at noon\nArchiving completed' in message]
+        self.expect('the start and end messages were sent as one', len(merged) == 1)
+
+    def rejected(self):
+        self.endpoint.statuses['/webhook'] = 404
+        self.run('--queue', 'title', 'rejected by the webhook')
+        self.expect('a rejected message is dropped', not self.queued())
+        self.expect('the other provider still got it', len(self.endpoint.received('/discord')) == 1)
+        self.endpoint.statuses['/webhook'] = 429
+        self.endpoint.statuses['/discord'] = 403
+        self.run('--queue', 'title', 'rate limited')
+        providers = [json.load(open(os.path.join(self.outbox, name)))['providers'] for name in self.queued()]
+        self.expect('a 429 is retried, a 403 is not', providers == [['webhook']])
+
+    def expired(self):
+        self.endpoint.status = 503
+        self.run('--queue', 'title', 'old message')
+        for name in self.queued():
+            path = os.path.join(self.outbox, name)
+            with open(path) as f:
+                entry = json.load(f)
+            entry['queued_at'] -= 3 * 24 * 3600
+            with open(path, 'w') as f:
+                json.dump(entry, f)
+        self.flush()
+        remaining = [json.load(open(os.path.join(self.outbox, name)))['message'] for name in self.queued()]
+        self.expect('messages past the maximum age are given up on', 'old message' not in remaining)
+
+    def unqueueable(self):
+        env = dict(self.env, NOTIFICATION_OUTBOX='/dev/null/outbox')
+        result = self.run('--queue', 'title', 'nowhere to go', env=env)
+        self.expect("a message that can't be queued doesn't exit with 4 (exit code {})".format(result.returncode),
+                    result.returncode not in (0, 4))
+
+    def run_all(self):
+        for step in (self.direct, self.offline, self.rejected, self.expired, self.unqueueable):
+            self.clear()
+            step()
+        return self.failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--status', type=int, default=200, help='HTTP status to answer with')
+    parser.add_argument('--check', action='store_true', help="check send_notifications.py's outbox")
+    parser.add_argument('--script', default=os.path.join(RUN_DIR, 'send_notifications.py'),
+                        help='send_notifications.py to check')
+    args = parser.parse_args()
+
+    if args.check:
+        check = Check(os.path.abspath(args.script))
+        try:
+            return 1 if check.run_all() else 0
+        finally:
+            check.close()
+
+    endpoint = MockEndpoint(args.status)
+    endpoint.start(args.port)
+    print('serving on {}'.format(endpoint.url))
+    seen = 0
+    try:
+        while True:
+            time.sleep(0.5)
+            requests = endpoint.received()
+            for body in requests[seen:]:
+                print(json.dumps(body))
+            seen = len(requests)
+    except KeyboardInterrupt:
+        endpoint.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,597 @@
+#!/usr/bin/python3
+"""
+A local stand-in for the Tesla owner-api and its token endpoint, to run
+tesla_api.py against without a Tesla account or car. benchmark_tesla_api.py
+uses it, and it can be run by itself, e.g.
+
+  mock_owner_api.py --port 8080 --cars 2 --asleep --wake-delay 5
+  TESLA_API_BASE_URL=http://127.0.0.1:8080/api/1/vehicles \\
+  TESLA_API_AUTH_URL=http://127.0.0.1:8080 OAUTHLIB_INSECURE_TRANSPORT=1 \\
+  tesla_api.py wake_up_vehicle
+
+Implemented:
+  GET  /api/1/vehicles                            list, with each car's state
+  GET  /api/1/vehicles/<id>                       summary
+  POST /api/1/vehicles/<id>/wake_up               starts waking the car, which
+                                                  comes online --wake-delay
+                                                  seconds later
+  GET  /api/1/vehicles/<id>/vehicle_data          408 unless online
+  GET  /api/1/vehicles/<id>/data_request/<state>  408 unless online
+  GET  /api/1/vehicles/<id>/{data,service_data,nearby_charging_sites}
+  POST /api/1/vehicles/<id>/command/<command>     408 unless online
+  POST /oauth2/v3/token                           refresh_token grant
+  GET  /streaming/                                websocket, like the
+                                                  streaming server that
+                                                  tesla_api.py --keep_awake
+                                                  holds a connection to
+
+Requests with an access token the mock didn't issue get a 401. Latency and
+errors can be injected, and every request is recorded.
+
+The streaming server accepts data:subscribe_oauth messages, sends a
+data:update for each subscribed car every --stream-interval seconds, and a
+vehicle_disconnected error when the car is asleep, after which the car has
+to be woken and subscribed to again. It answers pings.
+
+With --check, it instead runs tesla_api.py --keep_awake against the
+streaming server, checks that the client stays subscribed as the car falls
+asleep and the connection drops, and exits with 1 if it doesn't.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+REFRESH_TOKEN = 'mock-refresh-token'
+# See RFC 6455.
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+STREAM_COLUMNS = 'speed,odometer,soc,elevation,est_heading,est_lat,est_lng,power,shift_state,range,est_range,heading'
+
+
+def make_access_token(lifetime=86400):
+    """
+    :return: an access token that looks like a JWT, so tesla_api.py can tell
+             when it expires
+    """
+    payload = base64.urlsafe_b64encode(json.dumps({'exp': int(time.time()) + lifetime}).encode()).decode()
+    return 'header.{}.{}'.format(payload.rstrip('='), random.getrandbits(64))
+
+
+class Vehicle:
+    def __init__(self, number, asleep):
+        self.id = str(1000 + number)
+        self.vehicle_id = 2000 + number
+        self.vin = 'MOCKVIN{:010d}'.format(number)
+        self.display_name = 'car{}'.format(number)
+        self.asleep = asleep
+        self.woken_at = None
+        self.sentry_mode = False
+        self.charge_limit = 80
+
+    def state(self, wake_delay):
+        if self.asleep and self.woken_at is not None and time.time() - self.woken_at >= wake_delay:
+            self.asleep = False
+            self.woken_at = None
+        return 'asleep' if self.asleep else 'online'
+
+    def fall_asleep(self):
+        self.asleep = True
+        self.woken_at = None
+
+    def listing(self, wake_delay):
+        return {
+            'id_s': self.id,
+            'vehicle_id': self.vehicle_id,
+            'vin': self.vin,
+            'display_name': self.display_name,
+            'state': self.state(wake_delay),
+        }
+
+    def data(self):
+        return {
+            'id_s': self.id,
+            'vehicle_id': self.vehicle_id,
+            'vin': self.vin,
+            'display_name': self.display_name,
+            'state': 'online',
+            'charge_state': {'battery_level': 64, 'charge_limit_soc': self.charge_limit, 'charging_state': 'Stopped'},
+            'climate_state': {'inside_temp': 21.5, 'outside_temp': 12.0, 'is_climate_on': False},
+            'drive_state': {'shift_state': None, 'speed': None, 'latitude': 37.4, 'longitude': -122.1},
+            'gui_settings': {'gui_distance_units': 'km/hr', 'gui_temperature_units': 'C'},
+            'vehicle_state': {'locked': True, 'odometer': 12345.6, 'sentry_mode': self.sentry_mode},
+        }
+
+
+class MockOwnerApi:
+    """
+    The state of the stand-in server: the cars, the tokens it accepts, the
+    faults to inject, and a log of the requests it got.
+    """
+    def __init__(self, cars=1, asleep=False, wake_delay=0.0, latency=0.0, error_rate=0.0, error_status=503,
+                 fail_first=0, seed=None, stream_interval=1.0):
+        """
+        :param cars: number of vehicles on the account
+        :param asleep: whether the cars start out asleep
+        :param wake_delay: seconds from the first wake_up until a car is online
+        :param latency: seconds added to every response
+        :param error_rate: fraction of owner-api requests that fail with
+                           error_status
+        :param fail_first: number of owner-api requests that fail with
+                           error_status before any succeed
+        :param stream_interval: seconds between the streaming server's
+                                updates
+        """
+        self.vehicles = [Vehicle(number, asleep) for number in range(1, cars + 1)]
+        self.wake_delay = wake_delay
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_first = fail_first
+        self.random = random.Random(seed)
+        self.access_token = make_access_token()
+        self.valid_tokens = {self.access_token}
+        self.refresh_token = REFRESH_TOKEN
+        # (time, method, path, status) of every request
+        self.requests = []
+        self.stream_interval = stream_interval
+        # (time, event, vehicle_id) of every streaming connection, subscription
+        # and vehicle_disconnected error, and the open connections
+        self.stream_events = []
+        self.streams = set()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self, port=0):
+        """
+        Serve on 127.0.0.1 from a background thread.
+        :return: the base URL of the server
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.drop_streams()
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    @property
+    def vehicles_url(self):
+        return self.url + '/api/1/vehicles'
+
+    @property
+    def streaming_url(self):
+        return 'ws://127.0.0.1:{}/streaming/'.format(self.server.server_address[1])
+
+    def drop_streams(self):
+        """
+        Cut the open streaming connections, as if the network went away.
+        """
+        with self.lock:
+            streams = list(self.streams)
+        for stream in streams:
+            stream.drop()
+
+    def stream_count(self, event, since=0):
+        """
+        :return: the number of streaming 'connect', 'subscribe' or
+                 'disconnected' events since the given time
+        """
+        with self.lock:
+            return sum(1 for at, stream_event, _ in self.stream_events if at >= since and stream_event == event)
+
+    def revoke_tokens(self):
+        """
+        Make the server reject the access tokens issued so far, as if they
+        had expired.
+        """
+        with self.lock:
+            self.valid_tokens.clear()
+
+    def reset_log(self):
+        with self.lock:
+            self.requests = []
+
+    def count(self, method=None, suffix=None, since=0):
+        """
+        :return: the number of requests recorded, optionally only those with
+                 the given method, whose path ends with suffix, or that came
+                 in after the given time
+        """
+        with self.lock:
+            return sum(1 for at, request_method, path, _ in self.requests
+                       if at >= since
+                       and (method is None or request_method == method)
+                       and (suffix is None or path.endswith(suffix)))
+
+    def first_request_at(self, since=0):
+        with self.lock:
+            times = [at for at, _, _, _ in self.requests if at >= since]
+        return min(times) if times else None
+
+    def _vehicle(self, vehicle_id):
+        for vehicle in self.vehicles:
+            if vehicle.id == vehicle_id:
+                return vehicle
+        return None
+
+    def _inject_error(self):
+        with self.lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return True
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def handle(self, method, path, headers, body):
+        """
+        :return: (status, JSON response)
+        """
+        if path == '/oauth2/v3/token' and method == 'POST':
+            return self._token(body)
+
+        if not path.startswith('/api/1/vehicles'):
+            return 404, {'response': None, 'error': 'not_found'}
+        token = headers.get('Authorization', '')[len('Bearer '):]
+        with self.lock:
+            authorized = token in self.valid_tokens
+        if not authorized:
+            return 401, {'response': None, 'error': 'invalid bearer token'}
+        if self._inject_error():
+            return self.error_status, {'response': None, 'error': 'injected error'}
+
+        parts = path[len('/api/1/vehicles'):].strip('/').split('/')
+        with self.lock:
+            if parts == ['']:
+                return 200, {'response': [vehicle.listing(self.wake_delay) for vehicle in self.vehicles],
+                             'count': len(self.vehicles)}
+            vehicle = self._vehicle(parts[0])
+            if vehicle is None:
+                return 404, {'response': None, 'error': 'not_found'}
+            state = vehicle.state(self.wake_delay)
+            action = parts[1:]
+            if method == 'POST' and action == ['wake_up']:
+                if state == 'asleep' and vehicle.woken_at is None:
+                    vehicle.woken_at = time.time()
+                return 200, {'response': vehicle.listing(self.wake_delay)}
+            if not action:
+                return 200, {'response': vehicle.listing(self.wake_delay)}
+            if state != 'online':
+                return 408, {'response': None, 'error': 'vehicle unavailable: {:vehicle is offline or asleep}',
+                             'error_description': ''}
+            if method == 'GET' and action in (['vehicle_data'], ['data']):
+                return 200, {'response': vehicle.data()}
+            if method == 'GET' and len(action) == 2 and action[0] == 'data_request':
+                section = vehicle.data().get(action[1])
+                if section is None:
+                    return 404, {'response': None, 'error': 'not_found'}
+                return 200, {'response': section}
+            if method == 'GET' and action == ['service_data']:
+                return 200, {'response': {'service_status': 'not_in_service'}}
+            if method == 'GET' and action == ['nearby_charging_sites']:
+                return 200, {'response': {'superchargers': [], 'destination_charging': []}}
+            if method == 'POST' and len(action) == 2 and action[0] == 'command':
+                return 200, {'response': self._command(vehicle, action[1], body)}
+        return 404, {'response': None, 'error': 'not_found'}
+
+    def _command(self, vehicle, command, body):
+        if command == 'set_sentry_mode':
+            vehicle.sentry_mode = body.get('on', ['false'])[0].lower() == 'true'
+        elif command == 'set_charge_limit':
+            vehicle.charge_limit = int(body.get('percent', [vehicle.charge_limit])[0])
+        return {'result': True, 'reason': ''}
+
+    def _token(self, body):
+        if body.get('grant_type', [''])[0] != 'refresh_token' or body.get('refresh_token', [''])[0] != self.refresh_token:
+            return 401, {'error': 'invalid_grant'}
+        access_token = make_access_token()
+        with self.lock:
+            self.valid_tokens.add(access_token)
+        return 200, {
+            'access_token': access_token,
+            'refresh_token': self.refresh_token,
+            'expires_in': 86400,
+            'token_type': 'Bearer',
+        }
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get('Upgrade', '').lower() == 'websocket' and self.path.startswith('/streaming'):
+                    self._stream()
+                    return
+                self._serve('GET')
+
+            def _stream(self):
+                accept = base64.b64encode(hashlib.sha1(
+                    (self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode()).digest()).decode()
+                # Websocket clients want HTTP/1.1, the rest of the mock
+                # sticks to HTTP/1.0.
+                self.protocol_version = 'HTTP/1.1'
+                self.send_response(101, 'Switching Protocols')
+                self.send_header('Upgrade', 'websocket')
+                self.send_header('Connection', 'Upgrade')
+                self.send_header('Sec-WebSocket-Accept', accept)
+                self.end_headers()
+                self.wfile.flush()
+                self.close_connection = True
+                _Stream(api, self.connection, self.rfile).run()
+
+            def do_POST(self):
+                self._serve('POST')
+
+            def _serve(self, method):
+                length = int(self.headers.get('Content-Length', 0))
+                raw = self.rfile.read(length).decode('utf-8') if length else ''
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    body = {key: [str(value)] for key, value in json.loads(raw or '{}').items()}
+                else:
+                    body = parse_qs(raw)
+                path = self.path.split('?')[0].replace('//', '/')
+                with api.lock:
+                    api.requests.append((time.perf_counter(), method, path, None))
+                    index = len(api.requests) - 1
+                if api.latency:
+                    time.sleep(api.latency)
+                status, response = api.handle(method, path, self.headers, body)
+                with api.lock:
+                    if index < len(api.requests):
+                        at, _, _, _ = api.requests[index]
+                        api.requests[index] = (at, method, path, status)
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class _Stream:
+    """
+    One connection to the streaming server. Frames from the client are read
+    on the request's thread, updates are sent from another one.
+    """
+    def __init__(self, api, connection, rfile):
+        self.api = api
+        self.connection = connection
+        self.rfile = rfile
+        self.send_lock = threading.Lock()
+        self.closed = threading.Event()
+        # vehicle_id of the subscribed car, and whether it's subscribed
+        self.subscriptions = {}
+
+    def _record(self, event, vehicle_id=None):
+        with self.api.lock:
+            self.api.stream_events.append((time.time(), event, vehicle_id))
+
+    def drop(self):
+        self.closed.set()
+        try:
+            self.connection.shutdown(2)
+        except OSError:
+            pass
+
+    def send(self, opcode, payload=b''):
+        # Server frames aren't masked.
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([126]) + struct.pack('!H', len(payload))
+        else:
+            header += bytes([127]) + struct.pack('!Q', len(payload))
+        with self.send_lock:
+            self.connection.sendall(header + payload)
+
+    def send_json(self, message):
+        self.send(0x1, json.dumps(message).encode('utf-8'))
+
+    def _read_exactly(self, count):
+        data = self.rfile.read(count)
+        if len(data) < count:
+            raise EOFError
+        return data
+
+    def read_frame(self):
+        """
+        :return: (opcode, payload) of the next frame from the client
+        """
+        first, second = self._read_exactly(2)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._read_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read_exactly(8))[0]
+        mask = self._read_exactly(4) if second & 0x80 else b'\0\0\0\0'
+        payload = self._read_exactly(length)
+        return first & 0x0f, bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+    def _vehicle(self, vehicle_id):
+        for vehicle in self.api.vehicles:
+            if str(vehicle.vehicle_id) == vehicle_id:
+                return vehicle
+        return None
+
+    def _subscribe(self, message):
+        tag = message.get('tag', '')
+        with self.api.lock:
+            authorized = message.get('token') in self.api.valid_tokens
+            vehicle = self._vehicle(tag)
+            state = vehicle.state(self.api.wake_delay) if vehicle else None
+        if not authorized:
+            self.send_json({'msg_type': 'data:error', 'tag': tag, 'value': "Can't validate token. ",
+                            'error_type': 'client_error'})
+            return
+        if state != 'online':
+            self._disconnected(tag)
+            return
+        self._record('subscribe', tag)
+        self.subscriptions[tag] = True
+
+    def _disconnected(self, tag):
+        self._record('disconnected', tag)
+        self.subscriptions.pop(tag, None)
+        self.send_json({'msg_type': 'data:error', 'tag': tag, 'value': 'disconnected',
+                        'error_type': 'vehicle_disconnected'})
+
+    def _send_updates(self):
+        while not self.closed.wait(self.api.stream_interval):
+            try:
+                for tag in list(self.subscriptions):
+                    with self.api.lock:
+                        vehicle = self._vehicle(tag)
+                        online = vehicle.state(self.api.wake_delay) == 'online'
+                    if not online:
+                        self._disconnected(tag)
+                        continue
+                    values = [str(int(time.time() * 1000))] + [''] * len(STREAM_COLUMNS.split(','))
+                    self.send_json({'msg_type': 'data:update', 'tag': tag, 'value': ','.join(values)})
+            except OSError:
+                return
+
+    def run(self):
+        self._record('connect')
+        with self.api.lock:
+            self.api.streams.add(self)
+        threading.Thread(target=self._send_updates, daemon=True).start()
+        try:
+            self.send_json({'msg_type': 'control:hello', 'connection_timeout': 30000})
+            while not self.closed.is_set():
+                opcode, payload = self.read_frame()
+                if opcode == 0x8:
+                    self.send(0x8, payload[:2])
+                    break
+                if opcode == 0x9:
+                    self.send(0xa, payload)
+                elif opcode == 0x1:
+                    message = json.loads(payload.decode('utf-8'))
+                    if message.get('msg_type') == 'data:subscribe_oauth':
+                        self._subscribe(message)
+        except (OSError, EOFError, ValueError):
+            pass
+        finally:
+            self.closed.set()
+            with self.api.lock:
+                self.api.streams.discard(self)
+
+
+######################################
+# Check
+######################################
+def _wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def check_keep_awake(script):
+    """
+    Run tesla_api.py --keep_awake against the streaming server, while the car
+    falls asleep and the connection drops.
+    :return: the number of checks that failed
+    """
+    from benchmark_tesla_api import Environment
+
+    failures = 0
+
+    def expect(what, condition):
+        nonlocal failures
+        print('{}: {}'.format('ok' if condition else 'FAILED', what))
+        if not condition:
+            failures += 1
+
+    environment = Environment(script, asleep=True, wake_delay=1, stream_interval=0.5)
+    api = environment.api
+    vehicle = api.vehicles[0]
+    client = subprocess.Popen(environment.command(['--keep_awake', '--streaming_url', api.streaming_url]),
+                              env=environment.env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+    try:
+        expect('the car is woken and subscribed to',
+               _wait_for(lambda: api.stream_count('subscribe') == 1, 30))
+        expect('the car was woken first', api.count('POST', '/wake_up') >= 1)
+
+        with api.lock:
+            vehicle.fall_asleep()
+        wakes = api.count('POST', '/wake_up')
+        expect('after the car fell asleep, it is woken and subscribed to again',
+               _wait_for(lambda: api.stream_count('subscribe') == 2, 30))
+        expect('the car was woken again', api.count('POST', '/wake_up') > wakes)
+        expect('on the same connection', api.stream_count('connect') == 1)
+
+        api.drop_streams()
+        expect('after the connection dropped, the client reconnects and subscribes again',
+               _wait_for(lambda: api.stream_count('connect') == 2 and api.stream_count('subscribe') == 3, 30))
+        expect('the client is still running', client.poll() is None)
+    finally:
+        client.terminate()
+        _, stderr = client.communicate()
+        environment.close()
+    if failures:
+        print(stderr, file=sys.stderr)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--cars', type=int, default=1, help='number of vehicles on the account')
+    parser.add_argument('--asleep', action='store_true', help='start with the cars asleep')
+    parser.add_argument('--wake-delay', type=float, default=0, help='seconds it takes a car to wake up')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status of the failed requests')
+    parser.add_argument('--fail-first', type=int, default=0, help='number of requests that fail first')
+    parser.add_argument('--stream-interval', type=float, default=1, help='seconds between streaming updates')
+    parser.add_argument('--check', action='store_true', help='check tesla_api.py --keep_awake')
+    parser.add_argument('--script',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run', 'tesla_api.py'),
+                        help='tesla_api.py to check')
+    args = parser.parse_args()
+
+    if args.check:
+        return 1 if check_keep_awake(os.path.abspath(args.script)) else 0
+
+    api = MockOwnerApi(args.cars, args.asleep, args.wake_delay, args.latency, args.error_rate, args.error_status,
+                       args.fail_first, stream_interval=args.stream_interval)
+    api.start(args.port)
+    print('serving on {}'.format(api.url))
+    print('access token: {}'.format(api.access_token))
+    print('refresh token: {}'.format(api.refresh_token))
+    print('streaming: {}'.format(api.streaming_url))
+    for vehicle in api.vehicles:
+        print('vehicle {} (ID {}, VIN {})'.format(vehicle.display_name, vehicle.id, vehicle.vin))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())